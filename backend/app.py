@@ -1,19 +1,120 @@
-from flask import Flask, request, send_file, jsonify
+from flask import Flask, request, send_file, jsonify, Response, url_for, g
 from flask_cors import CORS
 import os
+import uuid
 import base64
+import threading
 from perform import SmartDocumentProcessor
-import asyncio
+from jobs import QueueFullError
+from batch import receive_batch, build_result_archive
+from web_common import (
+    TEMP_DIR,
+    SPILL_THRESHOLD,
+    BATCH_MAX_FILES,
+    RESULT_TYPES,
+    record_timings as finish_timings,
+    new_job_dir,
+    keep_in_memory,
+    memory_upload,
+    saved_upload,
+    parse_options,
+    remove_job_dir,
+    error_response,
+    queue_full,
+    job_accepted,
+    job_not_ready,
+    sse_event,
+    create_job_manager,
+)
+import metrics
 from PIL import Image
 import io
-import time
 
 app = Flask(__name__)
 CORS(app, supports_credentials=True, expose_headers=['Content-Disposition'])
 
 
+_processor = None
+_jobs = None
+_setup_lock = threading.Lock()
+
+
+# One processor for the whole server: env, Gemini client, event loop and render workers are set up
+# once, by the first request or at start-up in the process that serves (see __main__). Never at
+# import: the debug reloader's watcher process and the extraction workers import this module too
+def get_processor():
+    global _processor, _jobs
+    with _setup_lock:
+        if _processor is None:
+            _processor = SmartDocumentProcessor()
+            _processor.warm_up()
+            _jobs = create_job_manager(_processor)
+        return _processor
+
+
+def get_jobs():
+    get_processor()
+    return _jobs
+
+
+@app.before_request
+def start_timings():
+    g.timings = metrics.RequestTimings()
+
+
+@app.after_request
+def record_timings(response):
+    finish_timings(g.get("timings"), request.endpoint, response.headers)
+    return response
+
+
+# Returns the job ID, the job directory, and the process() arguments describing the upload
+def receive_upload(file):
+    job_id, job_dir = new_job_dir()
+    filename = os.path.basename(file.filename)
+
+    with g.timings.span("upload"):
+        if keep_in_memory(request.content_length):
+            return job_id, job_dir, memory_upload(job_id, filename, file.read())
+
+        file_path = os.path.join(job_dir, filename)
+        file.save(file_path)
+        return job_id, job_dir, saved_upload(job_id, file_path)
+
+
+# See web_common.parse_options, from_accept lets the Accept header pick the output format
+def request_options(from_accept=False):
+    return parse_options(request.args, request.form, request.accept_mimetypes if from_accept else None)
+
+
+# Send the finished result (diagram, Mermaid source or workflow JSON) from memory so the job
+# directory can be removed right after
+def send_result(result_path):
+    with g.timings.span("send"), open(result_path, "rb") as f:
+        data = f.read()
+
+    filename = os.path.basename(result_path)
+    print(f"Sending file: {result_path}")
+    try:
+        return send_file(
+            io.BytesIO(data),
+            mimetype=RESULT_TYPES.get(filename, "application/octet-stream"),
+            as_attachment=True,
+            download_name=filename,
+        )
+    except Exception as e:
+        print(f"Error sending file: {e}")
+        # If send_file fails, send the file as base64
+        encoded = base64.b64encode(data).decode('utf-8')
+        return jsonify({
+            "image": encoded,
+            "filename": filename
+        })
+
+
 @app.route("/process-document", methods=["POST"])
 def process_document():
+    job_dir = None
     try:
         print("Received request")
         print("Request headers:", dict(request.headers))
@@ -28,64 +129,34 @@ def process_document():
             print("No selected file")
             return {"error": "No selected file"}, 400
 
+        options, error = request_options(from_accept=True)
+        if error:
+            return error
+
         print(f"Processing file: {file.filename}")
 
-        temp_dir = "temp"
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        # Clear existing files in temp directory
-        for existing_file in os.listdir(temp_dir):
-            file_path = os.path.join(temp_dir, existing_file)
-            try:
-                if os.path.isfile(file_path):
-                    os.unlink(file_path)
-            except Exception as e:
-                print(f"Error deleting {file_path}: {e}")
-
-        file_path = os.path.join(temp_dir, file.filename)
-        file.save(file_path)
-        print(f"File saved at: {file_path}")
-
-        processor = SmartDocumentProcessor()
-        asyncio.run(processor.process())
-
-        # Add a small delay to ensure file is completely written
-        time.sleep(0.5)
-        
-        png_path = os.path.join(temp_dir, "workflow.png")
-        if os.path.exists(png_path):
-            print(f"Sending file: {png_path}")
-            try:
-                return send_file(
-                    png_path,
-                    mimetype="image/png",
-                    as_attachment=True,
-                    download_name="workflow.png",
-                )
-            except Exception as e:
-                print(f"Error sending file: {e}")
-                # If send_file fails, try to read the file and send as base64
-                with open(png_path, "rb") as f:
-                    image_data = f.read()
-                    encoded = base64.b64encode(image_data).decode('utf-8')
-                    return jsonify({
-                        "image": encoded,
-                        "filename": "workflow.png"
-                    })
+        job_id, job_dir, upload = receive_upload(file)
+        processor = get_processor()
+        result_path = processor.run(
+            processor.process(job_dir=job_dir, timings=g.timings, **upload, **options)
+        )
+
+        if result_path and os.path.exists(result_path):
+            return send_result(result_path)
         else:
-            print("PNG file not found")
+            print("Result file not found")
             return {"error": "Failed to generate diagram"}, 500
 
     except Exception as e:
-        import traceback
-
-        print(f"Error occurred: {str(e)}")
-        traceback.print_exc()
-        return {"error": str(e)}, 500
+        return error_response(e)
+    finally:
+        if job_dir:
+            remove_job_dir(job_dir)
 
 
 @app.route("/process-camera", methods=["POST"])
 def process_camera():
+    job_dir = None
     try:
         print("Received camera request")
         print("Request headers:", dict(request.headers))
@@ -101,65 +172,162 @@ def process_camera():
             print("No selected file")
             return {"error": "No selected file"}, 400
 
-        print(f"Processing file: {file.filename}")
+        options, error = request_options(from_accept=True)
+        if error:
+            return error
 
-        # Prepare temp directory
-        temp_dir = "temp"
-        os.makedirs(temp_dir, exist_ok=True)
-
-        # Clear existing files in temp directory
-        for existing_file in os.listdir(temp_dir):
-            file_path = os.path.join(temp_dir, existing_file)
-            try:
-                if os.path.isfile(file_path):
-                    os.unlink(file_path)
-            except Exception as e:
-                print(f"Error deleting {file_path}: {e}")
-
-        # Save the file
-        file_path = os.path.join(temp_dir, file.filename)
-        file.save(file_path)
-        print(f"File saved at: {file_path}")
+        print(f"Processing file: {file.filename}")
 
-        # Process document
-        processor = SmartDocumentProcessor()
-        asyncio.run(processor.process())
+        # Give the file a fresh job directory and process it
+        job_id, job_dir, upload = receive_upload(file)
+        processor = get_processor()
+        result_path = processor.run(
+            processor.process(job_dir=job_dir, timings=g.timings, **upload, **options)
+        )
 
-        # Add a small delay to ensure file is completely written
-        time.sleep(0.5)
-        
         # Return the generated PNG
-        png_path = os.path.join(temp_dir, "workflow.png")
-        if os.path.exists(png_path):
-            print(f"Sending file: {png_path}")
-            try:
-                return send_file(
-                    png_path,
-                    mimetype="image/png",
-                    as_attachment=True,
-                    download_name="workflow.png",
-                )
-            except Exception as e:
-                print(f"Error sending file: {e}")
-                # If send_file fails, try to read the file and send as base64
-                with open(png_path, "rb") as f:
-                    image_data = f.read()
-                    encoded = base64.b64encode(image_data).decode('utf-8')
-                    return jsonify({
-                        "image": encoded,
-                        "filename": "workflow.png"
-                    })
+        if result_path and os.path.exists(result_path):
+            return send_result(result_path)
         else:
-            print("PNG file not found")
+            print("Result file not found")
             return {"error": "Failed to generate diagram"}, 500
 
     except Exception as e:
-        import traceback
+        return error_response(e)
+    finally:
+        if job_dir:
+            remove_job_dir(job_dir)
+
+
+# Prometheus scrape endpoint: request and stage latency histograms, upload and prompt sizes,
+# cache and Gemini client counters
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+# Many documents in one request: any number of `files` fields and/or .zip archives.
+# Returns a ZIP with one diagram per file and a manifest.json covering failures too
+@app.route("/process-batch", methods=["POST"])
+def process_batch():
+    uploads = request.files.getlist("files") + request.files.getlist("file")
+    uploads = [file for file in uploads if file.filename]
+    if not uploads:
+        return {"error": "No files in request"}, 400
+
+    options, error = request_options()
+    if error:
+        return error
+
+    concurrency = request.args.get("concurrency", type=int)
+    batch_dir = os.path.join(TEMP_DIR, uuid.uuid4().hex)
+    os.makedirs(batch_dir, exist_ok=True)
+    try:
+        items, skipped = receive_batch(
+            [(file.filename, file.stream) for file in uploads],
+            batch_dir,
+            SPILL_THRESHOLD,
+            BATCH_MAX_FILES,
+        )
+        print(f"Received batch of {len(items)} files ({len(skipped)} skipped)")
+
+        processor = get_processor()
+        results = processor.run(
+            processor.process_batch(
+                items,
+                batch_dir,
+                concurrency=concurrency,
+                renderer=options.get("renderer"),
+                output=options["output"],
+            )
+        )
+        return send_file(
+            build_result_archive(results, skipped),
+            mimetype="application/zip",
+            as_attachment=True,
+            download_name="workflows.zip",
+        )
+
+    except Exception as e:
+        return error_response(e)
+    finally:
+        remove_job_dir(batch_dir)
+
+
+# Submit an upload as a background job, returns straight away with the job ID
+@app.route("/jobs", methods=["POST"])
+def submit_job():
+    if "file" not in request.files:
+        return {"error": "No file part"}, 400
+
+    file = request.files["file"]
+    if file.filename == "":
+        return {"error": "No selected file"}, 400
+
+    options, error = request_options()
+    if error:
+        return error
+
+    job_id, job_dir, upload = receive_upload(file)
+    try:
+        job = get_jobs().submit(job_dir, {**upload, **options}, job_id=job_id)
+    except QueueFullError as e:
+        remove_job_dir(job_dir)
+        return queue_full(e)
+
+    print(f"Queued job {job.id} for {file.filename}")
+    return job_accepted(job, url_for)
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = get_jobs().get(job_id)
+    if job is None:
+        return {"error": "Unknown job"}, 404
+    return job.to_dict()
+
+
+# Server-sent events: a "stage" event per stage change plus "node"/"edge" events as the model
+# streams its answer. Late listeners get the whole history first. The stream ends when the job is done or failed
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def job_events(job_id):
+    job = get_jobs().get(job_id)
+    if job is None:
+        return {"error": "Unknown job"}, 404
+
+    def stream():
+        sent = 0
+        while True:
+            events = job.events[sent:]
+            if events:
+                for event, data in events:
+                    yield sse_event(event, data)
+                sent += len(events)
+                if job.finished and sent == len(job.events):
+                    return
+            else:
+                yield ": keep-alive\n\n"
+            job.wait_for_change(sent)
+
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 
-        print(f"Error occurred: {str(e)}")
-        traceback.print_exc()
-        return {"error": str(e)}, 500
+@app.route("/jobs/<job_id>/result", methods=["GET"])
+def job_result(job_id):
+    job = get_jobs().get(job_id)
+    error = job_not_ready(job)
+    if error:
+        return error
+    return send_result(job.result_path)
 
 
 if __name__ == "__main__":
-    app.run(debug=True, port=5001, host="0.0.0.0")
\ No newline at end of file
+    # The debug reloader runs this in a watcher process as well, only the child that serves
+    # requests (WERKZEUG_RUN_MAIN) sets the processor up ahead of the first request
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        get_processor()
+    app.run(debug=True, port=5001, host="0.0.0.0")
@@ -0,0 +1,274 @@
+import os
+import uuid
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from quart import Quart, request, Response, g, url_for
+from quart_cors import cors
+
+from perform import SmartDocumentProcessor
+from jobs import QueueFullError
+from batch import receive_batch, build_result_archive
+from web_common import (
+    TEMP_DIR,
+    SPILL_THRESHOLD,
+    BATCH_MAX_FILES,
+    RESULT_TYPES,
+    record_timings as finish_timings,
+    new_job_dir,
+    keep_in_memory,
+    memory_upload,
+    saved_upload,
+    parse_options,
+    remove_job_dir,
+    error_response,
+    queue_full,
+    job_accepted,
+    job_not_ready,
+    sse_event,
+    create_job_manager,
+)
+import metrics
+
+# Async-native server: run with `hypercorn asgi:app` (or any ASGI server).
+# The processor's coroutines run directly on the server's event loop, so every request
+# is just another task on it and their Gemini calls overlap. Blocking work (PDF/DOCX
+# extraction, PIL, rendering) already goes to threads or the extraction process pool.
+# Serves the same API as app.py; the request handling both share lives in web_common.
+
+app = Quart(__name__)
+app = cors(
+    app,
+    allow_origin=os.getenv("CORS_ORIGINS", "*").split(","),
+    expose_headers=["Content-Disposition", "Server-Timing"],
+)
+
+# Threads for the blocking work handed off with asyncio.to_thread / run_in_executor
+BLOCKING_THREADS = int(os.getenv("ASGI_THREADS", "32"))
+
+processor = SmartDocumentProcessor()
+# Job threads hand their work to the server's loop through processor.run
+jobs = create_job_manager(processor)
+
+
+@app.before_serving
+async def start_processor():
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(
+        ThreadPoolExecutor(max_workers=BLOCKING_THREADS, thread_name_prefix="blocking")
+    )
+    processor.attach_loop(loop)
+    # starting the render workers blocks, keep it off the loop
+    await asyncio.to_thread(processor.warm_up)
+
+
+@app.after_serving
+async def stop_jobs():
+    jobs.shutdown()
+
+
+@app.before_request
+async def start_timings():
+    g.timings = metrics.RequestTimings()
+
+
+@app.after_request
+async def record_timings(response):
+    finish_timings(g.get("timings"), request.endpoint, response.headers)
+    return response
+
+
+# Same as app.receive_upload: small uploads stay in memory, bigger ones go to the job directory
+async def receive_upload(file):
+    job_id, job_dir = await asyncio.to_thread(new_job_dir)
+    filename = os.path.basename(file.filename)
+
+    with g.timings.span("upload"):
+        if keep_in_memory(request.content_length):
+            return job_id, job_dir, memory_upload(job_id, filename, file.read())
+
+        file_path = os.path.join(job_dir, filename)
+        await file.save(file_path)  # Quart's FileStorage.save is a coroutine
+        return job_id, job_dir, saved_upload(job_id, file_path)
+
+
+async def request_options(from_accept=False):
+    form = await request.form
+    return parse_options(request.args, form, request.accept_mimetypes if from_accept else None)
+
+
+async def send_result(result_path):
+    with g.timings.span("send"):
+        data = await asyncio.to_thread(read_file, result_path)
+    filename = os.path.basename(result_path)
+    return Response(
+        data,
+        mimetype=RESULT_TYPES.get(filename, "application/octet-stream"),
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+# /process-document and /process-camera do the same thing, the processor picks the path by file type
+@app.route("/process-document", methods=["POST"])
+@app.route("/process-camera", methods=["POST"])
+async def process_upload():
+    files = await request.files
+    if "file" not in files:
+        return {"error": "No file part"}, 400
+
+    file = files["file"]
+    if file.filename == "":
+        return {"error": "No selected file"}, 400
+
+    options, error = await request_options(from_accept=True)
+    if error:
+        return error
+
+    print(f"Processing file: {file.filename}")
+    job_dir = None
+    try:
+        job_id, job_dir, upload = await receive_upload(file)
+        result_path = await processor.process(
+            job_dir=job_dir, timings=g.timings, **upload, **options
+        )
+        if result_path and os.path.exists(result_path):
+            return await send_result(result_path)
+        print("Result file not found")
+        return {"error": "Failed to generate diagram"}, 500
+
+    except Exception as e:
+        return error_response(e)
+    finally:
+        if job_dir:
+            await asyncio.to_thread(remove_job_dir, job_dir)
+
+
+@app.route("/process-batch", methods=["POST"])
+async def process_batch():
+    files = await request.files
+    uploads = [file for file in files.getlist("files") + files.getlist("file") if file.filename]
+    if not uploads:
+        return {"error": "No files in request"}, 400
+
+    options, error = await request_options()
+    if error:
+        return error
+
+    concurrency = request.args.get("concurrency", type=int)
+    batch_dir = os.path.join(TEMP_DIR, uuid.uuid4().hex)
+    os.makedirs(batch_dir, exist_ok=True)
+    try:
+        items, skipped = await asyncio.to_thread(
+            receive_batch,
+            [(file.filename, file.stream) for file in uploads],
+            batch_dir,
+            SPILL_THRESHOLD,
+            BATCH_MAX_FILES,
+        )
+        print(f"Received batch of {len(items)} files ({len(skipped)} skipped)")
+
+        results = await processor.process_batch(
+            items,
+            batch_dir,
+            concurrency=concurrency,
+            renderer=options.get("renderer"),
+            output=options["output"],
+        )
+        archive = await asyncio.to_thread(build_result_archive, results, skipped)
+        return Response(
+            archive.getvalue(),
+            mimetype="application/zip",
+            headers={"Content-Disposition": 'attachment; filename="workflows.zip"'},
+        )
+
+    except Exception as e:
+        return error_response(e)
+    finally:
+        await asyncio.to_thread(remove_job_dir, batch_dir)
+
+
+# Same job API as app.py
+@app.route("/jobs", methods=["POST"])
+async def submit_job():
+    files = await request.files
+    if "file" not in files:
+        return {"error": "No file part"}, 400
+
+    file = files["file"]
+    if file.filename == "":
+        return {"error": "No selected file"}, 400
+
+    options, error = await request_options()
+    if error:
+        return error
+
+    job_id, job_dir, upload = await receive_upload(file)
+    try:
+        job = jobs.submit(job_dir, {**upload, **options}, job_id=job_id)
+    except QueueFullError as e:
+        await asyncio.to_thread(remove_job_dir, job_dir)
+        return queue_full(e)
+
+    print(f"Queued job {job.id} for {file.filename}")
+    return job_accepted(job, url_for)
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+async def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return {"error": "Unknown job"}, 404
+    return job.to_dict()
+
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+async def job_events(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return {"error": "Unknown job"}, 404
+
+    async def stream():
+        sent = 0
+        while True:
+            events = job.events[sent:]
+            if events:
+                for event, data in events:
+                    yield sse_event(event, data)
+                sent += len(events)
+                if job.finished and sent == len(job.events):
+                    return
+            else:
+                yield ": keep-alive\n\n"
+            # waits on the job's condition variable, keep it off the loop
+            await asyncio.to_thread(job.wait_for_change, sent)
+
+    response = Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    response.timeout = None  # the stream lasts as long as the job, not Quart's RESPONSE_TIMEOUT
+    return response
+
+
+@app.route("/jobs/<job_id>/result", methods=["GET"])
+async def job_result(job_id):
+    job = jobs.get(job_id)
+    error = job_not_ready(job)
+    if error:
+        return error
+    return await send_result(job.result_path)
+
+
+@app.route("/metrics", methods=["GET"])
+async def prometheus_metrics():
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+if __name__ == "__main__":
+    app.run(port=5001, host="0.0.0.0")
@@ -0,0 +1,102 @@
+import io
+import os
+import json
+import zipfile
+from pathlib import Path
+
+
+# What the pipeline can read, anything else in a batch is reported as skipped
+SUPPORTED_EXTENSIONS = (".pdf", ".docx", ".png", ".jpg", ".jpeg")
+
+
+# Size of an upload stream without reading it
+def stream_size(stream):
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
+
+# Turn one file of the batch into process() arguments: small files stay in memory,
+# bigger ones are written into the batch directory
+def _receive_member(name, stream, size, batch_dir, index, spill_threshold):
+    if size <= spill_threshold:
+        return {"data": stream.read(), "filename": name}
+    file_path = os.path.join(batch_dir, f"upload_{index:04d}{Path(name).suffix.lower()}")
+    with open(file_path, "wb") as f:
+        while True:
+            block = stream.read(1024 * 1024)
+            if not block:
+                break
+            f.write(block)
+    return {"file_path": file_path, "filename": name}
+
+
+# Expand the uploaded files of a batch, unpacking any .zip archives along the way.
+# uploads are (filename, stream) pairs. Returns (items, skipped) where items are
+# process() arguments and skipped lists the files we can't handle
+def receive_batch(uploads, batch_dir, spill_threshold, max_files):
+    items = []
+    skipped = []
+
+    def add(name, stream, size):
+        if Path(name).suffix.lower() not in SUPPORTED_EXTENSIONS:
+            skipped.append({"filename": name, "error": "Unsupported file type"})
+        elif len(items) >= max_files:
+            skipped.append({"filename": name, "error": f"Batch is limited to {max_files} files"})
+        else:
+            items.append(
+                _receive_member(name, stream, size, batch_dir, len(items) + 1, spill_threshold)
+            )
+
+    for filename, stream in uploads:
+        filename = os.path.basename(filename)
+        if Path(filename).suffix.lower() != ".zip":
+            add(filename, stream, stream_size(stream))
+            continue
+        try:
+            with zipfile.ZipFile(stream) as archive:
+                for info in archive.infolist():
+                    if info.is_dir() or os.path.basename(info.filename).startswith("."):
+                        continue
+                    with archive.open(info) as member:
+                        add(info.filename, member, info.file_size)
+        except zipfile.BadZipFile:
+            skipped.append({"filename": filename, "error": "Not a valid ZIP archive"})
+
+    return items, skipped
+
+
+# Pack the batch results into a ZIP: one diagram (or JSON/Mermaid file) per successful file plus manifest.json
+# describing every file, including the ones that failed or were skipped
+def build_result_archive(results, skipped=()):
+    manifest = []
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for result in results:
+            entry = {
+                "filename": result["filename"],
+                "status": "failed" if result["error"] else "ok",
+                "seconds": result["seconds"],
+            }
+            if result["error"]:
+                entry["error"] = result["error"]
+            else:
+                suffix = Path(result["output_file"]).suffix
+                diagram = f"{result['index']:04d}_{Path(result['filename']).stem}{suffix}"
+                # PNGs are already compressed, deflating them again only costs time
+                compression = zipfile.ZIP_STORED if suffix == ".png" else zipfile.ZIP_DEFLATED
+                archive.write(result["output_file"], diagram, compress_type=compression)
+                entry["diagram"] = diagram
+            manifest.append(entry)
+
+        for entry in skipped:
+            manifest.append({**entry, "status": "skipped"})
+
+        archive.writestr(
+            "manifest.json",
+            json.dumps({"files": manifest}, indent=2),
+            compress_type=zipfile.ZIP_DEFLATED,
+        )
+    buffer.seek(0)
+    return buffer
@@ -0,0 +1,145 @@
+"""DOCX extraction: python-docx Document() versus streaming word/document.xml
+with iter_docx_blocks. Time and peak RSS are measured in a fresh process per run.
+
+The test file is generated: paragraphs, bulleted lists, tables and an embedded
+media part of --media-mb megabytes, like the scanned attachments real files carry.
+
+    cd backend
+    python benchmarks/docx_extract.py --paragraphs 50000 --media-mb 50
+"""
+import os
+import sys
+import time
+import random
+import zipfile
+import argparse
+import tempfile
+import resource
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Default Extension="png" ContentType="image/png"/>
+<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>
+</Types>"""
+
+RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>
+</Relationships>"""
+
+DOCUMENT_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/image" Target="media/image1.png"/>
+</Relationships>"""
+
+WORDS = "claims intake review approval billing audit export vendor ledger archive".split()
+
+
+def sentence():
+    return " ".join(random.choice(WORDS) for _ in range(random.randint(8, 30))).capitalize() + "."
+
+
+def paragraph(text, bullet=False):
+    properties = '<w:pPr><w:numPr><w:ilvl w:val="0"/><w:numId w:val="1"/></w:numPr></w:pPr>' if bullet else ""
+    return f"<w:p>{properties}<w:r><w:t>{text}</w:t></w:r></w:p>"
+
+
+def table(rows, columns):
+    cells = "".join(
+        "<w:tr>" + "".join(f"<w:tc>{paragraph(sentence())}</w:tc>" for _ in range(columns)) + "</w:tr>"
+        for _ in range(rows)
+    )
+    return f"<w:tbl>{cells}</w:tbl>"
+
+
+def build_docx(path, paragraphs, media_mb):
+    random.seed(0)
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("[Content_Types].xml", CONTENT_TYPES)
+        archive.writestr("_rels/.rels", RELS)
+        archive.writestr("word/_rels/document.xml.rels", DOCUMENT_RELS)
+        with archive.open("word/document.xml", "w") as document:
+            document.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>'
+            )
+            for i in range(paragraphs):
+                if i % 50 == 49:
+                    block = table(5, 4)
+                else:
+                    block = paragraph(sentence(), bullet=i % 10 < 3)
+                document.write(block.encode("utf-8"))
+            document.write(b"</w:body></w:document>")
+        # incompressible, like a real photo
+        archive.writestr("word/media/image1.png", os.urandom(media_mb * 1024 * 1024), zipfile.ZIP_STORED)
+
+
+def extract_python_docx(path):
+    from docx import Document
+
+    doc = Document(path)
+    return "\n\n".join(p.text for p in doc.paragraphs if p.text.strip())
+
+
+def extract_streaming(path):
+    from extraction import iter_docx_blocks
+
+    return "\n\n".join(iter_docx_blocks(path))
+
+
+METHODS = {"python-docx": extract_python_docx, "streaming": extract_streaming}
+
+
+# Child process: run one extraction and print "seconds peak_rss_kb characters"
+def run_child(method, path):
+    start = time.perf_counter()
+    text = METHODS[method](path)
+    seconds = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak_kb //= 1024  # bytes there
+    print(f"{seconds} {peak_kb} {len(text)}")
+
+
+def measure(method, path):
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", method, path],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        print(f"{method:<12} failed: {result.stderr.strip().splitlines()[-1]}")
+        return
+    seconds, peak_kb, characters = result.stdout.split()
+    print(
+        f"{method:<12} {float(seconds) * 1000:9.1f} ms   "
+        f"peak RSS {int(peak_kb) / 1024:8.1f} MB   {int(characters):>10} chars"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--paragraphs", type=int, default=50000)
+    parser.add_argument("--media-mb", type=int, default=50)
+    parser.add_argument("--child", nargs=2, metavar=("METHOD", "PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(*args.child)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "large.docx")
+        build_docx(path, args.paragraphs, args.media_mb)
+        print(f"Test file: {os.path.getsize(path) / 1e6:.1f} MB, {args.paragraphs} blocks")
+        for method in METHODS:
+            measure(method, path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Vision-path image preparation: the old decode -> RGB -> 1024 px thumbnail -> optimized PNG
+versus image_prep.prepare_image (draft-mode JPEG decoding, JPEG/WebP for photos, PNG for
+line art, pass-through for uploads that already fit). Reports time and payload size.
+
+Test images are generated: a 12 MP camera-style JPEG, a 2000x1500 diagram PNG and a small
+JPEG that already fits.
+
+    cd backend
+    python benchmarks/image_encode.py --repeat 5
+"""
+import io
+import os
+import sys
+import time
+import random
+import argparse
+import statistics
+
+from PIL import Image, ImageDraw, ImageFilter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_prep import prepare_image  # noqa: E402
+
+
+def camera_photo(width=4032, height=3024):
+    random.seed(0)
+    image = Image.effect_noise((width // 4, height // 4), 40).convert("RGB")
+    image = image.resize((width, height), Image.BILINEAR)
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x, y = random.randrange(width), random.randrange(height)
+        colour = tuple(random.randrange(256) for _ in range(3))
+        draw.ellipse((x, y, x + random.randrange(100, 800), y + random.randrange(100, 800)), fill=colour)
+    image = image.filter(ImageFilter.GaussianBlur(3))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=92)
+    return buffer.getvalue()
+
+
+def diagram(width=2000, height=1500):
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    for row in range(5):
+        for column in range(6):
+            x, y = 80 + column * 320, 80 + row * 280
+            draw.rectangle((x, y, x + 220, y + 120), outline="black", width=4)
+            draw.text((x + 20, y + 50), f"process_{row}_{column}", fill="black")
+            draw.line((x + 220, y + 60, x + 320, y + 60), fill="blue", width=3)
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def small_photo():
+    image = Image.open(io.BytesIO(camera_photo(1600, 1200)))
+    image.thumbnail((900, 900))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+# What analyze_image_with_gemini used to do for every upload
+def old_prepare(data):
+    with Image.open(io.BytesIO(data)) as img:
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        if img.size[0] > 1024 or img.size[1] > 1024:
+            img.thumbnail((1024, 1024), Image.LANCZOS)
+        buffer = io.BytesIO()
+        img.save(buffer, format="PNG", optimize=True, quality=85)
+        return {"mime_type": "image/png", "data": buffer.getvalue()}
+
+
+def measure(prepare, data, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = prepare(data)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    samples = {
+        "camera photo": camera_photo(),
+        "diagram": diagram(),
+        "small photo": small_photo(),
+    }
+    for name, data in samples.items():
+        print(f"{name} ({len(data) / 1024:.0f} KB upload)")
+        for label, prepare in (("old", old_prepare), ("new", lambda d: prepare_image(d))):
+            ms, result = measure(prepare, data, args.repeat)
+            print(
+                f"  {label}  {ms:8.1f} ms   {len(result['data']) / 1024:8.1f} KB   {result['mime_type']}"
+            )
+
+
+if __name__ == "__main__":
+    main()
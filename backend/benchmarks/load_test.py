@@ -0,0 +1,401 @@
+"""Offline load test: drives /process-document and /process-camera through the Flask app with
+Gemini and the diagram renderer replaced by local stand-ins, so runs cost no quota and are
+repeatable. Reports p50/p95/p99 latency, throughput and a per-stage breakdown (taken from
+the Server-Timing header) per endpoint, and fails when a run regresses past the baseline.
+
+The fake model replays recorded workflow responses (--responses, a JSON list of
+{"nodes", "edges"} objects; a built-in set otherwise) after --model-latency ms, streamed in
+pieces like the real API. The stub renderer writes a placeholder PNG after --render-latency ms.
+The corpus is every PDF, DOCX and image in --corpus, or a generated set of each.
+
+    cd backend
+    python benchmarks/load_test.py --requests 200 --concurrency 16 --save-baseline
+    python benchmarks/load_test.py --requests 200 --concurrency 16   # exits 1 on a regression
+
+Failed requests always exit 1. Without a baseline the latency checks are skipped, unless
+--require-baseline is given (the default when the CI environment variable is set).
+"""
+import io
+import os
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+import itertools
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(BENCHMARK_DIR, "baselines", "load_test.json")
+
+DOCUMENT_EXTENSIONS = (".pdf", ".docx")
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+RECORDED_RESPONSES = [
+    {
+        "nodes": [
+            {"id": "node1", "text": "Customer submits claim form", "type": "core"},
+            {"id": "node2", "text": "Intake team validates documents", "type": "core"},
+            {"id": "node3", "text": "Request missing information", "type": "support"},
+            {"id": "node4", "text": "Adjuster reviews claim", "type": "core"},
+            {"id": "node5", "text": "Fraud screening", "type": "support"},
+            {"id": "node6", "text": "Approve or reject claim", "type": "core"},
+            {"id": "node7", "text": "Billing issues payment", "type": "core"},
+            {"id": "node8", "text": "Archive claim record", "type": "support"},
+        ],
+        "edges": [
+            {"from": "node1", "to": "node2", "label": "submitted"},
+            {"from": "node2", "to": "node3", "label": "incomplete"},
+            {"from": "node3", "to": "node2", "label": "resubmitted"},
+            {"from": "node2", "to": "node4", "label": "complete"},
+            {"from": "node4", "to": "node5", "label": "flagged"},
+            {"from": "node5", "to": "node4", "label": "cleared"},
+            {"from": "node4", "to": "node6", "label": "assessed"},
+            {"from": "node6", "to": "node7", "label": "approved"},
+            {"from": "node7", "to": "node8", "label": "paid"},
+        ],
+    },
+    {
+        "nodes": [
+            {"id": "node1", "text": "Vendor sends invoice", "type": "core"},
+            {"id": "node2", "text": "Match invoice to purchase order", "type": "core"},
+            {"id": "node3", "text": "Manager approval", "type": "core"},
+            {"id": "node4", "text": "Ledger update", "type": "support"},
+            {"id": "node5", "text": "Payment run", "type": "core"},
+        ],
+        "edges": [
+            {"from": "node1", "to": "node2", "label": "received"},
+            {"from": "node2", "to": "node3", "label": "matched"},
+            {"from": "node3", "to": "node4", "label": "approved"},
+            {"from": "node4", "to": "node5", "label": "posted"},
+        ],
+    },
+]
+
+
+# Stands in for genai.GenerativeModel behind the processor's GeminiClient: waits about
+# `latency` seconds, then answers with the next recorded response. Streamed calls get the
+# reply in pieces, the first one after `first_chunk` of the latency
+class FakeModel:
+    def __init__(self, responses, latency, jitter=0.2, first_chunk=0.3, pieces=8):
+        self._responses = itertools.cycle([json.dumps(r) if not isinstance(r, str) else r for r in responses])
+        self._lock = threading.Lock()
+        self.latency = latency
+        self.jitter = jitter
+        self.first_chunk = first_chunk
+        self.pieces = pieces
+        self.calls = 0
+
+    def _next(self):
+        with self._lock:
+            self.calls += 1
+            return next(self._responses)
+
+    def _delay(self):
+        return self.latency * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    async def generate_content_async(self, contents, generation_config=None, stream=False):
+        text = self._next()
+        delay = self._delay()
+        if not stream:
+            await asyncio.sleep(delay)
+            return FakeChunk(text)
+        return self._stream(text, delay)
+
+    async def _stream(self, text, delay):
+        await asyncio.sleep(delay * self.first_chunk)
+        size = math.ceil(len(text) / self.pieces)
+        rest = delay * (1 - self.first_chunk) / self.pieces
+        for start in range(0, len(text), size):
+            yield FakeChunk(text[start : start + size])
+            await asyncio.sleep(rest)
+
+
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+
+def placeholder_png():
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new("RGBA", (64, 64), (0, 0, 0, 0)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+# Replace both renderers with a sleep and a placeholder file, the pipeline around them runs as usual
+def stub_renderers(processor, latency):
+    png = placeholder_png()
+
+    def write(path):
+        time.sleep(latency)
+        with open(path, "wb") as f:
+            f.write(png)
+        return path
+
+    processor.generate_image = lambda mmd_file, png_file=None, fmt="png": write(png_file)
+    processor.generate_native_image = lambda workflow_data, png_file, fmt="png": write(png_file)
+
+
+# A PDF with real text pages, written by hand so no PDF library is needed to make one
+def text_pdf(pages):
+    def escape(line):
+        return line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+    objects = [None, None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    for lines in pages:
+        stream = "BT /F1 11 Tf 72 740 Td 14 TL " + " ".join(f"({escape(line)}) '" for line in lines) + " ET"
+        stream = stream.encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        content_id = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id
+        )
+        page_ids.append(len(objects))
+    objects[0] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    kids = " ".join(f"{i} 0 R" for i in page_ids).encode("ascii")
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(page_ids))
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n%s\nendobj\n" % (number, body))
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+    return out.getvalue()
+
+
+# A small mixed corpus: short and long text PDFs, a DOCX, a camera photo and a diagram
+def generate_corpus(directory):
+    from docx_extract import build_docx, sentence
+    from image_encode import camera_photo, diagram
+
+    random.seed(0)
+    for name, page_count in (("short.pdf", 2), ("long.pdf", 40)):
+        pages = [[f"Page {page}"] + [sentence() for _ in range(35)] for page in range(1, page_count + 1)]
+        with open(os.path.join(directory, name), "wb") as f:
+            f.write(text_pdf(pages))
+    build_docx(os.path.join(directory, "procedure.docx"), 2000, 0)
+    with open(os.path.join(directory, "whiteboard.jpg"), "wb") as f:
+        f.write(camera_photo())
+    with open(os.path.join(directory, "diagram.png"), "wb") as f:
+        f.write(diagram())
+
+
+def load_corpus(directory):
+    corpus = []
+    for name in sorted(os.listdir(directory)):
+        extension = os.path.splitext(name)[1].lower()
+        if extension in DOCUMENT_EXTENSIONS + IMAGE_EXTENSIONS:
+            with open(os.path.join(directory, name), "rb") as f:
+                data = f.read()
+            endpoint = "/process-camera" if extension in IMAGE_EXTENSIONS else "/process-document"
+            corpus.append((endpoint, name, data))
+    return corpus
+
+
+# "extract;dur=12.5;desc="...", model;dur=800.1, total;dur=950.0" -> {stage: milliseconds}
+def parse_server_timing(header):
+    stages = {}
+    for part in (header or "").split(","):
+        fields = part.strip().split(";")
+        for field in fields[1:]:
+            if field.startswith("dur="):
+                stages[fields[0]] = float(field[4:])
+    return stages
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def send(client, endpoint, name, data):
+    started = time.perf_counter()
+    response = client.post(endpoint, data={"file": (io.BytesIO(data), name)}, content_type="multipart/form-data")
+    seconds = time.perf_counter() - started
+    return {
+        "endpoint": endpoint,
+        "ok": response.status_code == 200,
+        "status": response.status_code,
+        "seconds": seconds,
+        "stages": parse_server_timing(response.headers.get("Server-Timing")),
+    }
+
+
+def run_load(app, corpus, requests, concurrency, warmup):
+    local = threading.local()
+
+    def run(item):
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+        return send(local.client, *item)
+
+    schedule = [corpus[i % len(corpus)] for i in range(requests)]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(run, schedule[:warmup]))
+        started = time.perf_counter()
+        results = list(executor.map(run, schedule))
+        elapsed = time.perf_counter() - started
+    return results, elapsed
+
+
+def summarize(results, elapsed):
+    summary = {}
+    for endpoint in sorted({r["endpoint"] for r in results}):
+        rows = [r for r in results if r["endpoint"] == endpoint]
+        latencies = [r["seconds"] * 1000 for r in rows]
+        stages = {}
+        for row in rows:
+            for stage, ms in row["stages"].items():
+                stages.setdefault(stage, []).append(ms)
+        summary[endpoint] = {
+            "requests": len(rows),
+            "errors": sum(1 for r in rows if not r["ok"]),
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "throughput": len(rows) / elapsed,
+            "stages": {
+                stage: {"mean": statistics.mean(values), "p95": percentile(values, 95)}
+                for stage, values in sorted(stages.items())
+            },
+        }
+    return summary
+
+
+def report(summary, elapsed):
+    print(f"\nMeasured {sum(s['requests'] for s in summary.values())} requests in {elapsed:.1f} s")
+    for endpoint, stats in summary.items():
+        print(
+            f"\n{endpoint}: {stats['requests']} requests, {stats['errors']} errors, "
+            f"{stats['throughput']:.2f} req/s"
+        )
+        print(f"  latency  p50 {stats['p50']:8.1f} ms   p95 {stats['p95']:8.1f} ms   p99 {stats['p99']:8.1f} ms")
+        for stage, values in stats["stages"].items():
+            print(f"  {stage:<10} mean {values['mean']:8.1f} ms   p95 {values['p95']:8.1f} ms")
+
+
+# Any failed request is a failure, with or without a baseline
+def request_errors(summary):
+    return [f"{endpoint}: {stats['errors']} failed requests" for endpoint, stats in summary.items() if stats["errors"]]
+
+
+# Latency may grow and throughput shrink by at most `tolerance` (a fraction) of the baseline.
+# Returns the list of regressions
+def compare(summary, baseline, tolerance):
+    regressions = []
+    for endpoint, stats in summary.items():
+        expected = baseline.get(endpoint)
+        if expected is None:
+            continue
+        for key in ("p50", "p95", "p99"):
+            if stats[key] > expected[key] * (1 + tolerance):
+                regressions.append(f"{endpoint} {key} {stats[key]:.1f} ms, baseline {expected[key]:.1f} ms")
+        if stats["throughput"] < expected["throughput"] * (1 - tolerance):
+            regressions.append(
+                f"{endpoint} throughput {stats['throughput']:.2f} req/s, baseline {expected['throughput']:.2f} req/s"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--corpus", help="directory of PDF, DOCX and image files (default: generated)")
+    parser.add_argument("--responses", help="JSON list of recorded workflow responses to replay")
+    parser.add_argument("--model-latency", type=float, default=800, help="ms per model call")
+    parser.add_argument("--render-latency", type=float, default=150, help="ms per rendered diagram")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument(
+        "--require-baseline",
+        action="store_true",
+        default=bool(os.getenv("CI")),
+        help="fail when there is no baseline to compare against (the default when CI is set)",
+    )
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression, 0.2 = 20%%")
+    args = parser.parse_args()
+
+    # Measure the pipeline, not the result cache; no real renderer or API key needed
+    os.environ["CACHE_ENABLED"] = "0"
+    os.environ["MERMAID_RENDERER"] = "cli"
+    os.environ["SERVER_TIMING"] = "1"
+    os.environ.setdefault("GEMINI_API", "offline")
+
+    responses = RECORDED_RESPONSES
+    if args.responses:
+        with open(args.responses, "r", encoding="utf-8") as f:
+            responses = json.load(f)
+
+    from app import app, get_processor
+
+    processor = get_processor()
+    processor.llm.model = FakeModel(responses, args.model_latency / 1000)
+    stub_renderers(processor, args.render_latency / 1000)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus_dir = args.corpus
+        if corpus_dir is None:
+            corpus_dir = tmp
+            generate_corpus(corpus_dir)
+        corpus = load_corpus(corpus_dir)
+        if not corpus:
+            parser.error(f"No PDF, DOCX or image files in {corpus_dir}")
+        print(f"Corpus: {', '.join(name for _, name, _ in corpus)}")
+
+        results, elapsed = run_load(app, corpus, args.requests, args.concurrency, args.warmup)
+
+    summary = summarize(results, elapsed)
+    report(summary, elapsed)
+    print(f"\nModel calls: {processor.llm.model.calls} (including warm-up)")
+
+    errors = request_errors(summary)
+    if errors:
+        print("\nFailed requests:")
+        for error in errors:
+            print(f"  {error}")
+        sys.exit(1)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save-baseline to store one")
+        if args.require_baseline:
+            sys.exit(1)
+        return
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = compare(summary, baseline, args.tolerance)
+    if regressions:
+        print("\nRegressions against the baseline:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    print(f"\nNo regressions against the baseline (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
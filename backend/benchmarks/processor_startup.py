@@ -0,0 +1,69 @@
+"""Per-request overhead: a new SmartDocumentProcessor + asyncio.run() per request
+versus one shared processor running everything on its long-lived loop.
+
+Only the setup around the pipeline is measured, the pipeline itself is replaced
+by an empty coroutine so no API quota is used.
+
+    cd backend
+    python benchmarks/processor_startup.py --requests 50
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from perform import SmartDocumentProcessor  # noqa: E402
+
+
+async def noop_pipeline():
+    await asyncio.sleep(0)
+
+
+# What the handlers used to do: build a processor and a fresh event loop every request
+def per_request(requests):
+    timings = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        SmartDocumentProcessor()
+        asyncio.run(noop_pipeline())
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+# What they do now: one processor, one loop, each request only submits a coroutine
+def shared(requests):
+    processor = SmartDocumentProcessor()
+    processor.run(noop_pipeline())  # start the loop outside the timed section
+    timings = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        processor.run(noop_pipeline())
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def report(name, timings):
+    timings_ms = sorted(t * 1000 for t in timings)
+    p95 = timings_ms[int(len(timings_ms) * 0.95) - 1]
+    print(
+        f"{name:<12} mean {statistics.mean(timings_ms):8.3f} ms   "
+        f"p50 {statistics.median(timings_ms):8.3f} ms   p95 {p95:8.3f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=50)
+    args = parser.parse_args()
+
+    os.environ.setdefault("GEMINI_API", "benchmark-placeholder")
+    report("per-request", per_request(args.requests))
+    report("shared", shared(args.requests))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+"""Bulk processing from the command line, for backfills over directories of documents.
+
+    cd backend
+    python bulk.py ~/archive/policies "scans/**/*.jpg" --output-dir out --formats png,json
+    python bulk.py ~/archive/policies --output-dir out   # after an interruption: resumes
+
+Every PDF, DOCX and image found is analyzed with up to --concurrency files in flight, PDF/DOCX
+extraction in a pool of --extract-workers processes and at most --llm-concurrency Gemini calls
+at once (GEMINI_RPM / GEMINI_TPM still apply). Results are written as <name>.png / .json /
+.mmd / .svg next to each input, or under --output-dir with the same relative layout.
+
+Finished files are appended to a journal (--journal, by default .bulk-journal.jsonl in the
+output directory). A rerun skips every file the journal lists as done, unless it changed since.
+Results from earlier runs are never picked up as inputs, and each file keeps the output name
+it was first given.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+from batch import SUPPORTED_EXTENSIONS
+
+
+# Extensions of the files process() writes, see perform.OUTPUT_FORMATS
+OUTPUT_EXTENSIONS = (".png", ".svg", ".json", ".mmd")
+
+
+def _inside(path, directory):
+    return directory is not None and os.path.commonpath([path, directory]) == directory
+
+
+# Every supported file under the given directories, files and glob patterns, sorted and deduplicated.
+# Our own results are left out: the output directory, the .bulk-* work directories, every
+# output the journal knows about, and <input>.<format> files written for colliding names
+def find_inputs(patterns, output_dir=None, outputs=()):
+    found = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, dirs, files in os.walk(pattern):
+                dirs[:] = [name for name in dirs if not name.startswith(".bulk-")]
+                found.update(os.path.join(root, name) for name in files)
+        elif os.path.isfile(pattern):
+            found.add(pattern)
+        else:
+            found.update(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+
+    found = {
+        os.path.abspath(path)
+        for path in found
+        if os.path.splitext(path)[1].lower() in SUPPORTED_EXTENSIONS
+    }
+
+    def ours(path):
+        stem, extension = os.path.splitext(path)
+        return (
+            path in outputs
+            or _inside(path, output_dir)
+            or any(part.startswith(".bulk-") for part in path.split(os.sep))
+            or (extension in OUTPUT_EXTENSIONS and stem in found)  # report.pdf.png next to report.pdf
+        )
+
+    return sorted(path for path in found if not ours(path))
+
+
+# A file counts as done only while it's unchanged
+def file_signature(path):
+    stat = os.stat(path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+# Append-only record of finished files, one JSON object per line. Each line is flushed as
+# soon as its file is done, so an interrupted run loses at most the files in flight.
+# A "started" line with the output prefix is written before a file is processed, so its
+# results are known (and never mistaken for inputs) even if the run stops half-way
+class Journal:
+    def __init__(self, path):
+        self.path = path
+        self.done = {}  # input path -> signature of the version that was processed
+        self.prefixes = {}  # input path -> where its results are written, minus the extension
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by the interruption
+                    if entry.get("prefix"):
+                        self.prefixes[entry["path"]] = entry["prefix"]
+                    if entry.get("status") == "ok":
+                        self.done[entry["path"]] = entry["signature"]
+                    else:
+                        self.done.pop(entry["path"], None)
+        self._file = open(path, "a", encoding="utf-8")
+
+    def is_done(self, path):
+        return self.done.get(path) == file_signature(path)
+
+    # Every file a run so far has written, or was about to write
+    def outputs(self):
+        return {prefix + extension for prefix in self.prefixes.values() for extension in OUTPUT_EXTENSIONS}
+
+    def record(self, entry):
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+# Where each file's results go: next to it, or mirrored under output_dir relative to base.
+# Files that would collide (report.pdf and report.docx, now or in an earlier run) keep their
+# extension: report.pdf.png, and so does an image that would overwrite itself or another
+# input (scan.png -> scan.png.png). A file the journal already knows keeps the prefix it had
+def output_prefixes(paths, base, output_dir, journal):
+    def prefix(stem):
+        return stem if output_dir is None else os.path.join(output_dir, os.path.relpath(stem, base))
+
+    known = set(paths) | set(journal.prefixes)
+    stems = [os.path.splitext(path)[0] for path in known]
+    used = {value: path for path, value in journal.prefixes.items()}
+    prefixes = {}
+    for path in paths:
+        if path in journal.prefixes:
+            prefixes[path] = journal.prefixes[path]
+            continue
+        stem = os.path.splitext(path)[0]
+        candidate = prefix(stem)
+        if (
+            stems.count(stem) > 1
+            or used.get(candidate, path) != path
+            or any(candidate + extension in known for extension in OUTPUT_EXTENSIONS)
+        ):
+            candidate = prefix(path)
+        prefixes[path] = candidate
+    return prefixes
+
+
+# Run one file through the pipeline once per requested format. The first pass analyzes it,
+# the others are served from the workflow cache and only render
+async def process_file(processor, path, prefix, formats, renderer):
+    from perform import OUTPUT_FORMATS
+
+    destination = os.path.dirname(prefix)
+    os.makedirs(destination, exist_ok=True)
+    # work next to the destination so finished files are moved into place with a rename
+    job_dir = tempfile.mkdtemp(prefix=".bulk-", dir=destination)
+    outputs = []
+    try:
+        for output in formats:
+            result = await processor.process(
+                file_path=path,
+                job_dir=job_dir,
+                renderer=renderer,
+                output=output,
+                extract_in_pool=True,
+            )
+            if not result:
+                raise RuntimeError(f"Failed to generate {output}")
+            target = prefix + os.path.splitext(OUTPUT_FORMATS[output][1])[1]
+            os.replace(result, target)
+            outputs.append(target)
+    finally:
+        shutil.rmtree(job_dir, ignore_errors=True)
+    return outputs
+
+
+async def run_bulk(processor, inputs, base, args, journal):
+    prefixes = output_prefixes(inputs, base, args.output_dir, journal)
+    queue = asyncio.Queue()
+    for path in inputs:
+        queue.put_nowait(path)
+    latencies = []
+    counts = {"ok": 0, "failed": 0}
+    total = len(inputs)
+
+    async def worker():
+        while True:
+            try:
+                path = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            started = time.perf_counter()
+            entry = {"path": path, "signature": file_signature(path), "prefix": prefixes[path]}
+            journal.record({**entry, "status": "started"})
+            try:
+                entry["outputs"] = await process_file(
+                    processor, path, prefixes[path], args.formats, args.renderer
+                )
+                entry["status"] = "ok"
+            except Exception as e:
+                # ModelUnavailableError included: the file stays pending and the next run retries it
+                entry["status"] = "failed"
+                entry["error"] = str(e)
+            entry["seconds"] = round(time.perf_counter() - started, 3)
+            journal.record(entry)
+            counts[entry["status"]] += 1
+            latencies.append(entry["seconds"])
+            print(
+                f"[{counts['ok'] + counts['failed']}/{total}] {entry['status']:<6} "
+                f"{os.path.relpath(path, base)} ({entry['seconds']:.1f}s)"
+                + (f": {entry['error']}" if entry["status"] == "failed" else "")
+            )
+
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    return counts, latencies
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[max(0, -(-len(ordered) * p // 100) - 1)]
+
+
+def report(counts, skipped, latencies, elapsed, llm_stats):
+    processed = counts["ok"] + counts["failed"]
+    print("\n=== Bulk run summary ===")
+    print(f"{counts['ok']} ok, {counts['failed']} failed, {skipped} already done, in {elapsed:.1f} s")
+    if processed:
+        print(f"Throughput: {processed / elapsed * 60:.1f} files/min")
+        print(
+            f"Per file: mean {statistics.mean(latencies):.1f} s   p50 {percentile(latencies, 50):.1f} s   "
+            f"p95 {percentile(latencies, 95):.1f} s   p99 {percentile(latencies, 99):.1f} s"
+        )
+    print(
+        f"Gemini: {llm_stats['calls']} calls, {llm_stats['retries']} retries, "
+        f"{llm_stats['coalesced']} coalesced, {llm_stats['throttled_seconds']:.1f} s throttled"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Turn directories of documents and images into workflow diagrams",
+        epilog="Failed files are retried on the next run.",
+    )
+    parser.add_argument("inputs", nargs="+", help="directories, files or glob patterns (quote ** patterns)")
+    parser.add_argument("--output-dir", help="write results here instead of next to each input")
+    parser.add_argument(
+        "--formats", default="png", help="comma-separated: png, svg, json, mermaid (default: png)"
+    )
+    parser.add_argument("--renderer", choices=("mermaid", "native"), help="default: DIAGRAM_RENDERER")
+    parser.add_argument("--concurrency", type=int, default=16, help="files in flight at once")
+    parser.add_argument("--llm-concurrency", type=int, help="Gemini calls at once (default: LLM_CONCURRENCY)")
+    parser.add_argument("--extract-workers", type=int, help="extraction processes (default: EXTRACT_WORKERS or one per CPU)")
+    parser.add_argument("--journal", help="progress journal (default: .bulk-journal.jsonl in the output directory)")
+    args = parser.parse_args()
+
+    args.formats = [name.strip() for name in args.formats.split(",") if name.strip()]
+    # the pool and the processor read their settings once, set them before either exists
+    if args.extract_workers:
+        os.environ["EXTRACT_WORKERS"] = str(args.extract_workers)
+    if args.llm_concurrency:
+        os.environ["LLM_CONCURRENCY"] = str(args.llm_concurrency)
+
+    from perform import SmartDocumentProcessor, OUTPUT_FORMATS
+
+    unknown = [name for name in args.formats if name not in OUTPUT_FORMATS]
+    if unknown or not args.formats:
+        parser.error(f"Unknown format(s) {', '.join(unknown)}, use: {', '.join(OUTPUT_FORMATS)}")
+
+    if args.output_dir:
+        args.output_dir = os.path.abspath(args.output_dir)
+    # the default journal lives next to the results, so where it is depends on the inputs
+    journal = Journal(args.journal) if args.journal else None
+    inputs = find_inputs(args.inputs, args.output_dir, journal.outputs() if journal else ())
+    if not inputs:
+        parser.error("No PDF, DOCX or image files found")
+    base = os.path.commonpath([os.path.dirname(path) for path in inputs])
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    if journal is None:
+        journal = Journal(os.path.join(args.output_dir or base, ".bulk-journal.jsonl"))
+        inputs = [path for path in inputs if path not in journal.outputs()]
+
+    pending = [path for path in inputs if not journal.is_done(path)]
+    skipped = len(inputs) - len(pending)
+    print(f"Found {len(inputs)} files, {skipped} already done, {len(pending)} to process")
+
+    if len(args.formats) > 1 and os.getenv("CACHE_ENABLED", "1") == "0":
+        print("Note: with CACHE_ENABLED=0 every extra format analyzes the file again")
+
+    processor = SmartDocumentProcessor()
+    processor.warm_up()
+    started = time.perf_counter()
+    try:
+        counts, latencies = processor.run(run_bulk(processor, pending, base, args, journal))
+    except KeyboardInterrupt:
+        print("\nInterrupted, finished files are in the journal. Run the same command again to resume.")
+        sys.exit(130)
+    finally:
+        journal.close()
+    report(counts, skipped, latencies, time.perf_counter() - started, processor.llm.stats)
+    if counts["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+# Hash a file in blocks so big uploads aren't read into memory twice
+def hash_file(file_path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+# Combine the content hash with whatever produced the result (prompt, model, config...)
+def cache_key(content_hash, version):
+    return hashlib.sha256(f"{content_hash}:{version}".encode("utf-8")).hexdigest()
+
+
+# On-disk, content-addressed cache with one directory per tier and a shared size-bounded LRU
+class ResultCache:
+    TIERS = ("text", "workflow", "png")
+
+    def __init__(self, root="cache", max_bytes=512 * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (tier, key) -> size, least recently used first
+        self._total = 0
+        self.hits = {tier: 0 for tier in self.TIERS}
+        self.misses = {tier: 0 for tier in self.TIERS}
+
+        for tier in self.TIERS:
+            os.makedirs(os.path.join(root, tier), exist_ok=True)
+        self._load_index()
+
+    # Rebuild the LRU order from file mtimes, which we bump on every hit
+    def _load_index(self):
+        found = []
+        for tier in self.TIERS:
+            with os.scandir(os.path.join(self.root, tier)) as it:
+                for entry in it:
+                    if entry.is_file() and not entry.name.endswith(".tmp"):
+                        stat = entry.stat()
+                        found.append((stat.st_mtime, tier, entry.name, stat.st_size))
+        for _, tier, key, size in sorted(found):
+            self._entries[(tier, key)] = size
+            self._total += size
+        print(f"Cache loaded: {len(self._entries)} entries, {self._total / 1e6:.1f} MB")
+
+    def _path(self, tier, key):
+        return os.path.join(self.root, tier, key)
+
+    def get(self, tier, key):
+        path = self._path(tier, key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            with self._lock:
+                self.misses[tier] += 1
+                # another process may have evicted it
+                size = self._entries.pop((tier, key), None)
+                if size is not None:
+                    self._total -= size
+            return None
+
+        with self._lock:
+            self.hits[tier] += 1
+            if (tier, key) in self._entries:
+                self._entries.move_to_end((tier, key))
+            else:
+                self._entries[(tier, key)] = len(data)
+                self._total += len(data)
+        return data
+
+    def put(self, tier, key, data):
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(tier, key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)  # readers never see a half-written entry
+
+        with self._lock:
+            old_size = self._entries.pop((tier, key), 0)
+            self._entries[(tier, key)] = len(data)
+            self._total += len(data) - old_size
+            self._evict()
+
+    # Drop least recently used entries until we're back under the size limit
+    def _evict(self):
+        while self._total > self.max_bytes and self._entries:
+            (tier, key), size = self._entries.popitem(last=False)
+            self._total -= size
+            try:
+                os.unlink(self._path(tier, key))
+            except FileNotFoundError:
+                pass
+
+    def get_text(self, key):
+        data = self.get("text", key)
+        return data.decode("utf-8") if data is not None else None
+
+    def put_text(self, key, text):
+        self.put("text", key, text.encode("utf-8"))
+
+    def get_json(self, tier, key):
+        data = self.get(tier, key)
+        return json.loads(data) if data is not None else None
+
+    def put_json(self, tier, key, value):
+        self.put(tier, key, json.dumps(value).encode("utf-8"))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total,
+                "max_bytes": self.max_bytes,
+                "hits": dict(self.hits),
+                "misses": dict(self.misses),
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+# Shared cache for the whole process, None when disabled with CACHE_ENABLED=0
+def get_result_cache():
+    global _cache
+    if os.getenv("CACHE_ENABLED", "1") == "0":
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultCache(
+                root=os.getenv("CACHE_DIR", "cache"),
+                max_bytes=int(os.getenv("CACHE_MAX_MB", "512")) * 1024 * 1024,
+            )
+        return _cache
@@ -0,0 +1,260 @@
+import re
+import zlib
+from difflib import SequenceMatcher
+
+
+# extract_text puts this between PDF pages so we can split on real page boundaries later
+PAGE_BREAK = "\f"
+
+# What actually goes between pages in the extracted text
+PAGE_SEPARATOR = f"\n{PAGE_BREAK}\n"
+
+
+# A section ends a chunk early when its checksum falls under len(section) / gap, i.e. on
+# average once every `gap` characters. The decision only depends on the section itself,
+# so chunk boundaries line up again right after an edited section
+def _is_anchor(section, gap):
+    return zlib.crc32(section.encode("utf-8")) / 2**32 < len(section) / gap
+
+
+# Packs pages into chunks of at most max_chars as they arrive, so analysis of the
+# first chunks can start while later pages are still being extracted. Pages are
+# kept whole when they fit, otherwise cut on paragraphs, and only mid-paragraph
+# as a last resort.
+# anchored: once a chunk is half full, it's closed at content-defined anchors (see
+# _is_anchor) instead of being filled up. Chunks come out a bit smaller, but editing one
+# part of a document leaves every other chunk byte-for-byte the same, so their cached
+# analyses can be reused
+class ChunkPacker:
+    def __init__(self, max_chars=30000, anchored=False):
+        self.max_chars = max_chars
+        self.anchored = anchored
+        self._current = []
+        self._current_len = 0
+
+    def _sections(self, page):
+        if len(page) <= self.max_chars:
+            if page.strip():
+                yield page.strip()
+            return
+        for paragraph in page.split("\n\n"):
+            paragraph = paragraph.strip()
+            if not paragraph:
+                continue
+            while len(paragraph) > self.max_chars:
+                cut = paragraph.rfind(" ", 0, self.max_chars)
+                cut = cut if cut > 0 else self.max_chars
+                yield paragraph[:cut]
+                paragraph = paragraph[cut:].strip()
+            yield paragraph
+
+    # Add one page, returns any chunks that are now full
+    def add(self, page):
+        full = []
+        for section in self._sections(page):
+            if self._current and self._current_len + len(section) + 2 > self.max_chars:
+                full.append("\n\n".join(self._current))
+                self._current = []
+                self._current_len = 0
+            self._current.append(section)
+            self._current_len += len(section) + 2
+            if (
+                self.anchored
+                and self._current_len >= self.max_chars // 2
+                and _is_anchor(section, self.max_chars // 4)
+            ):
+                full.append("\n\n".join(self._current))
+                self._current = []
+                self._current_len = 0
+        return full
+
+    # Whatever is left once the last page has been added
+    def flush(self):
+        rest = ["\n\n".join(self._current)] if self._current else []
+        self._current = []
+        self._current_len = 0
+        return rest
+
+
+# Split already-extracted document text into chunks, cutting on page boundaries first
+def split_into_chunks(text, max_chars=30000, anchored=False):
+    packer = ChunkPacker(max_chars, anchored)
+    chunks = []
+    for page in text.split(PAGE_BREAK):
+        chunks.extend(packer.add(page))
+    return chunks + packer.flush()
+
+
+# Words Mermaid reads as flowchart syntax, a node with one of them as its ID breaks the diagram
+MERMAID_RESERVED_IDS = frozenset((
+    "end", "graph", "flowchart", "subgraph", "direction", "style", "class", "classdef",
+    "linkstyle", "click", "call", "href", "default", "interpolate",
+))
+
+
+# lowercase_with_underscores, the same shape generate_mermaid turns IDs into. Reserved words get
+# a node_ prefix: a model node called "End" becomes node_end
+def normalize_id(value):
+    node_id = re.sub(r"[^a-z0-9]+", "_", str(value).lower()).strip("_") or "node"
+    return f"node_{node_id}" if node_id in MERMAID_RESERVED_IDS else node_id
+
+
+# SequenceMatcher ratio of a and b, or 0 when it can't reach `floor`
+def _ratio(a, b, floor):
+    matcher = SequenceMatcher(None, a, b)
+    # quick_ratio is an upper bound, skip the full comparison when it can't reach the floor
+    if matcher.quick_ratio() < floor:
+        return 0
+    return matcher.ratio()
+
+
+# Share of distinct words two descriptions have in common
+def _word_overlap(a, b):
+    a, b = set(re.findall(r"[a-z0-9]+", a.lower())), set(re.findall(r"[a-z0-9]+", b.lower()))
+    return len(a & b) / len(a | b) if a | b else 1.0
+
+
+# How sure we are that two nodes (from different parts or versions of a document) are the
+# same process, 0 when they aren't. An ID alone proves nothing: models number their nodes
+# (process_1, process_2, node1...) and those IDs are near-identical for distinct processes.
+# So a same or similar ID also needs the descriptions to share most of their words, and
+# without one the descriptions have to be near-identical on their own
+def _match_score(a, b, id_similarity, text_similarity, id_text_similarity):
+    same_id = a["id"] == b["id"]
+    similar_id = same_id or _ratio(a["id"], b["id"], id_similarity) >= id_similarity
+    overlap = _word_overlap(a["text"], b["text"])
+    if similar_id and overlap >= id_text_similarity:
+        return overlap + (0.1 if same_id else 0.05)
+    text = _ratio(a["text"].lower(), b["text"].lower(), text_similarity)
+    if text >= text_similarity:
+        return max(text, overlap)
+    return 0
+
+
+# A node ID not in `used` yet: the ID itself, or with _2, _3... appended
+def _unique_id(node_id, used):
+    unique, suffix = node_id, 2
+    while unique in used:
+        unique, suffix = f"{node_id}_{suffix}", suffix + 1
+    used.add(unique)
+    return unique
+
+
+# Merge the partial graphs from each chunk into one workflow. A node is merged with the best
+# matching node from an earlier chunk (see _match_score). Nodes of the same chunk are never
+# merged with each other unless they have the same ID. Edges are re-pointed at the merged
+# nodes and duplicates dropped.
+def merge_workflows(partials, id_similarity=0.85, text_similarity=0.9, id_text_similarity=0.5):
+    merged_nodes = []
+    sources = {}  # merged node ID -> the partials it has a node from
+    merged_edges = []
+    seen_edges = set()
+    used_ids = set()
+
+    for index, partial in enumerate(partials):
+        local_ids = {}  # this chunk's node IDs -> merged node IDs
+        by_key = {}  # this chunk's normalized IDs -> merged node
+
+        for node in partial.get("nodes", []):
+            if node.get("type") == "error":
+                continue
+            key = normalize_id(node.get("id", ""))
+            text = node.get("text", "")
+            candidate = {"id": key, "text": text}
+
+            match = by_key.get(key)
+            if match is None:
+                best = 0
+                for existing in merged_nodes:
+                    if index in sources[existing["id"]]:
+                        continue
+                    score = _match_score(existing, candidate, id_similarity, text_similarity, id_text_similarity)
+                    if score > best:
+                        match, best = existing, score
+
+            if match is None:
+                match = {"id": _unique_id(key, used_ids), "text": text, "type": node.get("type", "core")}
+                merged_nodes.append(match)
+                sources[match["id"]] = {index}
+            else:
+                # keep the most detailed description, and core beats support
+                if len(text) > len(match["text"]):
+                    match["text"] = text
+                if node.get("type") == "core":
+                    match["type"] = "core"
+                sources[match["id"]].add(index)
+
+            by_key[key] = match
+            local_ids[node.get("id")] = match["id"]
+            local_ids[key] = match["id"]
+
+        for edge in partial.get("edges", []):
+            source = local_ids.get(edge.get("from"), local_ids.get(normalize_id(edge.get("from", ""))))
+            target = local_ids.get(edge.get("to"), local_ids.get(normalize_id(edge.get("to", ""))))
+            if source is None or target is None or source == target:
+                continue
+            if (source, target) in seen_edges:
+                continue
+            seen_edges.add((source, target))
+            merged_edges.append(
+                {"from": source, "to": target, "label": edge.get("label", "flow")}
+            )
+
+    return {"nodes": merged_nodes, "edges": merged_edges}
+
+
+# Carry node IDs and ordering over from the previous version of a document: every node
+# that matches one from `previous` (same test as merge_workflows, best matches first, each
+# previous node used once) takes its ID and place, nodes new in this version come after
+# them. Declaration order drives the diagram layout, so an edit only adds to the diagram
+# instead of reshuffling it
+def stabilize_ids(workflow, previous, id_similarity=0.85, text_similarity=0.9, id_text_similarity=0.5):
+    previous_nodes = [node for node in previous.get("nodes", []) if node.get("type") != "error"]
+    position = {node["id"]: i for i, node in enumerate(previous_nodes)}
+    nodes = workflow.get("nodes", [])
+
+    pairs = []
+    for i, node in enumerate(nodes):
+        for old in previous_nodes:
+            score = _match_score(old, node, id_similarity, text_similarity, id_text_similarity)
+            if score:
+                pairs.append((score, i, old["id"]))
+    pairs.sort(key=lambda pair: -pair[0])
+    matched = {}  # index in nodes -> previous ID
+    taken = set()
+    for score, i, old_id in pairs:
+        if i not in matched and old_id not in taken:
+            matched[i] = old_id
+            taken.add(old_id)
+
+    renamed = {}
+    kept, added = [], []
+    for i, node in enumerate(nodes):
+        if i in matched:
+            renamed[node["id"]] = matched[i]
+            kept.append({**node, "id": matched[i]})
+        else:
+            added.append(node)
+    kept.sort(key=lambda node: position[node["id"]])
+
+    # a new node may carry an ID that now belongs to a matched one
+    used = {node["id"] for node in kept}
+    for i, node in enumerate(added):
+        node_id = _unique_id(node["id"], used)
+        renamed[node["id"]] = node_id
+        added[i] = {**node, "id": node_id}
+
+    previous_edges = {
+        (edge.get("from"), edge.get("to")): i for i, edge in enumerate(previous.get("edges", []))
+    }
+    edges = []
+    seen = set()
+    for edge in workflow.get("edges", []):
+        source, target = renamed.get(edge["from"], edge["from"]), renamed.get(edge["to"], edge["to"])
+        if source == target or (source, target) in seen:
+            continue
+        seen.add((source, target))
+        edges.append({**edge, "from": source, "to": target})
+    edges.sort(key=lambda edge: previous_edges.get((edge["from"], edge["to"]), len(previous_edges)))
+
+    return {"nodes": kept + added, "edges": edges}
@@ -0,0 +1,127 @@
+import re
+import math
+from collections import Counter
+
+from chunking import PAGE_SEPARATOR
+
+
+# Bump when the cleaning rules change, it's part of the cached analysis key
+COMPACTION_VERSION = "1"
+
+# Lines this close to the top or bottom of a page are candidates for running headers/footers
+EDGE_LINES = 2
+# A line seen at the edge of this many earlier pages is boilerplate from then on
+REPEAT_THRESHOLD = 2
+
+PAGE_NUMBER = re.compile(
+    r"^(?:page\s*)?[-–—\s]*\d{1,4}[-–—\s]*(?:(?:of|/)\s*\d{1,4})?$", re.IGNORECASE
+)
+HYPHENATED_BREAK = re.compile(r"(\w)-\n(\w)")
+SPACES = re.compile(r"[ \t ]+")
+BLANK_LINES = re.compile(r"\n{3,}")
+WORD = re.compile(r"[a-z][a-z0-9_]{2,}")
+
+
+# About four characters per token for English text, close enough for budgeting
+def estimate_tokens(text):
+    return len(text) // 4 + 1 if text else 0
+
+
+# Headers and footers differ in their page number at most, so compare lines with digits masked
+def _line_key(line):
+    return re.sub(r"\d+", "#", line.strip().lower())
+
+
+def normalize_whitespace(text):
+    text = HYPHENATED_BREAK.sub(r"\1\2", text)  # "inter-\nnational" -> "international"
+    lines = [SPACES.sub(" ", line).strip() for line in text.split("\n")]
+    return BLANK_LINES.sub("\n\n", "\n".join(lines)).strip()
+
+
+# Cleans pages one at a time as they're extracted: page numbers and any line that keeps
+# showing up at the top or bottom of earlier pages are dropped, whitespace is normalized.
+# Works in a single pass so it fits the streaming extraction path
+class PageCompactor:
+    def __init__(self):
+        self.edge_counts = Counter()
+        self.tokens_before = 0
+        self.tokens_after = 0
+
+    def add(self, page):
+        self.tokens_before += estimate_tokens(page)
+        lines = page.split("\n")
+        content = [i for i, line in enumerate(lines) if line.strip()]
+        edges = set(content[:EDGE_LINES] + content[-EDGE_LINES:])
+
+        kept = []
+        for i, line in enumerate(lines):
+            if i in edges:
+                key = _line_key(line)
+                if PAGE_NUMBER.match(line.strip()) or self.edge_counts[key] >= REPEAT_THRESHOLD:
+                    continue
+            kept.append(line)
+        for i in edges:
+            self.edge_counts[_line_key(lines[i])] += 1
+
+        cleaned = normalize_whitespace("\n".join(kept))
+        self.tokens_after += estimate_tokens(cleaned)
+        return cleaned
+
+
+# Drop the least informative paragraphs until the pages fit `budget` tokens. Paragraphs are
+# scored by how many distinctive words (rare across the document) they carry per token,
+# so repeated disclaimers and filler go first; what remains keeps its original order.
+# Returns (pages, number of paragraphs dropped)
+def fit_to_budget(pages, budget):
+    sections = [
+        (page_index, section)
+        for page_index, page in enumerate(pages)
+        for section in page.split("\n\n")
+        if section.strip()
+    ]
+    remaining = sum(estimate_tokens(section) for _, section in sections)
+    if not budget or remaining <= budget:
+        return pages, 0
+
+    words = [set(WORD.findall(section.lower())) for _, section in sections]
+    document_frequency = Counter(word for section_words in words for word in section_words)
+    total = len(sections)
+
+    seen = set()
+    scores = []
+    for i, (_, section) in enumerate(sections):
+        key = section.strip().lower()
+        if key in seen:
+            scores.append(-1.0)  # an exact repeat, nothing new in it
+            continue
+        seen.add(key)
+        information = sum(math.log(total / document_frequency[word]) + 1 for word in words[i])
+        scores.append(information / estimate_tokens(section))
+
+    dropped = set()
+    for i in sorted(range(total), key=lambda i: scores[i]):
+        if remaining <= budget:
+            break
+        dropped.add(i)
+        remaining -= estimate_tokens(sections[i][1])
+
+    kept = [[] for _ in pages]
+    for i, (page_index, section) in enumerate(sections):
+        if i not in dropped:
+            kept[page_index].append(section)
+    return ["\n\n".join(page) for page in kept], len(dropped)
+
+
+# Clean every page and fit the whole document into the budget (0 = no budget).
+# Pages stay separated by PAGE_SEPARATOR so chunking still splits on page boundaries.
+# Returns (text, stats) with the token counts before and after
+def compact_pages(pages, budget=0):
+    compactor = PageCompactor()
+    cleaned = [compactor.add(page) for page in pages]
+    cleaned, dropped = fit_to_budget(cleaned, budget)
+    text = PAGE_SEPARATOR.join(cleaned)
+    return text, {
+        "tokens_before": compactor.tokens_before,
+        "tokens_after": estimate_tokens(text),
+        "sections_dropped": dropped,
+    }
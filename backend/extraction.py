@@ -0,0 +1,293 @@
+import io
+import os
+import re
+import atexit
+import zipfile
+import tempfile
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from xml.etree import ElementTree
+
+import PyPDF2
+from PIL import Image
+
+from chunking import PAGE_SEPARATOR
+from image_prep import LINE_ART_MAX_SIDE, encode_image
+
+# Optional: renders scanned pages properly. Without it we fall back to the image embedded in the page
+try:
+    import pypdfium2
+except ImportError:
+    pypdfium2 = None
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def extraction_workers():
+    return int(os.getenv("EXTRACT_WORKERS", str(os.cpu_count() or 2)))
+
+
+# Workers must not be forked from the server: fork copies its threads' locks (event loop, render
+# workers, request threads) in whatever state they're in. forkserver starts them from a clean
+# process that preloads only this module (PyPDF2, PIL), never the server's __main__; spawn where
+# it's unavailable (Windows). Workers still import the main module as __mp_main__, so a server
+# script must not set anything up at import (see app.get_processor)
+def pool_context():
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["extraction"])
+        return context
+    return multiprocessing.get_context("spawn")
+
+
+# Process pool shared by every request for CPU-bound extraction work
+def get_extraction_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=extraction_workers(), mp_context=pool_context())
+            atexit.register(_pool.shutdown, wait=False, cancel_futures=True)
+        return _pool
+
+
+# A source is either a path on disk or the uploaded bytes themselves (small uploads stay in memory)
+def is_in_memory(source):
+    return isinstance(source, (bytes, bytearray, memoryview))
+
+
+# Something the PDF/DOCX/PIL readers can open: the path itself, or a buffer over the bytes
+def open_source(source):
+    return io.BytesIO(source) if is_in_memory(source) else source
+
+
+# Runs inside a pool worker: each worker opens the PDF itself and only parses its own pages
+def extract_pdf_page_range(file_path, start, stop):
+    with open(file_path, "rb") as f:
+        pdf = PyPDF2.PdfReader(f)
+        return [pdf.pages[i].extract_text() or "" for i in range(start, stop)]
+
+
+W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+# Text boxes are stored twice, as DrawingML and as a legacy VML fallback, only read the first
+MC_FALLBACK = "{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback"
+HEADING_STYLE = re.compile(r"^(?:heading\s*(\d)|title)$", re.IGNORECASE)
+
+
+# Text of one paragraph: its runs, tabs and line breaks, skipping duplicate fallback content
+def _paragraph_text(element, parts):
+    for child in element:
+        tag = child.tag
+        if tag == MC_FALLBACK:
+            continue
+        if tag == W + "t":
+            parts.append(child.text or "")
+        elif tag == W + "tab":
+            parts.append("\t")
+        elif tag in (W + "br", W + "cr"):
+            parts.append("\n")
+        else:
+            _paragraph_text(child, parts)
+    return parts
+
+
+# Headings get a markdown-style marker and list items a bullet, so the structure survives as text
+def _format_paragraph(element):
+    text = "".join(_paragraph_text(element, [])).strip()
+    properties = element.find(W + "pPr")
+    if not text or properties is None:
+        return text
+
+    style = properties.find(W + "pStyle")
+    if style is not None:
+        match = HEADING_STYLE.match(style.get(W + "val", ""))
+        if match:
+            return "#" * int(match.group(1) or 1) + " " + text
+
+    numbering = properties.find(W + "numPr")
+    if numbering is not None:
+        level = numbering.find(W + "ilvl")
+        depth = int(level.get(W + "val", "0")) if level is not None else 0
+        return "  " * depth + "- " + text
+    return text
+
+
+# Stream the body of a DOCX in document order: paragraphs, list items and tables (one block
+# per table, a line per row with cells separated by " | "). word/document.xml is read
+# straight out of the zip with an incremental parser and every finished element is dropped,
+# so memory stays flat; images and other media parts are never opened
+def iter_docx_blocks(source):
+    with zipfile.ZipFile(open_source(source)) as archive:
+        with archive.open("word/document.xml") as document:
+            body = None
+            paragraph_depth = 0  # text boxes put paragraphs inside paragraphs
+            cells = []  # text of each open table cell (tables can be nested)
+            rows = []  # cells of each open table row
+            tables = []  # finished rows of each open table
+
+            for event, element in ElementTree.iterparse(document, events=("start", "end")):
+                tag = element.tag
+                if event == "start":
+                    if tag == W + "body":
+                        body = element
+                    elif tag == W + "p":
+                        paragraph_depth += 1
+                    elif paragraph_depth == 0:
+                        if tag == W + "tbl":
+                            tables.append([])
+                        elif tag == W + "tr":
+                            rows.append([])
+                        elif tag == W + "tc":
+                            cells.append([])
+                    continue
+
+                if tag == W + "p":
+                    paragraph_depth -= 1
+                    if paragraph_depth > 0:
+                        continue  # part of the enclosing paragraph's text
+                    text = _format_paragraph(element)
+                    if cells:
+                        if text:
+                            cells[-1].append(text)
+                    elif text:
+                        yield text
+                elif paragraph_depth > 0:
+                    continue
+                elif tag == W + "tc":
+                    rows[-1].append(" ".join(cells.pop()))
+                    continue
+                elif tag == W + "tr":
+                    row = rows.pop()
+                    if any(row):
+                        tables[-1].append(" | ".join(row))
+                    continue
+                elif tag == W + "tbl":
+                    table = "\n".join(tables.pop())
+                    if cells:
+                        if table:
+                            cells[-1].append(table)  # nested table, part of its cell
+                        continue
+                    if table:
+                        yield table
+                else:
+                    continue
+
+                # a top-level paragraph or table is done, drop it from the tree
+                element.clear()
+                if body is not None and not cells:
+                    body.clear()
+
+
+# Runs inside a pool worker: the whole text of one document. Used for batches, where the
+# parallelism comes from many files at once rather than from splitting one file up
+def extract_document(source, extension):
+    if extension == ".docx":
+        return "\n\n".join(iter_docx_blocks(source))
+    if extension == ".pdf":
+        pdf = PyPDF2.PdfReader(open_source(source))
+        return PAGE_SEPARATOR.join(page.extract_text() or "" for page in pdf.pages)
+    raise ValueError(f"Unsupported file format: {extension}")
+
+
+# Runs inside a pool worker: the given pages (0-based) as images ready for the vision model
+# ({"mime_type", "data"}, prepared like uploaded images), for pages that had no extractable
+# text. Pages that can't be rasterized are left out
+def rasterize_pdf_pages(source, page_indices):
+    images = []
+    if pypdfium2 is not None:
+        pdf = pypdfium2.PdfDocument(bytes(source) if is_in_memory(source) else source)
+        try:
+            for index in page_indices:
+                page = pdf[index]
+                width, height = page.get_size()
+                # render close to the target size instead of rendering big and shrinking
+                bitmap = page.render(scale=min(LINE_ART_MAX_SIDE / max(width, height, 1), 4))
+                images.append(encode_image(bitmap.to_pil()))
+                page.close()
+        finally:
+            pdf.close()
+        return images
+
+    # A scanned page is usually one embedded image of the whole page, take the biggest
+    pdf = PyPDF2.PdfReader(open_source(source))
+    for index in page_indices:
+        try:
+            page_images = list(pdf.pages[index].images)
+        except Exception as e:
+            print(f"Could not read images of page {index + 1}: {e}")
+            continue
+        if page_images:
+            largest = max(page_images, key=lambda image: len(image.data))
+            with Image.open(io.BytesIO(largest.data)) as image:
+                if image.format == "JPEG":
+                    image.draft("RGB", (LINE_ART_MAX_SIDE, LINE_ART_MAX_SIDE))
+                images.append(encode_image(image))
+    return images
+
+
+def count_pdf_pages(file_path):
+    with open(file_path, "rb") as f:
+        return len(PyPDF2.PdfReader(f).pages)
+
+
+# Yield the text of every page in order while later page ranges are still being extracted.
+# At most `window` ranges are in flight, so memory stays bounded however long the PDF is.
+def iter_pdf_pages(source, pages_per_task=8, window=None):
+    if is_in_memory(source):
+        pdf = PyPDF2.PdfReader(open_source(source))
+        total = len(pdf.pages)
+        # Small PDFs aren't worth the round trip to another process
+        if total <= pages_per_task:
+            for page in pdf.pages:
+                yield page.extract_text() or ""
+            return
+        # The workers open the file themselves: write the upload out once rather than
+        # copying its bytes into every task
+        fd, file_path = tempfile.mkstemp(suffix=".pdf")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(source)
+            yield from _iter_pages_in_pool(file_path, total, pages_per_task, window)
+        finally:
+            os.unlink(file_path)
+        return
+
+    file_path = source
+    total = count_pdf_pages(file_path)
+
+    # Small PDFs aren't worth the round trip to another process
+    if total <= pages_per_task:
+        yield from extract_pdf_page_range(file_path, 0, total)
+        return
+    yield from _iter_pages_in_pool(file_path, total, pages_per_task, window)
+
+
+def _iter_pages_in_pool(file_path, total, pages_per_task, window):
+    pool = get_extraction_pool()
+    window = window or extraction_workers() * 2
+    ranges = iter(
+        (start, min(start + pages_per_task, total))
+        for start in range(0, total, pages_per_task)
+    )
+    in_flight = deque()
+
+    def submit_next():
+        page_range = next(ranges, None)
+        if page_range is not None:
+            in_flight.append(pool.submit(extract_pdf_page_range, file_path, *page_range))
+
+    for _ in range(window):
+        submit_next()
+
+    try:
+        while in_flight:
+            pages = in_flight.popleft().result()
+            submit_next()
+            yield from pages
+    finally:
+        # the consumer stopped early (error or cancellation), don't leave work queued
+        for future in in_flight:
+            future.cancel()
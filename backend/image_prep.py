@@ -0,0 +1,128 @@
+import io
+import os
+
+from PIL import Image, ImageOps
+
+
+# Bump when the preparation rules change, it's part of the cached image analysis key
+IMAGE_PREP_VERSION = "2"
+
+# Longest side we send. Photos only need enough detail to see shapes and arrows, line art
+# (scans, screenshots, diagrams) keeps more so small text stays readable. Both stay well
+# inside what the model accepts
+PHOTO_MAX_SIDE = int(os.getenv("IMAGE_PHOTO_MAX_SIDE", "1024"))
+LINE_ART_MAX_SIDE = int(os.getenv("IMAGE_LINE_ART_MAX_SIDE", "1536"))
+
+# "jpeg" or "webp" for photos, line art is always PNG
+PHOTO_FORMAT = os.getenv("IMAGE_PHOTO_FORMAT", "jpeg")
+PHOTO_QUALITY = int(os.getenv("IMAGE_PHOTO_QUALITY", "85"))
+
+# Uploads already this small, in a format the model reads and within the size limits are sent as-is
+PASSTHROUGH_BYTES = int(os.getenv("IMAGE_PASSTHROUGH_BYTES", str(1024 * 1024)))
+
+MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+# Line art has a handful of colours (ink, paper, a few highlights), photos have thousands
+LINE_ART_MAX_COLORS = 256
+
+
+# Classify on a small copy with each channel cut to 5 bits, so sensor noise and
+# antialiasing don't make a diagram look like a photo
+def is_line_art(image):
+    sample = image.convert("RGB")
+    sample.thumbnail((128, 128))
+    sample = sample.point(lambda value: value & 0xF8)
+    return sample.getcolors(maxcolors=LINE_ART_MAX_COLORS) is not None
+
+
+def _needs_rotation(image):
+    try:
+        return image.getexif().get(0x0112, 1) != 1  # EXIF orientation
+    except Exception:
+        return False
+
+
+# Encode an already-loaded image for the model: resized to the target for its kind of
+# content, photos as JPEG/WebP, line art as PNG. Returns {"mime_type", "data"}
+def encode_image(image, line_art=None):
+    if line_art is None:
+        line_art = is_line_art(image)
+    max_side = LINE_ART_MAX_SIDE if line_art else PHOTO_MAX_SIDE
+    if max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    buffer = io.BytesIO()
+    if line_art:
+        if image.mode not in ("1", "L", "P", "RGB", "RGBA"):
+            image = image.convert("RGB")
+        # zlib level 6 without optimize: optimize retries every filter and is several times slower
+        image.save(buffer, format="PNG", compress_level=6)
+        mime_type = "image/png"
+    else:
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        if PHOTO_FORMAT == "webp":
+            image.save(buffer, format="WEBP", quality=PHOTO_QUALITY, method=4)
+            mime_type = "image/webp"
+        else:
+            image.save(buffer, format="JPEG", quality=PHOTO_QUALITY)
+            mime_type = "image/jpeg"
+    return {"mime_type": mime_type, "data": buffer.getvalue()}
+
+
+# The upload's own bytes, for when they can go to the model unchanged
+def _original(source, in_memory, image_format):
+    if in_memory:
+        return {"mime_type": MIME_TYPES[image_format], "data": bytes(source)}
+    with open(source, "rb") as f:
+        return {"mime_type": MIME_TYPES[image_format], "data": f.read()}
+
+
+# Prepare an upload (path or bytes) for the vision model with as little work as possible.
+# Compliant uploads are passed through untouched, JPEGs are decoded straight at reduced
+# size with draft mode, and the output format follows the content. An upload that would
+# only grow by re-encoding (a small PNG diagram turned into a bigger one) is sent as it is
+def prepare_image(source):
+    in_memory = isinstance(source, (bytes, bytearray, memoryview))
+    byte_size = len(source) if in_memory else os.path.getsize(source)
+
+    with Image.open(io.BytesIO(source) if in_memory else source) as image:
+        image_format = image.format
+        width, height = image.size
+        rotate = _needs_rotation(image)
+        # a format and mode the model reads, already the right way up
+        sendable = image_format in MIME_TYPES and image.mode in ("L", "RGB", "P") and not rotate
+
+        # Within the limits for any kind of content: no need to decode it at all
+        if sendable and max(width, height) <= PHOTO_MAX_SIDE and byte_size <= PASSTHROUGH_BYTES:
+            print(f"Image already fits ({width}x{height} {image_format}, {byte_size} bytes), sending as-is")
+            return _original(source, in_memory, image_format)
+
+        # Let the JPEG decoder scale down by 1/2, 1/4 or 1/8 while decoding, far cheaper than
+        # decoding a 12 MP photo at full size and resizing it afterwards
+        if image_format == "JPEG":
+            image.draft("RGB", (LINE_ART_MAX_SIDE, LINE_ART_MAX_SIDE))
+        image.load()
+        if rotate:
+            image = ImageOps.exif_transpose(image)
+
+        # Line art may keep up to LINE_ART_MAX_SIDE, so it fits at sizes a photo doesn't
+        line_art = is_line_art(image)
+        max_side = LINE_ART_MAX_SIDE if line_art else PHOTO_MAX_SIDE
+        if sendable and max(width, height) <= max_side and byte_size <= PASSTHROUGH_BYTES:
+            print(f"Image already fits ({width}x{height} {image_format}, {byte_size} bytes), sending as-is")
+            return _original(source, in_memory, image_format)
+
+        prepared = encode_image(image, line_art)
+        if sendable and len(prepared["data"]) >= byte_size:
+            print(
+                f"Re-encoding {width}x{height} {image_format} wouldn't shrink it "
+                f"({byte_size} -> {len(prepared['data'])} bytes), sending as-is"
+            )
+            return _original(source, in_memory, image_format)
+
+        print(
+            f"Prepared image: {width}x{height} {image_format} ({byte_size} bytes) -> "
+            f"{prepared['mime_type']} ({len(prepared['data'])} bytes)"
+        )
+        return prepared
@@ -0,0 +1,127 @@
+import os
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Stages a job moves through, in order
+STAGES = ("queued", "extracting", "analyzing", "rendering", "done", "failed")
+FINISHED = ("done", "failed")
+
+
+class QueueFullError(Exception):
+    """Too many jobs waiting, the caller should retry later"""
+
+
+# One submitted upload and everything we know about its progress
+class Job:
+    def __init__(self, job_id, job_dir, process_args):
+        self.id = job_id
+        self.job_dir = job_dir
+        self.process_args = process_args  # keyword args for process(): the upload plus per-request options
+        self.stage = "queued"
+        self.error = None
+        self.result_path = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.events = []  # (event, data) in the order they happened, replayed by the event stream
+        self.version = 0  # bumped on every change so listeners know something happened
+        self._changed = threading.Condition()
+
+    def set_stage(self, stage, error=None, result_path=None):
+        with self._changed:
+            self.stage = stage
+            self.error = error
+            if result_path is not None:
+                self.result_path = result_path
+            self.updated_at = time.time()
+            self.events.append(("stage", self.to_dict()))
+            self.version += 1
+            self._changed.notify_all()
+
+    # A node or edge the model has finished writing, sent to listeners before the diagram is ready
+    def add_partial(self, kind, item):
+        with self._changed:
+            self.events.append((kind, item))
+            self.version += 1
+            self._changed.notify_all()
+
+    # Block until the job changes after `version` (or the timeout passes), used by the event stream
+    def wait_for_change(self, version, timeout=15):
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version, timeout=timeout)
+            return self.version
+
+    @property
+    def finished(self):
+        return self.stage in FINISHED
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "stage": self.stage,
+            "error": self.error,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+
+# Runs jobs on a bounded pool of background threads and refuses new work past max_pending
+class JobManager:
+    def __init__(self, run_job, on_expire=None, max_workers=4, max_pending=32, ttl=3600):
+        self.run_job = run_job  # run_job(job) does the work and returns the result path
+        self.on_expire = on_expire  # on_expire(job) cleans up a job's files once it's forgotten
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="job"
+        )
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, job_dir, process_args, job_id=None):
+        self._expire_old_jobs()
+        with self._lock:
+            pending = sum(1 for job in self._jobs.values() if not job.finished)
+            if pending >= self.max_pending:
+                raise QueueFullError(f"{pending} jobs already waiting")
+            job = Job(job_id or uuid.uuid4().hex, job_dir, process_args)
+            self._jobs[job.id] = job
+
+        self._executor.submit(self._run, job)
+        return job
+
+    def _run(self, job):
+        try:
+            result_path = self.run_job(job)
+            if result_path and os.path.exists(result_path):
+                job.set_stage("done", result_path=result_path)
+            else:
+                job.set_stage("failed", error="Failed to generate diagram")
+        except Exception as e:
+            print(f"Job {job.id} failed: {e}")
+            job.set_stage("failed", error=str(e))
+        finally:
+            job.process_args = None  # don't hold on to in-memory uploads once they're processed
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    # Forget finished jobs after the TTL and delete their workspaces
+    def _expire_old_jobs(self):
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            expired = [
+                job for job in self._jobs.values()
+                if job.finished and job.updated_at < cutoff
+            ]
+            for job in expired:
+                del self._jobs[job.id]
+        if self.on_expire:
+            for job in expired:
+                self.on_expire(job)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,456 @@
+import io
+import os
+import math
+from functools import lru_cache
+from xml.sax.saxutils import escape
+
+from PIL import Image, ImageDraw, ImageFont
+
+
+# Same look as the classDefs in generate_mermaid, plus a red style for error nodes
+NODE_STYLES = {
+    "core": {"fill": "#e3f2fd", "stroke": "#1565c0"},
+    "support": {"fill": "#f3f3f3", "stroke": "#78909c"},
+    "error": {"fill": "#ffebee", "stroke": "#c62828"},
+}
+EDGE_COLOR = "#2196f3"
+TEXT_COLOR = "#333333"
+
+FONT_SIZE = 14
+LINE_HEIGHT = 18
+CHAR_WIDTH = 7.4  # average Arial glyph width at 14px, good enough for sizing boxes
+PAD_X = 14
+PAD_Y = 10
+RANK_GAP = 90  # horizontal space between layers, room for edge labels
+NODE_GAP = 28  # vertical space between nodes in a layer
+MARGIN = 20
+DUMMY_HEIGHT = 12
+CROSSING_SWEEPS = 8
+
+# Largest PNG we draw. Wide graphs get a lower scale (never below 1x, the SVG's size), PNG
+# encoding time grows with the pixel count and dominates rendering past a few million pixels
+PNG_MAX_PIXELS = int(os.getenv("DIAGRAM_PNG_MAX_PIXELS", str(2 * 1024 * 1024)))
+
+
+# Wrap a description to ~30 characters per line, the same way generate_mermaid does
+def wrap_text(text, width=30):
+    lines = []
+    current_line = []
+    for word in str(text).split():
+        if current_line and sum(len(w) for w in current_line) + len(current_line) + len(word) > width:
+            lines.append(" ".join(current_line))
+            current_line = [word]
+        else:
+            current_line.append(word)
+    if current_line:
+        lines.append(" ".join(current_line))
+    return lines or [""]
+
+
+def _node_id(value):
+    return str(value).lower().replace(" ", "_")
+
+
+class LayoutNode:
+    def __init__(self, node_id, lines=None, node_type="core", dummy=False):
+        self.id = node_id
+        self.lines = lines or []
+        self.type = node_type if node_type in NODE_STYLES else "core"
+        self.dummy = dummy
+        if dummy:
+            self.width, self.height = 0, DUMMY_HEIGHT
+        else:
+            longest = max(len(line) for line in self.lines)
+            self.width = longest * CHAR_WIDTH + 2 * PAD_X
+            self.height = len(self.lines) * LINE_HEIGHT + 2 * PAD_Y
+        self.rank = 0
+        self.x = 0.0  # centre
+        self.y = 0.0  # centre
+
+
+class LayoutEdge:
+    def __init__(self, source, target, label, chain, reversed_):
+        self.source = source
+        self.target = target
+        self.label = label
+        self.chain = chain  # node IDs from rank order start to end, dummies included
+        self.reversed = reversed_  # drawn against the layering because it closed a cycle
+        self.points = []
+
+
+class Layout:
+    def __init__(self, nodes, edges, self_loops, width, height):
+        self.nodes = nodes
+        self.edges = edges
+        self.self_loops = self_loops
+        self.width = width
+        self.height = height
+
+
+# Depth-first search that returns the edges closing a cycle, reversing those makes the graph acyclic
+def _back_edges(order, successors):
+    state = {node: 0 for node in order}  # 0 new, 1 on stack, 2 done
+    back = set()
+    for start in order:
+        if state[start]:
+            continue
+        stack = [(start, iter(successors[start]))]
+        state[start] = 1
+        while stack:
+            node, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                state[node] = 2
+                stack.pop()
+            elif state[child] == 1:
+                back.add((node, child))
+            elif state[child] == 0:
+                state[child] = 1
+                stack.append((child, iter(successors[child])))
+    return back
+
+
+# Longest-path layering: every node sits one rank after its furthest predecessor
+def _assign_ranks(order, dag_edges):
+    incoming = {node: 0 for node in order}
+    successors = {node: [] for node in order}
+    for source, target in dag_edges:
+        successors[source].append(target)
+        incoming[target] += 1
+
+    rank = {node: 0 for node in order}
+    ready = [node for node in order if incoming[node] == 0]
+    while ready:
+        node = ready.pop(0)
+        for child in successors[node]:
+            rank[child] = max(rank[child], rank[node] + 1)
+            incoming[child] -= 1
+            if incoming[child] == 0:
+                ready.append(child)
+    return rank
+
+
+def _count_crossings(layers, successors):
+    crossings = 0
+    for upper, lower in zip(layers, layers[1:]):
+        position = {node: i for i, node in enumerate(lower)}
+        segments = [
+            (i, position[child])
+            for i, node in enumerate(upper)
+            for child in successors[node]
+            if child in position
+        ]
+        for a in range(len(segments)):
+            for b in range(a + 1, len(segments)):
+                if (segments[a][0] - segments[b][0]) * (segments[a][1] - segments[b][1]) < 0:
+                    crossings += 1
+    return crossings
+
+
+# Barycenter heuristic: alternate down and up sweeps, keep the ordering with fewest crossings
+def _reduce_crossings(layers, successors, predecessors):
+    best = [list(layer) for layer in layers]
+    best_crossings = _count_crossings(best, successors)
+
+    for sweep in range(CROSSING_SWEEPS):
+        downward = sweep % 2 == 0
+        indices = range(1, len(layers)) if downward else range(len(layers) - 2, -1, -1)
+        for r in indices:
+            fixed = layers[r - 1] if downward else layers[r + 1]
+            neighbours = predecessors if downward else successors
+            position = {node: i for i, node in enumerate(fixed)}
+
+            def barycenter(item):
+                i, node = item
+                linked = [position[n] for n in neighbours[node] if n in position]
+                return sum(linked) / len(linked) if linked else i
+
+            layers[r] = [node for _, node in sorted(enumerate(layers[r]), key=barycenter)]
+
+        crossings = _count_crossings(layers, successors)
+        if crossings < best_crossings:
+            best = [list(layer) for layer in layers]
+            best_crossings = crossings
+        if best_crossings == 0:
+            break
+    return best
+
+
+# Place a layer's nodes as close to their desired centres as the spacing allows. Pushing
+# down and pushing up both give valid placements, and so does their average.
+def _pack_layer(layer, nodes, desired):
+    def separation(a, b):
+        return (nodes[a].height + nodes[b].height) / 2 + NODE_GAP
+
+    down = list(desired)
+    for i in range(1, len(layer)):
+        down[i] = max(down[i], down[i - 1] + separation(layer[i - 1], layer[i]))
+    up = list(desired)
+    for i in range(len(layer) - 2, -1, -1):
+        up[i] = min(up[i], up[i + 1] - separation(layer[i], layer[i + 1]))
+    return [(d + u) / 2 for d, u in zip(down, up)]
+
+
+def _assign_coordinates(layers, nodes, successors, predecessors):
+    # x: one column per rank, as wide as the widest node in it (flowchart LR)
+    x = MARGIN
+    for layer in layers:
+        column = max(nodes[n].width for n in layer)
+        for node in layer:
+            nodes[node].x = x + column / 2
+        x += column + RANK_GAP
+
+    # y: start stacked, then pull every node towards the median of its neighbours
+    for layer in layers:
+        y = 0.0
+        for node in layer:
+            nodes[node].y = y + nodes[node].height / 2
+            y += nodes[node].height + NODE_GAP
+
+    for sweep in range(4):
+        downward = sweep % 2 == 0
+        ordered = layers[1:] if downward else list(reversed(layers[:-1]))
+        neighbours = predecessors if downward else successors
+        for layer in ordered:
+            desired = []
+            for node in layer:
+                linked = sorted(nodes[n].y for n in neighbours[node])
+                if linked:
+                    mid = len(linked) // 2
+                    median = linked[mid] if len(linked) % 2 else (linked[mid - 1] + linked[mid]) / 2
+                    desired.append(median)
+                else:
+                    desired.append(nodes[node].y)
+            for node, y in zip(layer, _pack_layer(layer, nodes, desired)):
+                nodes[node].y = y
+
+    # Shift everything so the top-most box starts at the margin
+    top = min(n.y - n.height / 2 for n in nodes.values())
+    for node in nodes.values():
+        node.y += MARGIN - top
+    return x - RANK_GAP + MARGIN
+
+
+# Turn workflow_data ({"nodes": [...], "edges": [...]}) into positioned boxes and edge routes
+def layout_workflow(workflow_data):
+    nodes = {}
+    for node in workflow_data.get("nodes", []):
+        node_id = _node_id(node["id"])
+        nodes[node_id] = LayoutNode(node_id, wrap_text(node.get("text", node_id)), node.get("type", "core"))
+
+    edges = []
+    self_loops = []
+    for edge in workflow_data.get("edges", []):
+        source, target = _node_id(edge["from"]), _node_id(edge["to"])
+        # Mermaid creates a bare node for unknown IDs, so do we
+        for node_id in (source, target):
+            if node_id not in nodes:
+                nodes[node_id] = LayoutNode(node_id, [node_id])
+        if source == target:
+            self_loops.append((source, edge.get("label", "flow")))
+        else:
+            edges.append((source, target, edge.get("label", "flow")))
+
+    if not nodes:
+        return Layout({}, [], [], 2 * MARGIN, 2 * MARGIN)
+
+    order = list(nodes)
+    successors = {node: [] for node in order}
+    for source, target, _ in edges:
+        successors[source].append(target)
+    back = _back_edges(order, successors)
+
+    dag_edges = []
+    for source, target, label in edges:
+        reversed_ = (source, target) in back
+        dag_edges.append((target, source, label, reversed_) if reversed_ else (source, target, label, reversed_))
+
+    rank = _assign_ranks(order, [(s, t) for s, t, _, _ in dag_edges])
+    for node_id, r in rank.items():
+        nodes[node_id].rank = r
+
+    # Long edges get a dummy node on every rank they cross so they can be routed around boxes
+    layout_edges = []
+    successors = {node: [] for node in order}
+    predecessors = {node: [] for node in order}
+    for index, (source, target, label, reversed_) in enumerate(dag_edges):
+        chain = [source]
+        for r in range(rank[source] + 1, rank[target]):
+            dummy_id = f"__dummy_{index}_{r}"
+            nodes[dummy_id] = LayoutNode(dummy_id, dummy=True)
+            nodes[dummy_id].rank = r
+            successors[dummy_id] = []
+            predecessors[dummy_id] = []
+            chain.append(dummy_id)
+        chain.append(target)
+        for a, b in zip(chain, chain[1:]):
+            successors[a].append(b)
+            predecessors[b].append(a)
+        original = (target, source) if reversed_ else (source, target)
+        layout_edges.append(LayoutEdge(original[0], original[1], label, chain, reversed_))
+
+    layers = [[] for _ in range(max(n.rank for n in nodes.values()) + 1)]
+    for node_id, node in nodes.items():
+        layers[node.rank].append(node_id)
+
+    layers = _reduce_crossings(layers, successors, predecessors)
+    width = _assign_coordinates(layers, nodes, successors, predecessors)
+    height = max(n.y + n.height / 2 for n in nodes.values()) + MARGIN
+
+    # Route edges from the right side of the first box to the left side of the last, via the dummies
+    for edge in layout_edges:
+        first, last = nodes[edge.chain[0]], nodes[edge.chain[-1]]
+        points = [(first.x + first.width / 2, first.y)]
+        points += [(nodes[d].x, nodes[d].y) for d in edge.chain[1:-1]]
+        points.append((last.x - last.width / 2, last.y))
+        edge.points = list(reversed(points)) if edge.reversed else points
+
+    real_nodes = {node_id: node for node_id, node in nodes.items() if not node.dummy}
+    return Layout(real_nodes, layout_edges, self_loops, width, height)
+
+
+def _label_position(points):
+    # middle of the middle segment
+    i = (len(points) - 1) // 2
+    (x1, y1), (x2, y2) = points[i], points[i + 1]
+    return (x1 + x2) / 2, (y1 + y2) / 2
+
+
+def _arrow_head(points, size=8):
+    (x1, y1), (x2, y2) = points[-2], points[-1]
+    angle = math.atan2(y2 - y1, x2 - x1)
+    left = (x2 - size * math.cos(angle - 0.4), y2 - size * math.sin(angle - 0.4))
+    right = (x2 - size * math.cos(angle + 0.4), y2 - size * math.sin(angle + 0.4))
+    return [(x2, y2), left, right]
+
+
+def render_svg(layout):
+    out = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{layout.width:.0f}" height="{layout.height:.0f}" '
+        f'viewBox="0 0 {layout.width:.0f} {layout.height:.0f}" font-family="arial" font-size="{FONT_SIZE}">'
+    ]
+
+    for edge in layout.edges:
+        path = " ".join(f"{x:.1f},{y:.1f}" for x, y in edge.points)
+        head = " ".join(f"{x:.1f},{y:.1f}" for x, y in _arrow_head(edge.points))
+        out.append(f'<polyline points="{path}" fill="none" stroke="{EDGE_COLOR}" stroke-width="2"/>')
+        out.append(f'<polygon points="{head}" fill="{EDGE_COLOR}"/>')
+
+    for node_id, _ in layout.self_loops:
+        node = layout.nodes[node_id]
+        x, top = node.x, node.y - node.height / 2
+        out.append(
+            f'<path d="M{x - 12:.1f},{top:.1f} C{x - 12:.1f},{top - 30:.1f} {x + 12:.1f},{top - 30:.1f} {x + 12:.1f},{top:.1f}" '
+            f'fill="none" stroke="{EDGE_COLOR}" stroke-width="2"/>'
+        )
+
+    for node in layout.nodes.values():
+        style = NODE_STYLES[node.type]
+        left, top = node.x - node.width / 2, node.y - node.height / 2
+        out.append(
+            f'<rect x="{left:.1f}" y="{top:.1f}" width="{node.width:.1f}" height="{node.height:.1f}" '
+            f'rx="8" ry="8" fill="{style["fill"]}" stroke="{style["stroke"]}" stroke-width="2"/>'
+        )
+        first_line = node.y - (len(node.lines) - 1) * LINE_HEIGHT / 2
+        for i, line in enumerate(node.lines):
+            out.append(
+                f'<text x="{node.x:.1f}" y="{first_line + i * LINE_HEIGHT:.1f}" text-anchor="middle" '
+                f'dominant-baseline="central" fill="{TEXT_COLOR}">{escape(line)}</text>'
+            )
+
+    # Labels last so they sit on top of the lines
+    for edge in layout.edges:
+        if not edge.label:
+            continue
+        x, y = _label_position(edge.points)
+        width = len(edge.label) * CHAR_WIDTH * 0.85 + 8
+        out.append(
+            f'<rect x="{x - width / 2:.1f}" y="{y - 9:.1f}" width="{width:.1f}" height="18" fill="#ffffff" opacity="0.9"/>'
+        )
+        out.append(
+            f'<text x="{x:.1f}" y="{y:.1f}" text-anchor="middle" dominant-baseline="central" '
+            f'font-size="{FONT_SIZE - 2}" fill="{TEXT_COLOR}">{escape(edge.label)}</text>'
+        )
+
+    out.append("</svg>")
+    return "\n".join(out)
+
+
+# A system sans-serif, or Pillow's bundled scalable font on hosts without one. Boxes are sized
+# for CHAR_WIDTH, which both fit at any scale
+@lru_cache(maxsize=None)
+def _load_font(size):
+    for name in ("arial.ttf", "Arial.ttf", "DejaVuSans.ttf", "LiberationSans-Regular.ttf"):
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            continue
+    return ImageFont.load_default(size)
+
+
+# "mm" anchors the text's middle at (x, y), no separate measuring pass
+def _draw_centered(draw, x, y, text, font, fill):
+    draw.text((x, y), text, font=font, fill=fill, anchor="mm")
+
+
+# `scale`, lowered for graphs that would come out bigger than PNG_MAX_PIXELS
+def png_scale(layout, scale):
+    area = layout.width * layout.height
+    if area * scale * scale <= PNG_MAX_PIXELS:
+        return scale
+    return max(1, math.sqrt(PNG_MAX_PIXELS / area))
+
+
+# Rasterize with Pillow at `scale`x, transparent background like `mmdc -b transparent -s 2`
+def render_png(layout, scale=2):
+    scale = png_scale(layout, scale)
+    stroke = round(2 * scale)
+    image = Image.new("RGBA", (math.ceil(layout.width * scale), math.ceil(layout.height * scale)), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    font = _load_font(round(FONT_SIZE * scale))
+    label_font = _load_font(round((FONT_SIZE - 2) * scale))
+
+    def scaled(points):
+        return [(x * scale, y * scale) for x, y in points]
+
+    for edge in layout.edges:
+        draw.line(scaled(edge.points), fill=EDGE_COLOR, width=stroke, joint="curve")
+        draw.polygon(scaled(_arrow_head(edge.points)), fill=EDGE_COLOR)
+
+    for node_id, _ in layout.self_loops:
+        node = layout.nodes[node_id]
+        top = node.y - node.height / 2
+        box = scaled([(node.x - 12, top - 22), (node.x + 12, top + 2)])
+        draw.arc(box, 180, 360, fill=EDGE_COLOR, width=stroke)
+
+    for node in layout.nodes.values():
+        style = NODE_STYLES[node.type]
+        box = scaled([
+            (node.x - node.width / 2, node.y - node.height / 2),
+            (node.x + node.width / 2, node.y + node.height / 2),
+        ])
+        draw.rounded_rectangle(box, radius=8 * scale, fill=style["fill"], outline=style["stroke"], width=stroke)
+        first_line = node.y - (len(node.lines) - 1) * LINE_HEIGHT / 2
+        for i, line in enumerate(node.lines):
+            _draw_centered(draw, node.x * scale, (first_line + i * LINE_HEIGHT) * scale, line, font, TEXT_COLOR)
+
+    for edge in layout.edges:
+        if not edge.label:
+            continue
+        x, y = _label_position(edge.points)
+        left, top, right, bottom = draw.textbbox((0, 0), edge.label, font=label_font)
+        half_w, half_h = (right - left) / 2 + 4 * scale, (bottom - top) / 2 + 3 * scale
+        draw.rectangle([x * scale - half_w, y * scale - half_h, x * scale + half_w, y * scale + half_h], fill="#ffffff")
+        _draw_centered(draw, x * scale, y * scale, edge.label, label_font, TEXT_COLOR)
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", compress_level=1)  # zlib speed over size, this is the slow part
+    return buffer.getvalue()
+
+
+# Lay out and render a workflow in one go, fmt is "png" or "svg"
+def render_workflow(workflow_data, fmt="png", scale=2):
+    layout = layout_workflow(workflow_data)
+    if fmt == "svg":
+        return render_svg(layout).encode("utf-8")
+    return render_png(layout, scale)
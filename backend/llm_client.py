@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import random
+import asyncio
+import hashlib
+
+from google.api_core import exceptions as google_exceptions
+
+from metrics import span, PROMPT_CHARS, PROMPT_TOKENS
+
+
+# Quota (429) and server-side (5xx) failures, worth another try after a pause
+RETRYABLE_ERRORS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.InternalServerError,
+    google_exceptions.BadGateway,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.GatewayTimeout,
+    google_exceptions.DeadlineExceeded,
+)
+
+# Rough token cost of one image part, Gemini bills small images at a flat rate
+IMAGE_TOKENS = 258
+
+
+class ModelUnavailableError(Exception):
+    """Gemini kept failing with quota or server errors after every retry, the caller should try again later"""
+
+    def __init__(self, message, retry_after=30):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# Classic token bucket: holds up to `per_minute` units and refills continuously.
+# acquire() waits until enough units are available, callers are served in order
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self._lock = None
+
+    async def acquire(self, amount=1):
+        if self._lock is None:
+            self._lock = asyncio.Lock()  # created on first use so it belongs to the running loop
+        amount = min(amount, self.capacity)  # a huge request still gets through eventually
+        waited = 0.0
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                delay = (amount - self.tokens) / self.rate
+                waited += delay
+                await asyncio.sleep(delay)
+
+
+# Rough input size of a request, about four characters per token for text
+def estimate_tokens(contents):
+    parts = contents if isinstance(contents, list) else [contents]
+    total = 0
+    for part in parts:
+        if isinstance(part, str):
+            total += len(part) // 4 + 1
+        else:
+            total += IMAGE_TOKENS
+    return total
+
+
+# Set on a coalesced call whose caller was cancelled: the callers waiting on it make the call again
+class _LeaderCancelled(Exception):
+    pass
+
+
+# Identical prompt + inputs + config means an identical request
+def request_key(contents, generation_config):
+    digest = hashlib.sha256()
+    digest.update(json.dumps(generation_config, sort_keys=True).encode("utf-8"))
+    for part in contents if isinstance(contents, list) else [contents]:
+        if isinstance(part, str):
+            digest.update(b"text:" + part.encode("utf-8"))
+        elif isinstance(part, dict):
+            digest.update(f"blob:{part.get('mime_type')}:".encode("utf-8"))
+            digest.update(part.get("data", b""))
+        else:
+            digest.update(repr(part).encode("utf-8"))
+    return digest.hexdigest()
+
+
+# The one way our code talks to Gemini. Keeps us inside the requests/tokens per minute quota,
+# retries quota and server errors with exponential backoff and jitter, and coalesces
+# identical requests that are in flight at the same time into a single model call
+class GeminiClient:
+    def __init__(
+        self,
+        model,
+        requests_per_minute=0,
+        tokens_per_minute=0,
+        concurrency=16,
+        max_retries=5,
+        base_delay=1.0,
+        max_delay=30.0,
+    ):
+        self.model = model
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._slots = None
+        self._in_flight = {}  # request key -> future of the leader's response text
+        self.stats = {"calls": 0, "retries": 0, "coalesced": 0, "failures": 0, "throttled_seconds": 0.0}
+
+    # Send one request and return the response text. With on_chunk the response is streamed
+    # and on_chunk(text) sees every piece as it arrives (only for the caller that made the call,
+    # a coalesced duplicate just gets the final text)
+    async def generate(self, contents, generation_config, on_chunk=None):
+        key = request_key(contents, generation_config)
+        pending = self._in_flight.get(key)
+        if pending is not None:
+            self.stats["coalesced"] += 1
+        while pending is not None:
+            try:
+                # shield: a duplicate giving up must not cancel the call everyone else is waiting on
+                return await asyncio.shield(pending)
+            except _LeaderCancelled:
+                # the caller that made the call went away (e.g. closed the page), that's no reason
+                # for us to fail: the first one back makes the call again, the others join it
+                pending = self._in_flight.get(key)
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            text = await self._generate_with_retries(contents, generation_config, on_chunk)
+            future.set_result(text)
+            return text
+        except asyncio.CancelledError:
+            future.set_exception(_LeaderCancelled())
+            future.exception()  # retrieved, so it isn't reported when nobody was waiting
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # retrieved here, so nobody waiting isn't reported as an error
+            raise
+        finally:
+            del self._in_flight[key]
+
+    async def _generate_with_retries(self, contents, generation_config, on_chunk):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+        parts = contents if isinstance(contents, list) else [contents]
+        estimated = estimate_tokens(contents)
+        PROMPT_TOKENS.inc(estimated)
+        PROMPT_CHARS.observe(sum(len(part) for part in parts if isinstance(part, str)))
+        streamed = []  # pieces already handed to on_chunk, we can't take those back
+
+        for attempt in range(self.max_retries + 1):
+            if self.requests or self.tokens:
+                with span("throttle"):
+                    if self.requests:
+                        self.stats["throttled_seconds"] += await self.requests.acquire()
+                    if self.tokens:
+                        self.stats["throttled_seconds"] += await self.tokens.acquire(estimated)
+
+            try:
+                async with self._slots:
+                    self.stats["calls"] += 1
+                    with span("model"):
+                        return await self._call(contents, generation_config, on_chunk, streamed)
+            except RETRYABLE_ERRORS as e:
+                if streamed or attempt == self.max_retries:
+                    self.stats["failures"] += 1
+                    raise ModelUnavailableError(
+                        f"Gemini unavailable after {attempt + 1} attempts: {e}",
+                        retry_after=int(self.max_delay),
+                    ) from e
+                # full jitter: spread retries out so a burst doesn't come back as another burst
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                self.stats["retries"] += 1
+                print(f"Gemini call failed ({type(e).__name__}), retrying in {delay:.1f}s...")
+                await asyncio.sleep(delay)
+
+    async def _call(self, contents, generation_config, on_chunk, streamed):
+        if on_chunk is None:
+            response = await self.model.generate_content_async(
+                contents, generation_config=generation_config
+            )
+            return response.text
+
+        response = await self.model.generate_content_async(
+            contents, generation_config=generation_config, stream=True
+        )
+        async for chunk in response:
+            try:
+                text = chunk.text
+            except ValueError:
+                continue  # chunk without text parts, e.g. the final finish-reason chunk
+            streamed.append(text)
+            on_chunk(text)
+        return "".join(streamed)
+
+
+# Build the client from the GEMINI_* environment settings
+def client_from_env(model):
+    return GeminiClient(
+        model,
+        requests_per_minute=int(os.getenv("GEMINI_RPM", "0")),
+        tokens_per_minute=int(os.getenv("GEMINI_TPM", "0")),
+        concurrency=int(os.getenv("LLM_CONCURRENCY", "16")),
+        max_retries=int(os.getenv("GEMINI_MAX_RETRIES", "5")),
+        base_delay=float(os.getenv("GEMINI_RETRY_BASE_DELAY", "1")),
+        max_delay=float(os.getenv("GEMINI_RETRY_MAX_DELAY", "30")),
+    )
@@ -0,0 +1,47 @@
+// Long-lived Mermaid renderer used by renderer.py.
+// It launches one headless browser at startup and keeps it warm, then renders
+// every diagram it is sent on stdin (one JSON request per line) and answers on
+// stdout (one JSON response per line). Requests are handled one at a time, the
+// Python side runs several of these workers to get parallelism.
+import readline from "node:readline";
+import puppeteer from "puppeteer";
+import { renderMermaid } from "@mermaid-js/mermaid-cli";
+
+const browser = await puppeteer.launch({
+  headless: "new",
+  args: ["--no-sandbox", "--disable-setuid-sandbox"],
+});
+
+// If the browser dies we exit too, the pool notices and starts a fresh worker
+browser.on("disconnected", () => process.exit(1));
+
+const send = (message) => process.stdout.write(JSON.stringify(message) + "\n");
+
+send({ ready: true });
+
+const lines = readline.createInterface({ input: process.stdin });
+
+for await (const line of lines) {
+  if (!line.trim()) continue;
+
+  let job;
+  try {
+    job = JSON.parse(line);
+  } catch (err) {
+    send({ id: null, ok: false, error: `Invalid request: ${err.message}` });
+    continue;
+  }
+
+  try {
+    const { data } = await renderMermaid(browser, job.definition, job.format || "png", {
+      backgroundColor: job.background || "transparent",
+      viewport: { width: 800, height: 600, deviceScaleFactor: job.scale || 2 },
+      mermaidConfig: {},
+    });
+    send({ id: job.id, ok: true, data: Buffer.from(data).toString("base64") });
+  } catch (err) {
+    send({ id: job.id, ok: false, error: String((err && err.message) || err) });
+  }
+}
+
+await browser.close();
@@ -0,0 +1,229 @@
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+
+# Seconds, from a cache hit up to a long multi-chunk document
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Bytes or characters
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 3e5, 1e6, 3e6, 1e7, 3e7, 1e8)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{value}"' for key, value in labels)
+    return "{" + pairs + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._values = {}  # sorted label pairs -> value
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self._series = {}  # sorted label pairs -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    labels = _format_labels(key + (("le", _format_value(bound)),))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+# Every metric of the process plus collectors that report other components' own counters
+# (cache, Gemini client...) at scrape time, rendered in the Prometheus text format
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help_text):
+        metric = Counter(name, help_text)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help_text, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    # collect() returns [(name, type, help, [(labels dict, value), ...]), ...]
+    def add_collector(self, collect):
+        self._collectors.append(collect)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collect in self._collectors:
+            try:
+                families = collect()
+            except Exception as e:
+                print(f"Metrics collector failed: {e}")
+                continue
+            for name, kind, help_text, samples in families:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    labels = _format_labels(tuple(sorted(labels.items())))
+                    lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+REQUEST_SECONDS = registry.histogram(
+    "workflow_request_seconds", "Time spent handling an HTTP request, by endpoint"
+)
+STAGE_SECONDS = registry.histogram(
+    "workflow_stage_seconds", "Time spent in each pipeline stage"
+)
+UPLOAD_BYTES = registry.histogram(
+    "workflow_upload_bytes", "Size of uploaded files", SIZE_BUCKETS
+)
+PROMPT_CHARS = registry.histogram(
+    "workflow_prompt_chars", "Characters of text sent to Gemini per call", SIZE_BUCKETS
+)
+PROMPT_TOKENS = registry.counter(
+    "workflow_prompt_tokens_total", "Estimated input tokens sent to Gemini"
+)
+TOKENS_SAVED = registry.counter(
+    "workflow_prompt_tokens_saved_total", "Estimated tokens removed from document text before analysis"
+)
+SECTIONS = registry.counter(
+    "workflow_document_chunks_total", "Document chunks sent to Gemini (analyzed) or reused from an earlier upload"
+)
+REPLY_REPAIRS = registry.counter(
+    "workflow_reply_repairs_total",
+    "Follow-up Gemini requests for replies that failed validation (retry: unreadable, edges: dangling edges)",
+)
+
+
+# Where one request spent its time, summed per stage (chunks analyzed in parallel add up)
+class RequestTimings:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._stages = {}  # stage -> [seconds, count]
+        self._notes = {}  # stage -> description, e.g. which cache tier hit
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            entry = self._stages.setdefault(stage, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += 1
+
+    def note(self, stage, description):
+        with self._lock:
+            self._notes[stage] = description
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    @contextmanager
+    def span(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            STAGE_SECONDS.observe(seconds, stage=stage)
+            self.add(stage, seconds)
+
+    # Value for the Server-Timing response header
+    def header(self):
+        parts = []
+        with self._lock:
+            for stage, (seconds, count) in self._stages.items():
+                part = f"{stage};dur={seconds * 1000:.1f}"
+                if stage in self._notes:
+                    part += f';desc="{self._notes[stage]}"'
+                elif count > 1:
+                    part += f';desc="{count} calls"'
+                parts.append(part)
+            for stage, description in self._notes.items():
+                if stage not in self._stages:
+                    parts.append(f'{stage};desc="{description}"')
+        parts.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(parts)
+
+
+# Timings of the request the current task belongs to. process() sets it, everything it
+# awaits (and asyncio.to_thread) inherits it, so spans deep in the pipeline find their request
+_current = contextvars.ContextVar("request_timings", default=None)
+
+
+def set_request_timings(timings):
+    _current.set(timings)
+
+
+def current_timings():
+    return _current.get()
+
+
+# Time a pipeline stage: always recorded in the stage histogram, and in the current request's timings if any
+@contextmanager
+def span(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        STAGE_SECONDS.observe(seconds, stage=stage)
+        timings = _current.get()
+        if timings is not None:
+            timings.add(stage, seconds)
+
+
+def note(stage, description):
+    timings = _current.get()
+    if timings is not None:
+        timings.note(stage, description)
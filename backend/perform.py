@@ -1,7 +1,5 @@
 import os
 from pathlib import Path
-from docx import Document
-import PyPDF2
 import google.generativeai as genai
 from dotenv import load_dotenv
 import json
@@ -10,14 +8,297 @@ import subprocess
 import platform
 import atexit
 import asyncio
-from PIL import Image
-import io
+import threading
 import traceback
+import hashlib
+from renderer import get_render_pool
+from cache import get_result_cache, hash_file, hash_bytes, cache_key
+from chunking import (
+    PAGE_SEPARATOR,
+    ChunkPacker,
+    split_into_chunks,
+    merge_workflows,
+    stabilize_ids,
+)
+from extraction import (
+    iter_pdf_pages,
+    is_in_memory,
+    extract_document,
+    get_extraction_pool,
+    iter_docx_blocks,
+    rasterize_pdf_pages,
+)
+from layout_renderer import render_workflow
+from stream_parser import WorkflowStreamParser
+from compaction import COMPACTION_VERSION, PageCompactor, compact_pages
+from image_prep import IMAGE_PREP_VERSION, prepare_image
+from phash import get_phash_index, image_hash
+from llm_client import ModelUnavailableError, client_from_env
+from workflow_schema import (
+    WORKFLOW_SCHEMA_VERSION,
+    structured_config,
+    parse_workflow_reply,
+    validate_workflow,
+)
+import metrics
+
+
+MODEL_NAME = "gemini-2.0-flash-exp"
+
+# temperature is the randomness of the output, top_p is the probability of the output, top_k is the number of tokens to consider.
+# Replies are constrained to the workflow JSON schema (see workflow_schema.py)
+DOCUMENT_GENERATION_CONFIG = structured_config({"temperature": 0.3, "top_p": 0.8, "top_k": 40})
+IMAGE_GENERATION_CONFIG = structured_config(
+    {
+        "temperature": 0.3,
+        "top_p": 0.8,
+        "top_k": 40,
+        "max_output_tokens": 2048,
+    }
+)
+
+DOCUMENT_PROMPT = """Create a comprehensive workflow diagram that shows how different processes interact and flow within the system.  Only base it off information provided
+
+Key requirements:
+1. Process Identification:
+   - Identify major system processes
+   - Use clear, technical naming for processes (lowercase with underscores)
+   - Each process should have both a title and detailed description
+
+2. Process Details:
+   For each process, provide:
+   - Title: Short, technical name (e.g., 'data_integration', 'claims_processing')
+   - Description: 2-3 lines explaining key functionality
+   - Type: Either 'core' or 'support' process
+
+3. Flow Structure:
+   - Multiple processes can run in parallel
+   - Processes can converge or branch based on logic
+   - Show both primary and secondary workflows
+   - Include branching paths where relevant
+
+Return JSON in this format:
+{
+    "nodes": [
+        {
+            "id": "process_name",
+            "text": "Detailed description of functionality",
+            "type": "core"
+        }
+    ],
+    "edges": [
+        {
+            "from": "source_process",
+            "to": "target_process",
+            "label": "flow"
+        }
+    ]
+}
+
+Create a natural flow that allows for parallel processes and interconnected workflows."""
+
+# Added to DOCUMENT_PROMPT when a long document is analyzed in parts
+CHUNK_PROMPT = """This text is part {part} of a longer document. Only describe the processes that appear in this part.
+Name processes by what they do (not by where they appear) so the same process gets the same id in every part."""
+
+SCANNED_PROMPT = """The pages attached as images (pages {first} to {last} of the document) are scans, read their text from the images.
+Only describe the processes that appear on these pages.
+Name processes by what they do (not by where they appear) so the same process gets the same id in every part."""
+
+IMAGE_PROMPT = """Analyze this image in detail and create a comprehensive workflow diagram. Break down the analysis into clear steps:
+
+            1. Initial Visual Analysis:
+            - Identify all visual elements (shapes, text, icons, etc.)
+            - Note their positions and relationships
+            - Identify any color coding or visual hierarchies
+            - Look for arrows, lines, or other connection indicators
+            
+            2. Workflow Components:
+            - Break down the image into distinct process steps or components
+            - Identify any parallel processes or decision points
+            - Note any start/end points or key milestones
+            - Identify any conditional flows or branches
+            
+            3. Process Classification:
+            - Categorize each component (input, process, decision, output, etc.)
+            - Identify primary vs. supporting processes
+            - Note any dependencies between components
+            - Identify process boundaries and interfaces
+            
+            4. Data and Information Flow:
+            - Track how information or data moves between components
+            - Identify input/output relationships
+            - Note any feedback loops or cyclic processes
+            - Identify any data transformation points
+
+            Convert your analysis into this specific JSON format:
+            {
+                "nodes": [
+                    {
+                        "id": "unique_process_name",
+                        "text": "Detailed description of what this component does and its role in the workflow",
+                        "type": "core"
+                    }
+                ],
+                "edges": [
+                    {
+                        "from": "source_process_name",
+                        "to": "target_process_name",
+                        "label": "describes the nature of this connection"
+                    }
+                ]
+            }
+
+            Requirements for the output:
+            1. Each node must have a unique, descriptive ID
+            2. Node descriptions should be clear and detailed
+            3. All connections must reference valid node IDs
+            4. Edge labels should describe the nature of the connection
+            5. Use "core" or "support" for node types
+
+            If you can't identify specific components, create logical groupings based on visual elements and their apparent relationships."""
+
+# Follow-up for the edges of a reply that point at nodes it doesn't have. Only the broken
+# edges and the node list are sent, not the document again
+REPAIR_EDGES_PROMPT = """These connections in a workflow point at processes that are not in its process list.
+
+Processes (id: description):
+{nodes}
+
+Broken connections:
+{edges}
+
+For each broken connection, return it with "from" and "to" set to ids from the process list. If it
+refers to a real process that is missing from the list, also return that process in "nodes".
+Leave out connections that don't fit any process. Return only the added processes and the
+corrected connections, as JSON: {{"nodes": [{{"id", "text", "type"}}], "edges": [{{"from", "to", "label"}}]}}"""
+
+# Added to a request whose reply couldn't be read at all
+RETRY_NOTE = """Your previous reply could not be read as the workflow JSON. Reply with only the JSON object, in exactly the format above."""
+
+
+# Cache versions: anything that changes a result has to change its key.
+# Bump EXTRACT_VERSION / RENDER_VERSION by hand when the extractors or the diagram styling change.
+def _version(*parts):
+    return hashlib.sha256(
+        json.dumps(parts, sort_keys=True).encode("utf-8")
+    ).hexdigest()[:16]
+
+
+EXTRACT_VERSION = "3"
+DOCUMENT_ANALYSIS_VERSION = _version(
+    "document",
+    EXTRACT_VERSION,  # the workflow and diagram are looked up before any text is extracted
+    MODEL_NAME,
+    DOCUMENT_PROMPT,
+    CHUNK_PROMPT,
+    SCANNED_PROMPT,
+    DOCUMENT_GENERATION_CONFIG,
+    COMPACTION_VERSION,
+    WORKFLOW_SCHEMA_VERSION,
+)
+IMAGE_ANALYSIS_VERSION = _version(
+    "image",
+    MODEL_NAME,
+    IMAGE_PROMPT,
+    IMAGE_GENERATION_CONFIG,
+    IMAGE_PREP_VERSION,
+    WORKFLOW_SCHEMA_VERSION,
+)
+RENDER_VERSION = "1"
+RENDERERS = ("mermaid", "native")
+
+# What process() can hand back: format -> (response content type, file name)
+OUTPUT_FORMATS = {
+    "png": ("image/png", "workflow.png"),
+    "svg": ("image/svg+xml", "workflow.svg"),
+    "mermaid": ("text/plain", "workflow.mmd"),  # the frameworks add "; charset=utf-8" to text types
+    "json": ("application/json", "workflow.json"),
+}
+# Accept header types for each format, in order of preference
+ACCEPT_TYPES = (
+    ("image/png", "png"),
+    ("image/svg+xml", "svg"),
+    ("application/json", "json"),
+    ("text/vnd.mermaid", "mermaid"),
+    ("text/x-mermaid", "mermaid"),
+    ("text/plain", "mermaid"),
+)
+
+
+# Pick the output format for a request: an explicit ?format= wins, otherwise the Accept header.
+# Clients that accept anything (*/*, image/*) or send no Accept get the PNG they always got, so
+# only clients that ask for JSON, Mermaid or SVG alone change behaviour.
+# accept is the framework's parsed Accept header (werkzeug MIMEAccept).
+# Returns (format, error message)
+def negotiate_output(requested, accept):
+    if requested:
+        if requested not in OUTPUT_FORMATS:
+            return None, f"Unknown format '{requested}', use one of: {', '.join(OUTPUT_FORMATS)}"
+        return requested, None
+    if not accept or any(value in ("*/*", "image/*") and quality > 0 for value, quality in accept):
+        return "png", None
+    match = accept.best_match([mimetype for mimetype, _ in ACCEPT_TYPES])
+    if match is None:
+        return None, f"Can't produce any of: {accept}"
+    return dict(ACCEPT_TYPES)[match], None
+
+
+# Hand a cached partial graph to on_partial as if the model had just streamed it
+def replay_partials(workflow_data, on_partial):
+    if on_partial is None:
+        return
+    for node in workflow_data.get("nodes", []):
+        on_partial("node", node)
+    for edge in workflow_data.get("edges", []):
+        on_partial("edge", edge)
+
+
+# Write an output file so it's complete on disk before anyone is handed its path: written
+# under a temporary name, fsynced, then renamed into place
+def write_output(path, data):
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+# Tell the caller (e.g. the job API) which stage we're in
+def report_stage(on_stage, stage):
+    if on_stage is not None:
+        on_stage(stage)
+
+
+# What analyze_with_gemini returns when the document couldn't be analyzed
+def document_error_workflow():
+    return {
+        "nodes": [
+            {
+                "id": "node1",
+                "text": "Error analyzing document. Please try with a shorter text.",
+                "type": "error",
+            }
+        ],
+        "edges": [],
+    }
+
+
+# A PDF page with less text than this is treated as a scan
+MIN_PAGE_CHARS = 20
+
+
+# True when the analyzers fell back to their error diagram
+def is_error_workflow(workflow_data):
+    return any(node.get("type") == "error" for node in workflow_data.get("nodes", []))
 
 
 class SmartDocumentProcessor:
-    def __init__(self):
+    # headless (servers) never opens a viewer on the result, the CLI passes headless=False to preview it
+    def __init__(self, headless=True):
         load_dotenv()  # Load our API
+        self.headless = headless
         self.temp_dir = "temp"  # we save our temp directory
         os.makedirs(
             self.temp_dir, exist_ok=True
@@ -26,22 +307,151 @@ class SmartDocumentProcessor:
         # Initialize Gemini models for us we use 2.0 flash its new experimental and an handle files/images
         print("Initializing Gemini models...")
         genai.configure(api_key=os.getenv("GEMINI_API"))
-        self.model = genai.GenerativeModel("gemini-2.0-flash-exp")
-        self.model_vision = genai.GenerativeModel("gemini-2.0-flash-exp")
+        self.model = genai.GenerativeModel(MODEL_NAME)
+        self.model_vision = genai.GenerativeModel(MODEL_NAME)
         print("Models initialized successfully!")
 
-        # Register cleanup
+        # Every Gemini call goes through this: rate limits, retries and request coalescing
+        self.llm = client_from_env(self.model)
+
+        # Long documents are split into chunks that are analyzed in parallel and merged
+        self.chunk_chars = int(os.getenv("CHUNK_CHARS", "30000"))
+        self.chunk_concurrency = int(os.getenv("CHUNK_CONCURRENCY", "4"))
+        # Cache each chunk's analysis and cut chunks at content-defined points, so a revised
+        # upload only sends its changed chunks to Gemini and keeps the previous node IDs
+        self.incremental = os.getenv("INCREMENTAL_ANALYSIS", "1") == "1"
+
+        # Stream Gemini responses and parse nodes/edges as they arrive
+        self.streaming = os.getenv("GEMINI_STREAMING", "1") == "1"
+
+        # Follow-up requests for a reply that failed validation: asking again for an unreadable
+        # reply, or sending back just the edges that point at unknown nodes. 0 = never
+        self.schema_repairs = int(os.getenv("SCHEMA_REPAIR_ATTEMPTS", "1"))
+
+        # Files processed at once per batch
+        self.batch_concurrency = int(os.getenv("BATCH_CONCURRENCY", "8"))
+
+        # Strip repeated headers/footers, page numbers and whitespace before the text goes to Gemini.
+        # With a token budget (0 = none) the least informative paragraphs are dropped until it fits
+        self.compact_text = os.getenv("COMPACT_TEXT", "1") == "1"
+        self.token_budget = int(os.getenv("DOCUMENT_TOKEN_BUDGET", "0"))
+
+        # PDF pages without text are rasterized and read by the vision model, this many per request
+        self.scan_fallback = os.getenv("SCAN_FALLBACK", "1") == "1"
+        self.scan_batch_pages = int(os.getenv("SCAN_BATCH_PAGES", "8"))
+
+        # Cache version of a whole document's workflow: the settings above change which text
+        # reaches Gemini and how it's split, so changing one must not serve the old workflows
+        self.document_analysis_version = _version(
+            DOCUMENT_ANALYSIS_VERSION,
+            self.chunk_chars,
+            self.incremental,
+            self.compact_text,
+            self.token_budget,
+            self.scan_fallback,
+            self.scan_batch_pages,
+        )
+
+        # "mermaid" renders through mmdc, "native" uses the in-process layout renderer
+        self.default_renderer = os.getenv("DIAGRAM_RENDERER", "mermaid")
+
+        # Shared on-disk cache for extracted text, workflow JSON and rendered PNGs
+        self.cache = get_result_cache()
+        # Perceptual hashes of recent camera captures, so retakes of the same page reuse a result
+        self.phash_index = get_phash_index()
+
+        # One event loop for the lifetime of the processor. The async Gemini client binds its
+        # gRPC channel to the loop it was first used on, so reusing a single loop keeps that
+        # connection alive instead of rebuilding it for every asyncio.run() call
+        self._loop = None
+        self._loop_thread = None
+        self._loop_lock = threading.Lock()
+        self._owns_loop = True  # False once a server's loop was attached instead
+
+        # Register cleanup (once, the processor is meant to be created once per process)
         atexit.register(self._cleanup)
 
+        metrics.registry.add_collector(self.collect_metrics)
+
+    # Counters kept by the cache and the Gemini client, reported on /metrics
+    def collect_metrics(self):
+        families = [
+            (
+                f"workflow_llm_{name}_total",
+                "counter",
+                f"Gemini client {name.replace('_', ' ')}",
+                [({}, value)],
+            )
+            for name, value in self.llm.stats.items()
+        ]
+        if self.cache:
+            stats = self.cache.stats()
+            families += [
+                (
+                    "workflow_cache_lookups_total",
+                    "counter",
+                    "Result cache lookups by tier and outcome",
+                    [({"tier": tier, "result": "hit"}, count) for tier, count in stats["hits"].items()]
+                    + [({"tier": tier, "result": "miss"}, count) for tier, count in stats["misses"].items()],
+                ),
+                ("workflow_cache_bytes", "gauge", "Size of the result cache", [({}, stats["bytes"])]),
+            ]
+        if self.phash_index:
+            stats = self.phash_index.stats()
+            families.append(
+                (
+                    "workflow_similar_image_lookups_total",
+                    "counter",
+                    "Near-duplicate image lookups by outcome",
+                    [({"result": "hit"}, stats["hits"]), ({"result": "miss"}, stats["misses"])],
+                )
+            )
+        return families
+
+    # Start the background event loop the first time something needs it
+    def _get_loop(self):
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._loop_thread = threading.Thread(
+                    target=self._loop.run_forever, name="processor-loop", daemon=True
+                )
+                self._loop_thread.start()
+            return self._loop
+
+    # Use a loop someone else runs (the ASGI server's) instead of starting our own.
+    # Must be called before anything has started our loop
+    def attach_loop(self, loop):
+        with self._loop_lock:
+            if self._loop is not None and self._loop is not loop:
+                raise RuntimeError("Processor is already running on another event loop")
+            self._loop = loop
+            self._owns_loop = False
+
+    # Run one of our coroutines on the shared loop from any thread and wait for the result.
+    # Never call this from the loop itself, await the coroutine there instead
+    def run(self, coro, timeout=None):
+        future = asyncio.run_coroutine_threadsafe(coro, self._get_loop())
+        return future.result(timeout)
+
+    # Start the slow pieces (render workers) up front so the first request doesn't pay for them
+    def warm_up(self):
+        pool = get_render_pool()
+        if pool is not None:
+            try:
+                pool.start()
+            except Exception as e:
+                print(f"Could not start render workers: {e}")
+        self._get_loop()
+
     # Cleanup function
     def _cleanup(self):
-        """Clean up resources properly"""
+        """Stop the shared event loop when the process exits"""
         try:
-            loop = asyncio.get_event_loop()
-            if loop.is_running():
-                loop.stop()
-            if not loop.is_closed():
-                loop.close()
+            if self._owns_loop and self._loop is not None and not self._loop.is_closed():
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._loop_thread.join(timeout=5)
+                self._loop.close()
         except Exception:
             pass
 
@@ -66,36 +476,75 @@ class SmartDocumentProcessor:
     # basically loops through everything in the tmep folder and adds anything with a valid extension to an array and return the most recent of the files (theres typically only going to be 1 anyways)
 
     # Extract text from a document or PDF file
-    def extract_text(self, file_path):
-        extension = Path(file_path).suffix.lower()
+    # source is a path or the uploaded bytes, extension has to be given for bytes
+    def extract_text(self, source, extension=None):
+        extension = extension or Path(source).suffix.lower()
         print(f"\nExtracting text from {extension} file...")
 
         # we are basically returning one big string from the extracted text from the file
         if extension == ".docx":
-            doc = Document(file_path)
-            text = "\n\n".join([p.text for p in doc.paragraphs if p.text.strip()])
+            # paragraphs, list items and tables streamed straight out of the zip
+            text = "\n\n".join(iter_docx_blocks(source))
             print(f"Extracted {len(text)} characters from DOCX")
             return text
         elif extension == ".pdf":
-            with open(file_path, "rb") as file:
-                pdf = PyPDF2.PdfReader(file)
-                text = "\n\n".join(page.extract_text() for page in pdf.pages)
-                print(f"Extracted {len(text)} characters from PDF")
-                return text
+            # pages are separated by a form feed so long documents can be chunked per page
+            text = PAGE_SEPARATOR.join(iter_pdf_pages(source))
+            print(f"Extracted {len(text)} characters from PDF")
+            return text
         raise ValueError(f"Unsupported file format: {extension}")
 
+    # Yield the document text page by page, PDFs are extracted in parallel in the extraction pool
+    def iter_pages(self, source, extension=None):
+        extension = extension or Path(source).suffix.lower()
+        if extension == ".pdf":
+            yield from iter_pdf_pages(source)
+        else:
+            yield self.extract_text(source, extension)
+
+    # Async view of iter_pages: extraction runs in a thread and pages are handed over as they're ready
+    async def stream_pages(self, source, extension=None, window=16):
+        loop = asyncio.get_running_loop()
+        pages = asyncio.Queue()
+        slots = threading.Semaphore(window)  # at most `window` pages waiting to be consumed
+        stopped = threading.Event()
+        done = object()
+
+        def produce():
+            try:
+                for page in self.iter_pages(source, extension):
+                    while not slots.acquire(timeout=1):
+                        if stopped.is_set():
+                            return
+                    if stopped.is_set():
+                        return
+                    loop.call_soon_threadsafe(pages.put_nowait, page)
+            except Exception as e:
+                loop.call_soon_threadsafe(pages.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(pages.put_nowait, done)
+
+        producer = loop.run_in_executor(None, produce)
+        try:
+            while True:
+                page = await pages.get()
+                if page is done:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                slots.release()
+                yield page
+        finally:
+            stopped.set()
+            await producer
+
     # Process an image using Gemini 2.0 Flash
-    async def process_image(self, image_path):
-        """Process a PNG image using Gemini"""
+    async def process_image(self, image, on_partial=None):
+        """Process a PNG image (path or bytes) using Gemini"""
         print("\nProcessing image with Gemini 2.0 Flash...")
         try:
-            # Read and prepare the image
-            with Image.open(image_path) as img:
-                if img.mode != "RGB":
-                    img = img.convert("RGB")
-                img_byte_arr = io.BytesIO()
-                img.save(img_byte_arr, format="PNG")
-                img_bytes = img_byte_arr.getvalue()
+            # Read and prepare the image (resized and encoded to suit its content)
+            img_data = await asyncio.to_thread(prepare_image, image)
 
             #  prompt for image analysis
             prompt = """Analyze this image and create a workflow diagram showing the relationships between elements.
@@ -129,38 +578,16 @@ class SmartDocumentProcessor:
                 ]
             }"""
 
-            response = await self.model.generate_content_async(
-                [prompt, img_bytes],
-                generation_config={
-                    "temperature": 0.3,
-                    "top_p": 0.8,
-                    "top_k": 40,
-                },  # temperature is the randomness of the output, top_p is the probability of the output, top_k is the number of tokens to consider
+            result = await self.request_validated_workflow(
+                [prompt, img_data],
+                DOCUMENT_GENERATION_CONFIG,
+                on_partial,
             )
+            print(f"Analysis complete. Found {len(result['nodes'])} components.")
+            return result
 
-            # Process response
-            response_text = (
-                response.text.strip()
-            )  # we strip the response text of any whitespace
-            json_start = response_text.find("{")
-            json_end = response_text.rfind("}") + 1
-
-            if json_start >= 0 and json_end > json_start:
-                json_str = response_text[json_start:json_end]
-                result = json.loads(
-                    json_str
-                )  # we load the json string into a json object
-
-                # Update node IDs
-                nodes = result.get("nodes", [])
-                for i, node in enumerate(nodes, 1):
-                    node["id"] = f"node_{i}"
-
-                print(f"Analysis complete. Found {len(nodes)} components.")
-                return result
-            else:
-                raise ValueError("No valid JSON found in response")
-
+        except ModelUnavailableError:
+            raise
         except Exception as e:
             print(f"Image analysis error: {str(e)}")
             return {
@@ -174,267 +601,375 @@ class SmartDocumentProcessor:
                 "edges": [],
             }
 
-    # Process a document using Gemini 2.0 Flash
-    async def analyze_with_gemini(self, text):
-        print("\nAnalyzing document content with Gemini 2.0 Flash...")
-
-        prompt = """Create a comprehensive workflow diagram that shows how different processes interact and flow within the system.  Only base it off information provided
-
-Key requirements:
-1. Process Identification:
-   - Identify major system processes
-   - Use clear, technical naming for processes (lowercase with underscores)
-   - Each process should have both a title and detailed description
-
-2. Process Details:
-   For each process, provide:
-   - Title: Short, technical name (e.g., 'data_integration', 'claims_processing')
-   - Description: 2-3 lines explaining key functionality
-   - Type: Either 'core' or 'support' process
-
-3. Flow Structure:
-   - Multiple processes can run in parallel
-   - Processes can converge or branch based on logic
-   - Show both primary and secondary workflows
-   - Include branching paths where relevant
-
-Return JSON in this format:
-{
-    "nodes": [
-        {
-            "id": "process_name",
-            "text": "Detailed description of functionality",
-            "type": "core"
-        }
-    ],
-    "edges": [
-        {
-            "from": "source_process",
-            "to": "target_process",
-            "label": "flow"
-        }
-    ]
-}
-
-Create a natural flow that allows for parallel processes and interconnected workflows."""
-
-        try:
-            print("Processing document...")
-            max_length = 100000  # Much higher limit for Gemini 2.0
-            if len(text) > max_length:
-                text = text[:max_length] + "..."
-                print(
-                    "Document truncated to fit model limits (but using much higher limit)"
+    # Call Gemini and read its reply. In streaming mode the response is consumed chunk by chunk
+    # and every node/edge is parsed (and handed to on_partial) as soon as it's complete.
+    # Returns (response_text, result): result is None when the reply still needs the regular parsing.
+    # Raises ModelUnavailableError when Gemini is out of quota or down even after retries
+    async def generate_workflow(self, contents, generation_config, on_partial=None):
+        if not self.streaming:
+            response_text = await self.llm.generate(contents, generation_config)
+            return response_text.strip(), None
+
+        parser = WorkflowStreamParser()
+
+        def on_chunk(text):
+            for kind, item in parser.feed(text):
+                if on_partial is not None:
+                    on_partial(kind, item)
+
+        response_text = (
+            await self.llm.generate(contents, generation_config, on_chunk=on_chunk)
+        ).strip()
+        # a coalesced duplicate never sees the chunks, it goes through the regular parsing
+        if parser.complete and parser.errors == 0 and parser.nodes:
+            return response_text, parser.result()
+        return response_text, None
+
+    # The one way a workflow is read from Gemini: parse the reply and validate it against the
+    # schema (see workflow_schema.py). An unreadable reply is asked for once more, and edges
+    # that point at unknown nodes are sent back on their own to be fixed, instead of the
+    # whole analysis failing and the user retrying the upload
+    async def request_validated_workflow(self, contents, generation_config, on_partial=None):
+        response_text, result = await self.generate_workflow(contents, generation_config, on_partial)
+        for attempt in range(self.schema_repairs + 1):
+            try:
+                workflow_data, dangling = validate_workflow(
+                    result if result is not None else parse_workflow_reply(response_text)
                 )
-
-            response = await self.model.generate_content_async(
-                prompt + "\n\nDocument text:\n" + text,
-                generation_config={"temperature": 0.3, "top_p": 0.8, "top_k": 40},
+                break
+            except ValueError as e:
+                if attempt == self.schema_repairs:
+                    raise
+                metrics.REPLY_REPAIRS.inc(kind="retry")
+                print(f"Unusable reply from Gemini ({e}), asking again...")
+                if isinstance(contents, str):
+                    retry = contents + "\n\n" + RETRY_NOTE
+                else:
+                    retry = list(contents) + [RETRY_NOTE]
+                response_text, result = await self.generate_workflow(retry, generation_config)
+
+        if dangling and self.schema_repairs:
+            workflow_data, dangling = await self.repair_edges(workflow_data, dangling, generation_config)
+        if dangling:
+            print(f"Dropped {len(dangling)} edges pointing at unknown nodes")
+        return workflow_data
+
+    # Ask Gemini to re-point edges whose endpoints aren't in the workflow, returns (workflow, still dangling).
+    # Whatever can't be fixed stays dropped, the rest of the workflow is kept either way
+    async def repair_edges(self, workflow_data, dangling, generation_config):
+        metrics.REPLY_REPAIRS.inc(kind="edges")
+        print(f"{len(dangling)} edges point at unknown nodes, asking Gemini to fix just those...")
+        prompt = REPAIR_EDGES_PROMPT.format(
+            nodes="\n".join(f"{node['id']}: {node['text'][:120]}" for node in workflow_data["nodes"]),
+            edges="\n".join(f"{edge['from']} -> {edge['to']} ({edge['label']})" for edge in dangling),
+        )
+        try:
+            response_text, result = await self.generate_workflow(prompt, generation_config)
+            fix = result if result is not None else parse_workflow_reply(response_text)
+            return validate_workflow(
+                {
+                    "nodes": workflow_data["nodes"] + list(fix.get("nodes") or []),
+                    "edges": workflow_data["edges"] + list(fix.get("edges") or []),
+                }
             )
+        except ModelUnavailableError:
+            raise
+        except Exception as e:
+            print(f"Could not repair edges: {str(e)}")
+            return workflow_data, dangling
+
+    # Send one piece of document text to Gemini and parse the workflow JSON it returns
+    async def request_workflow(self, text, part=None, on_partial=None):
+        prompt = DOCUMENT_PROMPT
+        if part is not None:
+            prompt += "\n\n" + CHUNK_PROMPT.format(part=part)
+
+        return await self.request_validated_workflow(
+            prompt + "\n\nDocument text:\n" + text,
+            DOCUMENT_GENERATION_CONFIG,
+            on_partial,
+        )
 
-            # Clean and parse response
-            response_text = response.text.strip()
-
-            # Find JSON in response
-            json_start = response_text.find("{")
-            json_end = response_text.rfind("}") + 1
-            if json_start >= 0 and json_end > json_start:
-                json_str = response_text[json_start:json_end]
-                result = json.loads(json_str)
-
-                # Update node IDs
-                nodes = result.get("nodes", [])
-                for i, node in enumerate(nodes, 1):
-                    node["id"] = f"node_{i}"
-
-                print(f"Analysis complete. Found {len(nodes)} components.")
+    # Scanned PDF pages have no text: rasterize them in the extraction pool and send them to
+    # Gemini as one multi-image request per batch. Like analyze_chunk, failure returns None
+    async def analyze_scanned_pages(self, source, page_indices, semaphore, on_partial=None):
+        first, last = page_indices[0] + 1, page_indices[-1] + 1
+        async with semaphore:
+            try:
+                images = await asyncio.get_running_loop().run_in_executor(
+                    get_extraction_pool(), rasterize_pdf_pages, source, page_indices
+                )
+                if not images:
+                    print(f"Scanned pages {first}-{last}: nothing to rasterize")
+                    return None
+                prompt = DOCUMENT_PROMPT + "\n\n" + SCANNED_PROMPT.format(first=first, last=last)
+                result = await self.request_validated_workflow(
+                    [prompt] + images,
+                    DOCUMENT_GENERATION_CONFIG,
+                    on_partial,
+                )
+                print(f"Scanned pages {first}-{last} done, {len(result.get('nodes', []))} components")
                 return result
-            else:
-                raise ValueError("No valid JSON found in response")
+            except ModelUnavailableError:
+                raise
+            except Exception as e:
+                print(f"Scanned pages {first}-{last} failed: {str(e)}")
+                return None
+
+    # Indices of PDF pages without extractable text, i.e. scans
+    def find_scanned_pages(self, pages, extension):
+        if extension != ".pdf" or not self.scan_fallback:
+            return []
+        return [i for i, page in enumerate(pages) if len(page.strip()) < MIN_PAGE_CHARS]
+
+    # One analysis task per batch of scanned pages
+    def start_scan_tasks(self, source, scanned, semaphore, on_partial=None):
+        size = self.scan_batch_pages
+        return [
+            asyncio.create_task(
+                self.analyze_scanned_pages(source, scanned[i:i + size], semaphore, on_partial)
+            )
+            for i in range(0, len(scanned), size)
+        ]
 
+    def report_compaction(self, stats):
+        saved = max(stats["tokens_before"] - stats["tokens_after"], 0)
+        metrics.TOKENS_SAVED.inc(saved)
+        metrics.note("compaction", f"{saved} tokens saved")
+        print(
+            f"Compacted text: ~{stats['tokens_before']} -> ~{stats['tokens_after']} tokens "
+            f"({saved} saved, {stats['sections_dropped']} sections dropped)"
+        )
+
+    # Analyze already-extracted text, plus the scanned pages of the PDF it came from (if any)
+    async def analyze_document(self, source, extension, text, on_partial=None):
+        pages = text.split(PAGE_SEPARATOR)
+        scanned = self.find_scanned_pages(pages, extension)
+        if self.compact_text or self.token_budget:
+            # CPU-bound on long documents, keep it off the shared loop
+            text, stats = await asyncio.to_thread(compact_pages, pages, self.token_budget)
+            self.report_compaction(stats)
+        if not scanned:
+            return await self.analyze_with_gemini(text, on_partial)
+
+        print(f"{len(scanned)} scanned pages, sending them through the vision path...")
+        semaphore = asyncio.Semaphore(self.chunk_concurrency)
+        chunks = split_into_chunks(text, self.chunk_chars, self.incremental)
+        tasks = [
+            asyncio.create_task(self.analyze_chunk(chunk, i, semaphore, on_partial))
+            for i, chunk in enumerate(chunks, 1)
+        ]
+        tasks += self.start_scan_tasks(source, scanned, semaphore, on_partial)
+        try:
+            result = await self.merge_chunk_results(tasks, chunks)
+            print(f"Analysis complete. Found {len(result['nodes'])} components.")
+            return result
+        except ModelUnavailableError:
+            raise
         except Exception as e:
             print(f"Analysis error: {str(e)}")
-            return {
-                "nodes": [
-                    {
-                        "id": "node1",
-                        "text": "Error analyzing document. Please try with a shorter text.",
-                        "type": "error",
-                    }
-                ],
-                "edges": [],
-            }
+            return document_error_workflow()
 
-    async def analyze_image_with_gemini(self, image_path):
-        """Process an image using Gemini 2.0 Flash"""
-        print("\nProcessing image with Gemini 2.0 Flash...")
+    # Cache key of a chunk's own analysis, None when incremental analysis is off.
+    # Only the text counts, not its position, so a chunk that moved is still found
+    def section_key(self, chunk, kind="section"):
+        if not (self.incremental and self.cache):
+            return None
+        return cache_key(hash_bytes(chunk.encode("utf-8")), f"{DOCUMENT_ANALYSIS_VERSION}:{kind}")
+
+    # Analyze one chunk of a long document, a failed chunk returns None instead of sinking the document.
+    # A chunk analyzed before (e.g. in the previous version of this document) is reused as it was
+    async def analyze_chunk(self, chunk, index, semaphore, on_partial=None):
+        key = self.section_key(chunk)
+        if key:
+            cached = await asyncio.to_thread(self.cache.get_json, "workflow", key)
+            if cached is not None:
+                metrics.SECTIONS.inc(result="reused")
+                print(f"Chunk {index} unchanged, reusing its analysis")
+                replay_partials(cached, on_partial)
+                return cached
+
+        async with semaphore:
+            try:
+                result = await self.request_workflow(chunk, part=index, on_partial=on_partial)
+                print(f"Chunk {index} done, {len(result.get('nodes', []))} components")
+                if key:
+                    metrics.SECTIONS.inc(result="analyzed")
+                    await asyncio.to_thread(self.cache.put_json, "workflow", key, result)
+                return result
+            except ModelUnavailableError:
+                raise
+            except Exception as e:
+                print(f"Chunk {index} failed: {str(e)}")
+                return None
+
+    # Wait for every chunk and merge the partial graphs into one workflow.
+    # With the chunks' texts the result is lined up with the previous version of the document
+    async def merge_chunk_results(self, tasks, chunks=()):
+        tasks = [asyncio.ensure_future(task) for task in tasks]
         try:
-            # Read and prepare the image
-            with Image.open(image_path) as img:
-                print(f"Image opened successfully: {img.size}, mode: {img.mode}")
-
-                # Convert to RGB if needed
-                if img.mode != "RGB":
-                    print(f"Converting image from {img.mode} to RGB")
-                    img = img.convert("RGB")
-
-                # Resize if the image is too large
-                max_size = (1024, 1024)
-                if img.size[0] > max_size[0] or img.size[1] > max_size[1]:
-                    img.thumbnail(max_size, Image.LANCZOS)
-                    print(f"Resized image to: {img.size}")
-
-                # Save to bytes - using BytesIO
-                img_byte_arr = io.BytesIO()
-                img.save(img_byte_arr, format="PNG", optimize=True, quality=85)
-                img_byte_arr.seek(0)  # Important: reset the pointer to the start
-                img_data = {"mime_type": "image/png", "data": img_byte_arr.getvalue()}
-
-            # Enhanced prompt for better image analysis
-            prompt = """Analyze this image in detail and create a comprehensive workflow diagram. Break down the analysis into clear steps:
-
-            1. Initial Visual Analysis:
-            - Identify all visual elements (shapes, text, icons, etc.)
-            - Note their positions and relationships
-            - Identify any color coding or visual hierarchies
-            - Look for arrows, lines, or other connection indicators
-            
-            2. Workflow Components:
-            - Break down the image into distinct process steps or components
-            - Identify any parallel processes or decision points
-            - Note any start/end points or key milestones
-            - Identify any conditional flows or branches
-            
-            3. Process Classification:
-            - Categorize each component (input, process, decision, output, etc.)
-            - Identify primary vs. supporting processes
-            - Note any dependencies between components
-            - Identify process boundaries and interfaces
-            
-            4. Data and Information Flow:
-            - Track how information or data moves between components
-            - Identify input/output relationships
-            - Note any feedback loops or cyclic processes
-            - Identify any data transformation points
-
-            Convert your analysis into this specific JSON format:
-            {
-                "nodes": [
-                    {
-                        "id": "unique_process_name",
-                        "text": "Detailed description of what this component does and its role in the workflow",
-                        "type": "core"
-                    }
-                ],
-                "edges": [
-                    {
-                        "from": "source_process_name",
-                        "to": "target_process_name",
-                        "label": "describes the nature of this connection"
-                    }
-                ]
-            }
-
-            Requirements for the output:
-            1. Each node must have a unique, descriptive ID
-            2. Node descriptions should be clear and detailed
-            3. All connections must reference valid node IDs
-            4. Edge labels should describe the nature of the connection
-            5. Use "core" or "support" for node types
-
-            If you can't identify specific components, create logical groupings based on visual elements and their apparent relationships."""
+            partials = await asyncio.gather(*tasks)
+        except BaseException:
+            # Gemini is unavailable (or we were cancelled), the other chunks are wasted calls
+            for task in tasks:
+                task.cancel()
+            raise
+        partials = [p for p in partials if p]
+        if not partials:
+            raise ValueError("None of the document chunks could be analyzed")
+        result = merge_workflows(partials)
+        if chunks and self.section_key(chunks[0]):
+            # a handful of cache reads and writes, done off the loop
+            result = await asyncio.to_thread(self.follow_previous_version, result, chunks)
+        return result
+
+    # Keep the node IDs and order of the last version of this document. It's found through any
+    # chunk it shares with this one: every chunk points at the latest merged workflow it was part of
+    def follow_previous_version(self, workflow_data, chunks):
+        pointers = [self.section_key(chunk, "latest") for chunk in chunks]
+        version_key = cache_key(":".join(pointers), f"{DOCUMENT_ANALYSIS_VERSION}:document")
+        for pointer in pointers:
+            previous_key = self.cache.get_text(pointer)
+            previous = self.cache.get_json("workflow", previous_key) if previous_key else None
+            if previous is not None:
+                workflow_data = stabilize_ids(workflow_data, previous)
+                print("Kept node IDs and order from the previous version of this document")
+                break
+
+        self.cache.put_json("workflow", version_key, workflow_data)
+        for pointer in pointers:
+            self.cache.put_text(pointer, version_key)
+        return workflow_data
+
+    # Map-reduce for long documents: analyze every chunk concurrently (bounded), then merge the graphs
+    async def analyze_in_chunks(self, text, on_partial=None):
+        chunks = split_into_chunks(text, self.chunk_chars, self.incremental)
+        print(f"Document is {len(text)} characters, analyzing {len(chunks)} chunks in parallel...")
+        semaphore = asyncio.Semaphore(self.chunk_concurrency)
+        return await self.merge_chunk_results(
+            [
+                self.analyze_chunk(chunk, i, semaphore, on_partial)
+                for i, chunk in enumerate(chunks, 1)
+            ],
+            chunks,
+        )
 
-            try:
-                print("Sending request to Gemini...")
-                response = (
-                    await self.model.generate_content_async(  # Changed to self.model
-                        contents=[
-                            prompt,
-                            img_data,
-                        ],  # Pass as a list with img_data dictionary
-                        generation_config={
-                            "temperature": 0.3,
-                            "top_p": 0.8,
-                            "top_k": 40,
-                            "max_output_tokens": 2048,
-                        },
-                    )
+    # Extract and analyze at the same time: chunks are sent to Gemini as soon as enough
+    # pages have arrived, so a long PDF starts analyzing before its last page is read.
+    # Returns (text, workflow_data).
+    async def extract_and_analyze(self, source, extension=None, on_stage=None, on_partial=None):
+        pages = []
+        compacted = []  # the same pages cleaned up, this is what gets analyzed
+        compactor = PageCompactor() if self.compact_text else None
+        # a budget is spent across the whole document, so analysis has to wait for all of it
+        budgeted = bool(self.token_budget)
+        packer = ChunkPacker(self.chunk_chars, self.incremental)
+        semaphore = asyncio.Semaphore(self.chunk_concurrency)
+        tasks = []
+        chunks = []
+
+        def start_chunk(chunk):
+            if not tasks:
+                report_stage(on_stage, "analyzing")
+                print("Document is long, analyzing chunks while extraction continues...")
+            chunks.append(chunk)
+            tasks.append(
+                asyncio.create_task(
+                    self.analyze_chunk(chunk, len(tasks) + 1, semaphore, on_partial)
                 )
+            )
 
-                if not response or not response.text:
-                    raise ValueError("Empty response from Gemini")
-
-                print("\n=== Gemini's Complete Response ===")
-                print(response.text)
-                print("\n=== End of Gemini's Response ===\n")
-                print("Successfully received response from Gemini")
+        try:
+            with metrics.span("extract"):
+                async for page in self.stream_pages(source, extension):
+                    pages.append(page)
+                    if budgeted:
+                        continue
+                    cleaned = compactor.add(page) if compactor else page
+                    compacted.append(cleaned)
+                    for chunk in packer.add(cleaned):
+                        start_chunk(chunk)
+        except Exception:
+            for task in tasks:
+                task.cancel()
+            raise
+
+        text = PAGE_SEPARATOR.join(pages)
+        print(f"Extracted {len(text)} characters")
+        if budgeted:
+            report_stage(on_stage, "analyzing")
+            return text, await self.analyze_document(source, extension, text, on_partial)
+        if compactor:
+            self.report_compaction(
+                {
+                    "tokens_before": compactor.tokens_before,
+                    "tokens_after": compactor.tokens_after,
+                    "sections_dropped": 0,
+                }
+            )
+        scanned = self.find_scanned_pages(pages, extension)
+
+        # Never filled a chunk: short document, one request is enough
+        if not tasks and not scanned:
+            report_stage(on_stage, "analyzing")
+            return text, await self.analyze_with_gemini(PAGE_SEPARATOR.join(compacted), on_partial)
+
+        for chunk in packer.flush():
+            start_chunk(chunk)
+        if scanned:
+            if not tasks:
+                report_stage(on_stage, "analyzing")
+            print(f"{len(scanned)} scanned pages, sending them through the vision path...")
+            tasks += self.start_scan_tasks(source, scanned, semaphore, on_partial)
+        try:
+            workflow_data = await self.merge_chunk_results(tasks, chunks)
+            print(f"Analysis complete. Found {len(workflow_data['nodes'])} components.")
+        except ModelUnavailableError:
+            raise
+        except Exception as e:
+            print(f"Analysis error: {str(e)}")
+            workflow_data = document_error_workflow()
+        return text, workflow_data
 
-            except Exception as api_error:
-                print(f"Gemini API error: {str(api_error)}")
-                raise
+    # Process a document using Gemini 2.0 Flash
+    async def analyze_with_gemini(self, text, on_partial=None):
+        print("\nAnalyzing document content with Gemini 2.0 Flash...")
 
-            # Process response
-            response_text = response.text.strip()
+        try:
+            print("Processing document...")
+            if len(text) > self.chunk_chars:
+                result = await self.analyze_in_chunks(text, on_partial)
+                print(f"Analysis complete. Found {len(result['nodes'])} components.")
+                return result
 
-            # Improved JSON extraction
-            try:
-                # Find JSON in response
-                json_start = response_text.find("{")
-                json_end = response_text.rfind("}") + 1
-
-                if json_start >= 0 and json_end > json_start:
-                    json_str = response_text[json_start:json_end]
-                    print("\n=== Extracted JSON ===")
-                    print(json_str)
-                    print("\n=== End of JSON ===\n")
-
-                    try:
-                        result = json.loads(json_str)
-                    except json.JSONDecodeError:
-                        print(
-                            "Initial JSON parsing failed, attempting to clean the JSON string..."
-                        )
-                        # Clean JSON string
-                        json_str = json_str.replace("'", '"')
-                        json_str = json_str.replace("\n", " ")
-                        result = json.loads(json_str)
-
-                    # Update node IDs
-                    nodes = result.get("nodes", [])
-                    for i, node in enumerate(nodes, 1):
-                        node["id"] = f"node_{i}"
-
-                    print(f"Analysis complete. Found {len(nodes)} components.")
-                    return result
-                else:
-                    print("No JSON found in response, creating basic structure...")
-                    # Create a basic structure from the text response
-                    result = {
-                        "nodes": [
-                            {
-                                "id": "node_1",
-                                "text": response_text[:500],
-                                "type": "core",
-                            }
-                        ],
-                        "edges": [],
-                    }
-                    return result
+            result = await self.request_workflow(text, on_partial=on_partial)
+            print(f"Analysis complete. Found {len(result['nodes'])} components.")
+            return result
 
-            except Exception as json_error:
-                print(f"JSON processing error: {str(json_error)}")
-                traceback.print_exc()  # Print the full traceback
-                return {
-                    "nodes": [
-                        {
-                            "id": "error_node",
-                            "text": f"Error processing response: {str(json_error)}. Please try again.",
-                            "type": "error",
-                        }
-                    ],
-                    "edges": [],
-                }
+        except ModelUnavailableError:
+            raise  # no point rendering an error diagram, the caller should retry later
+        except Exception as e:
+            print(f"Analysis error: {str(e)}")
+            return document_error_workflow()
 
+    async def analyze_image_with_gemini(self, image, on_partial=None):
+        """Process an image (path or bytes) using Gemini 2.0 Flash"""
+        print("\nProcessing image with Gemini 2.0 Flash...")
+        try:
+            # Decoding, resizing and re-encoding are CPU work, keep them off the event loop.
+            # Compliant uploads are sent as-is, photos as JPEG and line art as PNG (see image_prep.py)
+            img_data = await asyncio.to_thread(prepare_image, image)
+
+            print("Sending request to Gemini...")
+            result = await self.request_validated_workflow(
+                [IMAGE_PROMPT, img_data],
+                IMAGE_GENERATION_CONFIG,
+                on_partial,
+            )
+            print(f"Analysis complete. Found {len(result['nodes'])} components.")
+            return result
+        except ModelUnavailableError:
+            raise
         except Exception as e:
             print(f"Image analysis error (Detailed): {str(e)}")
             print(f"Error type: {type(e)}")
@@ -503,58 +1038,103 @@ Create a natural flow that allows for parallel processes and interconnected work
 
         return "\n".join(mermaid)
 
-    # Generate PNG image from Mermaid code
-    def generate_image(self, mmd_file):
-        print("\nGenerating PNG image...")
-        png_file = os.path.join(self.temp_dir, "workflow.png")
-
+    # Render with the warm worker pool, returns False if the pool isn't available or failed
+    def render_with_pool(self, mmd_file, output_file, fmt="png"):
+        pool = get_render_pool()
+        if pool is None:
+            return False
         try:
-            if platform.system() == "Darwin":  # macOS
-                command = [
-                    "npx",
-                    "@mermaid-js/mermaid-cli",
-                    "mmdc",
-                    "-i",
-                    mmd_file,
-                    "-o",
-                    png_file,
-                    "-b",
-                    "transparent",
-                    "-s",
-                    "2",
-                ]
-            else:  # Windows (reverting to the working version)
-                command = [
-                    "npx.cmd" if platform.system() == "Windows" else "npx",
-                    "@mermaid-js/mermaid-cli",
-                    "-i",
-                    mmd_file,
-                    "-o",
-                    png_file,
-                    "-b",
-                    "transparent",
-                    "-s",
-                    "2",
-                ]
+            with open(mmd_file, "r", encoding="utf-8") as f:
+                rendered = pool.render(f.read(), fmt=fmt, scale=2)
+            write_output(output_file, rendered)
+            return True
+        except Exception as e:
+            print(f"Render pool failed ({e}), falling back to mermaid-cli")
+            return False
+
+    # Render by spawning mermaid-cli through npx (slow, a fresh browser per diagram).
+    # mmdc picks PNG or SVG from the output file's extension
+    def render_with_cli(self, mmd_file, png_file):
+        if platform.system() == "Darwin":  # macOS
+            command = [
+                "npx",
+                "@mermaid-js/mermaid-cli",
+                "mmdc",
+                "-i",
+                mmd_file,
+                "-o",
+                png_file,
+                "-b",
+                "transparent",
+                "-s",
+                "2",
+            ]
+        else:  # Windows (reverting to the working version)
+            command = [
+                "npx.cmd" if platform.system() == "Windows" else "npx",
+                "@mermaid-js/mermaid-cli",
+                "-i",
+                mmd_file,
+                "-o",
+                png_file,
+                "-b",
+                "transparent",
+                "-s",
+                "2",
+            ]
+
+        env = os.environ.copy()
+        env["NODE_OPTIONS"] = "--no-warnings"
+
+        result = subprocess.run(
+            command, check=True, capture_output=True, text=True, env=env
+        )
 
-            env = os.environ.copy()
-            env["NODE_OPTIONS"] = "--no-warnings"
+        if result.stderr:
+            print("Command output:", result.stderr)
+
+        # mmdc has exited, make sure what it wrote is on disk before the path is handed out
+        if os.path.exists(png_file):
+            with open(png_file, "rb+") as f:
+                os.fsync(f.fileno())
+
+    # Open the generated diagram in the desktop image viewer
+    def open_image(self, png_file):
+        print(f"Opening generated image: {png_file}")
+        if platform.system() == "Darwin":  # macOS
+            subprocess.run(["open", png_file])
+        elif platform.system() == "Windows":
+            os.startfile(png_file)
+        else:  # Linux
+            subprocess.run(["xdg-open", png_file])
+
+    # Generate a PNG (or SVG) straight from workflow_data with the in-process layout renderer (no Node, no browser)
+    def generate_native_image(self, workflow_data, png_file, fmt="png"):
+        print(f"\nGenerating {fmt.upper()} image (native renderer)...")
+        try:
+            rendered = render_workflow(workflow_data, fmt=fmt, scale=2)
+            write_output(png_file, rendered)
+            if not self.headless:
+                self.open_image(png_file)
+            return png_file
+        except Exception as e:
+            print(f"Error generating image: {str(e)}")
+            return None
 
-            result = subprocess.run(
-                command, check=True, capture_output=True, text=True, env=env
-            )
+    # Generate a PNG (or SVG) image from Mermaid code
+    def generate_image(self, mmd_file, png_file=None, fmt="png"):
+        print(f"\nGenerating {fmt.upper()} image...")
+        if png_file is None:
+            # write next to the .mmd source so each job keeps its own output
+            png_file = os.path.join(os.path.dirname(mmd_file), OUTPUT_FORMATS[fmt][1])
 
-            if result.stderr:
-                print("Command output:", result.stderr)
+        try:
+            if not self.render_with_pool(mmd_file, png_file, fmt):
+                self.render_with_cli(mmd_file, png_file)
 
             if os.path.exists(png_file):
-                print(f"Opening generated image: {png_file}")
-                if platform.system() == "Darwin":  # macOS
-                    subprocess.run(["open", png_file])
-                elif platform.system() == "Windows":
-                    os.startfile(png_file)
-                else:  # Linux
-                    subprocess.run(["xdg-open", png_file])
+                if not self.headless:
+                    self.open_image(png_file)
                 return png_file
             else:
                 raise FileNotFoundError("PNG file was not generated")
@@ -570,42 +1150,252 @@ Create a natural flow that allows for parallel processes and interconnected work
             )
             return None
 
-    # Main processing function, it will call the other functions to process the document
-    async def process(self):
+    # The server passes the upload in explicitly: `data` holds the bytes of small uploads (with
+    # `filename` as the type hint), larger ones were spilled to disk and come in as `file_path`.
+    # job_dir keeps each request's outputs apart. With nothing given (CLI usage) we fall back
+    # to the latest file in temp/. renderer picks "mermaid" (mmdc, high fidelity) or "native" (in-process)
+    # on_partial gets ("node", {...}) / ("edge", {...}) as soon as the model has produced each one.
+    # extract_in_pool extracts the whole document in one pool worker (batches, see process_batch).
+    # timings (a metrics.RequestTimings) collects how long each stage of this request took.
+    # output is one of OUTPUT_FORMATS: "json" and "mermaid" stop before anything is rendered,
+    # "svg" uses the in-process renderer unless renderer="mermaid" is asked for.
+    # Returns the path of the output file
+    async def process(
+        self,
+        file_path=None,
+        job_dir=None,
+        on_stage=None,
+        data=None,
+        filename=None,
+        renderer=None,
+        on_partial=None,
+        extract_in_pool=False,
+        timings=None,
+        output="png",
+    ):
+        output_file = None
+        metrics.set_request_timings(timings)
         try:
             print("\n=== Starting Processing ===")
             start_time = time.time()
 
-            file_path = self.get_latest_file()
-            extension = Path(file_path).suffix.lower()
+            if data is None and file_path is None:
+                file_path = self.get_latest_file()
+            if job_dir is None:
+                job_dir = self.temp_dir
+            os.makedirs(job_dir, exist_ok=True)
+            source = data if data is not None else file_path
+            renderer = renderer or ("native" if output == "svg" else self.default_renderer)
+            extension = Path(filename or file_path).suffix.lower()
+            is_image = extension in [".png", ".jpg", ".jpeg"]
+            output_path = os.path.join(job_dir, OUTPUT_FORMATS[output][1])
+            renders = output in ("png", "svg")
+
+            # Everything we cache is keyed on the upload's bytes plus the version of whatever produced it
+            file_hash = None
+            if self.cache:
+                # hashing a big upload takes a while, don't hold up other requests on the loop
+                file_hash = await asyncio.to_thread(
+                    hash_bytes if is_in_memory(source) else hash_file, source
+                )
+            analysis_version = (
+                IMAGE_ANALYSIS_VERSION if is_image else self.document_analysis_version
+            )
 
-            # Check if it's an image file
-            if extension in [".png", ".jpg", ".jpeg"]:
-                workflow_data = await self.analyze_image_with_gemini(file_path)
-            else:
-                # Original document processing path
-                text = self.extract_text(file_path)
-                workflow_data = await self.analyze_with_gemini(text)
+            # Rendered diagrams are cached per renderer and format, SVGs go in the "png" tier too
+            def rendered_key(content_hash):
+                suffix = "" if output == "png" else f":{output}"
+                return cache_key(
+                    content_hash, f"{analysis_version}:{RENDER_VERSION}:{renderer}{suffix}"
+                )
 
-            mermaid_code = self.generate_mermaid(workflow_data)
-            mmd_path = os.path.join(self.temp_dir, "workflow.mmd")
+            # Final diagram already rendered for this exact file? then we're done.
+            # Cache and output file I/O goes to threads, the loop is shared by every request
+            if self.cache and renders:
+                rendered = await asyncio.to_thread(self.cache.get, "png", rendered_key(file_hash))
+                if rendered is not None:
+                    metrics.note("cache", f"{output} hit")
+                    await asyncio.to_thread(write_output, output_path, rendered)
+                    print(f"\nCache hit, reusing diagram ({time.time() - start_time:.3f} seconds)")
+                    return output_path
+
+            workflow_data = None
+            if self.cache:
+                workflow_key = cache_key(file_hash, analysis_version)
+                workflow_data = await asyncio.to_thread(self.cache.get_json, "workflow", workflow_key)
+                if workflow_data is not None:
+                    metrics.note("cache", "workflow hit")
+
+            # A retake of a recent capture (same page, different noise and framing) reuses its result
+            image_phash = None
+            if workflow_data is None and is_image and self.phash_index:
+                try:
+                    image_phash = await asyncio.to_thread(image_hash, source)
+                except Exception as e:
+                    print(f"Could not hash image: {e}")
+                if image_phash is not None:
+                    match = self.phash_index.find(image_phash, analysis_version)
+                    if match is not None:
+                        similar_hash, distance = match
+                        rendered = None
+                        if renders:
+                            rendered = await asyncio.to_thread(
+                                self.cache.get, "png", rendered_key(similar_hash)
+                            )
+                        if rendered is not None:
+                            metrics.note("cache", f"similar {output} hit, distance {distance}")
+                            await asyncio.to_thread(write_output, output_path, rendered)
+                            print(f"\nNear-duplicate of a recent capture (distance {distance}), reusing diagram")
+                            return output_path
+                        workflow_data = await asyncio.to_thread(
+                            self.cache.get_json, "workflow", cache_key(similar_hash, analysis_version)
+                        )
+                        if workflow_data is not None:
+                            metrics.note("cache", f"similar workflow hit, distance {distance}")
+                            print(f"\nNear-duplicate of a recent capture (distance {distance}), reusing workflow")
+
+            if workflow_data is None:
+                # Check if it's an image file
+                if is_image:
+                    report_stage(on_stage, "analyzing")
+                    workflow_data = await self.analyze_image_with_gemini(source, on_partial)
+                else:
+                    # Original document processing path
+                    text = None
+                    if self.cache:
+                        text_key = cache_key(file_hash, EXTRACT_VERSION)
+                        text = await asyncio.to_thread(self.cache.get_text, text_key)
+                        if text is not None:
+                            metrics.note("cache", "text hit")
+                    if text is None and extract_in_pool:
+                        report_stage(on_stage, "extracting")
+                        with metrics.span("extract"):
+                            text = await asyncio.get_running_loop().run_in_executor(
+                                get_extraction_pool(), extract_document, source, extension
+                            )
+                        report_stage(on_stage, "analyzing")
+                        workflow_data = await self.analyze_document(
+                            source, extension, text, on_partial
+                        )
+                        if self.cache:
+                            await asyncio.to_thread(self.cache.put_text, text_key, text)
+                    elif text is None:
+                        report_stage(on_stage, "extracting")
+                        # extraction runs off the loop, and long documents start analyzing before it finishes
+                        text, workflow_data = await self.extract_and_analyze(
+                            source, extension, on_stage, on_partial
+                        )
+                        if self.cache:
+                            await asyncio.to_thread(self.cache.put_text, text_key, text)
+                    else:
+                        report_stage(on_stage, "analyzing")
+                        workflow_data = await self.analyze_document(
+                            source, extension, text, on_partial
+                        )
 
-            with open(mmd_path, "w", encoding="utf-8") as f:
-                f.write(mermaid_code)
+                # error diagrams are never cached, the next upload should try again
+                if self.cache and not is_error_workflow(workflow_data):
+                    await asyncio.to_thread(self.cache.put_json, "workflow", workflow_key, workflow_data)
+                    if image_phash is not None:
+                        await asyncio.to_thread(
+                            self.phash_index.add, image_phash, file_hash, analysis_version
+                        )
 
-            png_file = self.generate_image(mmd_path)
+            # Consumers that only want the graph or its Mermaid source never wait for a renderer
+            if output == "json":
+                await asyncio.to_thread(
+                    write_output, output_path, json.dumps(workflow_data, indent=2).encode("utf-8")
+                )
+                output_file = output_path
+            elif output == "mermaid":
+                with metrics.span("mermaid"):
+                    mermaid_code = self.generate_mermaid(workflow_data)
+                await asyncio.to_thread(write_output, output_path, mermaid_code.encode("utf-8"))
+                output_file = output_path
+            else:
+                report_stage(on_stage, "rendering")
+                if renderer == "native":
+                    with metrics.span("render"):
+                        output_file = await asyncio.to_thread(
+                            self.generate_native_image, workflow_data, output_path, output
+                        )
+                else:
+                    with metrics.span("mermaid"):
+                        mermaid_code = self.generate_mermaid(workflow_data)
+                    mmd_path = os.path.join(job_dir, "workflow.mmd")
+                    await asyncio.to_thread(Path(mmd_path).write_text, mermaid_code, encoding="utf-8")
+
+                    with metrics.span("render"):
+                        output_file = await asyncio.to_thread(
+                            self.generate_image, mmd_path, output_path, output
+                        )
 
-            if png_file:
-                print(f"\nWorkflow diagram saved as: {png_file}")
+                if output_file and self.cache and not is_error_workflow(workflow_data):
+                    key = rendered_key(file_hash)
+                    await asyncio.to_thread(
+                        lambda: self.cache.put("png", key, Path(output_file).read_bytes())
+                    )
+
+            if output_file:
+                print(f"\nWorkflow {output} saved as: {output_file}")
 
             print(f"\nTotal processing time: {time.time() - start_time:.2f} seconds")
 
+        except ModelUnavailableError as e:
+            print(f"\nGemini unavailable: {str(e)}")
+            raise
         except Exception as e:
             print(f"\nError occurred: {str(e)}")
-        finally:
-            self._cleanup()
+
+        return output_file
+
+    # Process many uploads at once. At most `concurrency` files are in the pipeline at a time:
+    # their extraction runs in the process pool, Gemini calls share the processor-wide limit and
+    # renders go to the render pool. items are process() keyword arguments (data/file_path + filename).
+    # Returns one result per item, in order: {"index", "filename", "output_file", "error", "seconds"}
+    async def process_batch(
+        self, items, batch_dir, concurrency=None, renderer=None, output="png"
+    ):
+        semaphore = asyncio.Semaphore(concurrency or self.batch_concurrency)
+
+        async def run_one(index, item):
+            async with semaphore:
+                started = time.time()
+                output_file = None
+                error = None
+                try:
+                    output_file = await self.process(
+                        job_dir=os.path.join(batch_dir, f"{index:04d}"),
+                        renderer=renderer,
+                        output=output,
+                        extract_in_pool=True,
+                        **item,
+                    )
+                    if not output_file:
+                        error = "Failed to generate diagram"
+                except Exception as e:
+                    error = str(e)
+                return {
+                    "index": index,
+                    "filename": item.get("filename") or os.path.basename(item["file_path"]),
+                    "output_file": output_file,
+                    "error": error,
+                    "seconds": round(time.time() - started, 3),
+                }
+
+        print(f"\n=== Processing batch of {len(items)} files ===")
+        start_time = time.time()
+        results = await asyncio.gather(
+            *(run_one(index, item) for index, item in enumerate(items, 1))
+        )
+        failed = sum(1 for result in results if result["error"])
+        print(
+            f"\nBatch done: {len(results) - failed} ok, {failed} failed "
+            f"in {time.time() - start_time:.2f} seconds"
+        )
+        return results
 
 
 if __name__ == "__main__":
-    processor = SmartDocumentProcessor()  # we create a new instance of the processor
+    processor = SmartDocumentProcessor(headless=False)  # we create a new instance of the processor, previewing results
     asyncio.run(processor.process())  # then we run the process function
@@ -0,0 +1,144 @@
+import io
+import os
+import math
+import json
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageOps
+
+
+# Captures whose hashes differ in at most this many of the 64 bits are treated as the same
+# picture. Sensor noise and slightly different framing stay around 2-4 bits. Kept low on
+# purpose: diagrams look alike, and a false match hands back another page's result.
+# -1 turns near-duplicate matching off
+MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "6"))
+# How many recent captures are remembered
+RECENT_CAPTURES = int(os.getenv("PHASH_RECENT", "512"))
+
+SAMPLE_SIZE = 32  # the image is reduced to this many pixels square before hashing
+HASH_SIZE = 8  # of which the lowest 8x8 frequencies are kept
+
+# DCT-II basis for the lowest frequencies only, the rest is never looked at
+_COSINES = [
+    [math.cos(math.pi * (2 * x + 1) * u / (2 * SAMPLE_SIZE)) for x in range(SAMPLE_SIZE)]
+    for u in range(HASH_SIZE)
+]
+
+
+# pHash: reduce to 32x32 greyscale, take the 8x8 lowest frequencies of its DCT and set a bit
+# for every coefficient above their median. Only the coarse layout of light and dark
+# survives, which noise, recompression and small shifts barely touch. Returns a 64-bit int
+def phash(image):
+    small = image.convert("L").resize((SAMPLE_SIZE, SAMPLE_SIZE), Image.BOX)
+    pixels = small.tobytes()
+    rows = [pixels[i : i + SAMPLE_SIZE] for i in range(0, SAMPLE_SIZE * SAMPLE_SIZE, SAMPLE_SIZE)]
+    # separable 2D DCT: along each row, then down the columns of that result
+    partial = [[sum(c * p for c, p in zip(basis, row)) for basis in _COSINES] for row in rows]
+    coefficients = [
+        sum(basis[y] * partial[y][v] for y in range(SAMPLE_SIZE))
+        for basis in _COSINES
+        for v in range(HASH_SIZE)
+    ]
+    # the DC term is overall brightness, leave it out of the median
+    median = sorted(coefficients[1:])[(len(coefficients) - 1) // 2]
+    value = 0
+    for coefficient in coefficients:
+        value = (value << 1) | (coefficient > median)
+    return value
+
+
+# Perceptual hash of an upload (path or bytes). JPEGs are decoded at 1/8 size in draft mode,
+# the hash only looks at a 32x32 thumbnail anyway
+def image_hash(source):
+    in_memory = isinstance(source, (bytes, bytearray, memoryview))
+    with Image.open(io.BytesIO(source) if in_memory else source) as image:
+        if image.format == "JPEG":
+            image.draft("L", (64, 64))
+        image = ImageOps.exif_transpose(image)  # a rotated shot of the same page should still match
+        return phash(image)
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+# The last few captures' hashes, mapped to the content hash their results are cached under.
+# A linear scan over a few hundred ints is far cheaper than decoding the image, so no
+# BK-tree. Saved next to the result cache so it survives restarts
+class PerceptualIndex:
+    def __init__(self, path, max_entries=RECENT_CAPTURES, max_distance=MAX_DISTANCE):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (content hash, version) -> perceptual hash, oldest first
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for content_hash, version, value in json.load(f):
+                    self._entries[(content_hash, version)] = value
+        except FileNotFoundError:
+            pass
+        except (ValueError, TypeError) as e:
+            print(f"Ignoring unreadable perceptual hash index: {e}")
+
+    def _save(self):
+        data = [[content_hash, version, value] for (content_hash, version), value in self._entries.items()]
+        tmp_path = f"{self.path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    # Closest earlier capture analyzed under `version`, as (content hash, distance), or None
+    def find(self, value, version):
+        best = None
+        with self._lock:
+            for (content_hash, entry_version), entry_value in self._entries.items():
+                if entry_version != version:
+                    continue
+                distance = hamming(value, entry_value)
+                if distance <= self.max_distance and (best is None or distance < best[1]):
+                    best = (content_hash, distance)
+            if best is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end((best[0], version))
+        return best
+
+    def add(self, value, content_hash, version):
+        with self._lock:
+            self._entries.pop((content_hash, version), None)
+            self._entries[(content_hash, version)] = value
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            try:
+                self._save()
+            except OSError as e:
+                print(f"Could not save perceptual hash index: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+# Shared index for the process, None when the cache or near-duplicate matching is off
+def get_phash_index():
+    global _index
+    if os.getenv("CACHE_ENABLED", "1") == "0" or MAX_DISTANCE < 0:
+        return None
+    with _index_lock:
+        if _index is None:
+            root = os.getenv("CACHE_DIR", "cache")
+            os.makedirs(root, exist_ok=True)
+            _index = PerceptualIndex(os.path.join(root, "phash.json"))
+        return _index
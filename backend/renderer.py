@@ -0,0 +1,188 @@
+import os
+import json
+import base64
+import queue
+import shutil
+import atexit
+import threading
+import subprocess
+import itertools
+
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+WORKER_SCRIPT = os.path.join(BACKEND_DIR, "mermaid_worker.mjs")
+MERMAID_CLI_DIR = os.path.join(BACKEND_DIR, "node_modules", "@mermaid-js", "mermaid-cli")
+
+
+class RenderError(Exception):
+    """Mermaid rejected the diagram (bad syntax etc.), restarting won't help"""
+
+
+class WorkerCrashed(Exception):
+    """The Node worker died or stopped answering"""
+
+
+# One Node process with a warm headless browser, talking JSON lines over stdin/stdout
+class MermaidRenderWorker:
+    def __init__(self, startup_timeout=60):
+        self.startup_timeout = startup_timeout
+        self.proc = None
+        self._lines = None
+        self._ids = itertools.count(1)
+
+    def start(self):
+        env = os.environ.copy()
+        env["NODE_OPTIONS"] = "--no-warnings"
+        self.proc = subprocess.Popen(
+            ["node", WORKER_SCRIPT],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=BACKEND_DIR,
+            env=env,
+            text=True,
+            encoding="utf-8",
+            bufsize=1,
+        )
+
+        # A reader thread feeds stdout into a queue so we can wait on it with a timeout
+        self._lines = queue.Queue()
+        threading.Thread(
+            target=self._read_stdout, args=(self.proc, self._lines), daemon=True
+        ).start()
+
+        message = self._next_message(self.startup_timeout)
+        if not message.get("ready"):
+            self.stop()
+            raise WorkerCrashed("Renderer worker did not report ready")
+        print(f"Mermaid render worker started (pid {self.proc.pid})")
+
+    @staticmethod
+    def _read_stdout(proc, lines):
+        for line in proc.stdout:
+            lines.put(line)
+        lines.put(None)  # EOF, the process is gone
+
+    def _next_message(self, timeout):
+        try:
+            line = self._lines.get(timeout=timeout)
+        except queue.Empty:
+            raise WorkerCrashed(f"Renderer worker did not answer within {timeout}s")
+        if line is None:
+            raise WorkerCrashed("Renderer worker exited")
+        return json.loads(line)
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def stop(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=5)
+        except Exception:
+            self.proc.kill()
+        self.proc = None
+
+    def render(self, definition, fmt="png", scale=2, background="transparent", timeout=30):
+        request_id = next(self._ids)
+        request = {
+            "id": request_id,
+            "definition": definition,
+            "format": fmt,
+            "scale": scale,
+            "background": background,
+        }
+        try:
+            self.proc.stdin.write(json.dumps(request) + "\n")
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise WorkerCrashed(f"Could not send to renderer worker: {e}")
+
+        # Skip any stale answer left over from a request that timed out earlier
+        while True:
+            message = self._next_message(timeout)
+            if message.get("id") == request_id:
+                break
+
+        if not message.get("ok"):
+            raise RenderError(message.get("error", "Unknown render error"))
+        return base64.b64decode(message["data"])
+
+
+# A fixed set of warm workers, at most `size` renders run at once and crashed workers are replaced
+class MermaidRenderPool:
+    def __init__(self, size=2, timeout=30):
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+
+    @staticmethod
+    def available():
+        return (
+            shutil.which("node") is not None
+            and os.path.exists(WORKER_SCRIPT)
+            and os.path.isdir(MERMAID_CLI_DIR)
+        )
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            for _ in range(self.size):
+                worker = MermaidRenderWorker()
+                worker.start()
+                self._idle.put(worker)
+            self._started = True
+
+    def render(self, definition, fmt="png", scale=2, background="transparent"):
+        self.start()
+        # Blocks until a worker is free, which is what bounds concurrency
+        worker = self._idle.get()
+        try:
+            for attempt in range(2):
+                try:
+                    if not worker.alive():
+                        print("Render worker is down, restarting it...")
+                        worker.restart()
+                    return worker.render(definition, fmt, scale, background, self.timeout)
+                except WorkerCrashed as e:
+                    print(f"Render worker failed ({e}), restarting it...")
+                    worker.restart()
+            raise WorkerCrashed("Renderer worker failed twice in a row")
+        finally:
+            self._idle.put(worker)
+
+    def close(self):
+        with self._lock:
+            while not self._idle.empty():
+                self._idle.get_nowait().stop()
+            self._started = False
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+# Shared pool for the whole process, None when Node or mermaid-cli isn't installed locally
+def get_render_pool():
+    global _pool
+    if os.getenv("MERMAID_RENDERER", "pool") != "pool":
+        return None
+    with _pool_lock:
+        if _pool is None:
+            if not MermaidRenderPool.available():
+                return None
+            _pool = MermaidRenderPool(
+                size=int(os.getenv("MERMAID_POOL_SIZE", "2")),
+                timeout=int(os.getenv("MERMAID_RENDER_TIMEOUT", "30")),
+            )
+            atexit.register(_pool.close)
+        return _pool
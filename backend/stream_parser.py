@@ -0,0 +1,101 @@
+import json
+
+
+# Incremental parser for the {"nodes": [...], "edges": [...]} JSON Gemini returns.
+# Feed it response chunks as they arrive; every node or edge object is handed back
+# the moment its closing brace shows up, and each character is only scanned once.
+class WorkflowStreamParser:
+    TRACKED_KEYS = ("nodes", "edges")
+
+    def __init__(self):
+        self.nodes = []
+        self.edges = []
+        self.errors = 0  # items that were complete but not valid JSON
+        self.started = False  # seen the opening brace of the top-level object
+        self.complete = False  # seen its closing brace
+        self._buffer = ""
+        self._pos = 0  # next character of _buffer to scan
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._last_string = None  # last string closed at depth 1, i.e. the latest key
+        self._array_key = None  # "nodes"/"edges" while inside one of those arrays
+        self._item_start = None  # where the object currently being read starts
+
+    # Add the next piece of response text, returns [(kind, item), ...] for every completed node/edge
+    def feed(self, text):
+        self._buffer += text
+        found = []
+        buffer = self._buffer
+        i = self._pos
+
+        while i < len(buffer) and not self.complete:
+            char = buffer[i]
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._last_string = buffer[self._string_start + 1:i]
+            elif not self.started:
+                # skip any prose or ```json fence before the object
+                if char == "{":
+                    self.started = True
+                    self._depth = 1
+            elif char == '"':
+                self._in_string = True
+                self._string_start = i
+            elif char in "{[":
+                if char == "[" and self._depth == 1:
+                    key = self._last_string
+                    self._array_key = key if key in self.TRACKED_KEYS else None
+                elif char == "{" and self._depth == 2 and self._array_key:
+                    self._item_start = i
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if char == "}" and self._depth == 2 and self._item_start is not None:
+                    item = self._parse_item(buffer[self._item_start:i + 1])
+                    self._item_start = None
+                    if item is not None:
+                        kind = "node" if self._array_key == "nodes" else "edge"
+                        (self.nodes if kind == "node" else self.edges).append(item)
+                        found.append((kind, item))
+                elif char == "]" and self._depth == 1:
+                    self._array_key = None
+                elif self._depth == 0:
+                    self.complete = True
+            i += 1
+
+        # Forget what we've scanned unless we're in the middle of an item or a key
+        keep_from = i
+        if self._item_start is not None:
+            keep_from = min(keep_from, self._item_start)
+        if self._in_string and self._string_start is not None:
+            keep_from = min(keep_from, self._string_start)
+        self._buffer = buffer[keep_from:]
+        self._pos = i - keep_from
+        if self._item_start is not None:
+            self._item_start -= keep_from
+        if self._string_start is not None:
+            self._string_start -= keep_from
+        return found
+
+    def _parse_item(self, raw):
+        try:
+            return json.loads(raw)
+        except json.JSONDecodeError:
+            try:
+                # same clean-up the analyzers fall back to
+                return json.loads(raw.replace("'", '"').replace("\n", " "))
+            except json.JSONDecodeError:
+                self.errors += 1
+                return None
+
+    def result(self):
+        return {"nodes": self.nodes, "edges": self.edges}
@@ -0,0 +1,62 @@
+import io
+import json
+import asyncio
+
+from PIL import Image, ImageDraw
+
+import web_common
+
+WORKFLOW = {
+    "nodes": [
+        {"id": "submit", "text": "Customer submits the claim", "type": "core"},
+        {"id": "review", "text": "Adjuster reviews the claim", "type": "core"},
+    ],
+    "edges": [{"from": "submit", "to": "review", "label": "flow"}],
+}
+
+
+class Reply:
+    def __init__(self, text):
+        self.text = text
+
+    # the streamed form: the whole reply as one chunk
+    async def __aiter__(self):
+        yield self
+
+
+class FakeModel:
+    async def generate_content_async(self, contents, generation_config=None, stream=False):
+        return Reply(json.dumps(WORKFLOW))
+
+
+def diagram_png():
+    image = Image.new("RGB", (400, 300), "white")
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((20, 20, 180, 80), outline="black")
+    draw.rectangle((220, 200, 380, 260), outline="black")
+    draw.line((100, 80, 300, 200), fill="black")
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+# Uploads past UPLOAD_SPILL_BYTES are saved to the job directory before processing
+def test_spilled_upload_is_saved_and_processed(monkeypatch, tmp_path):
+    monkeypatch.setenv("CACHE_ENABLED", "0")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(web_common, "SPILL_THRESHOLD", 0)  # as with UPLOAD_SPILL_BYTES=0
+    import asgi
+    from quart.datastructures import FileStorage
+
+    monkeypatch.setattr(asgi.processor.llm, "model", FakeModel())
+
+    async def scenario():
+        async with asgi.app.test_app() as test_app:
+            client = test_app.test_client()
+            upload = FileStorage(io.BytesIO(diagram_png()), filename="diagram.png", content_type="image/png")
+            response = await client.post("/process-camera?format=json", files={"file": upload})
+            return response.status_code, await response.get_json()
+
+    status, body = asyncio.run(scenario())
+    assert status == 200, body
+    assert [node["text"] for node in body["nodes"]] == [node["text"] for node in WORKFLOW["nodes"]]
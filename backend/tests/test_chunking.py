@@ -0,0 +1,135 @@
+from chunking import merge_workflows, stabilize_ids
+
+
+def node(node_id, text, node_type="core"):
+    return {"id": node_id, "text": text, "type": node_type}
+
+
+def edge(source, target, label="flow"):
+    return {"from": source, "to": target, "label": label}
+
+
+NUMBERED = {
+    "nodes": [
+        node("process_1", "Customer submits the claim form online"),
+        node("process_2", "Intake team validates the attached documents"),
+        node("process_3", "Billing issues the payment to the customer"),
+    ],
+    "edges": [edge("process_1", "process_2"), edge("process_2", "process_3")],
+}
+
+
+def test_merge_keeps_numbered_nodes_of_one_partial_apart():
+    result = merge_workflows([NUMBERED])
+    assert [n["id"] for n in result["nodes"]] == ["process_1", "process_2", "process_3"]
+    assert [(e["from"], e["to"]) for e in result["edges"]] == [
+        ("process_1", "process_2"),
+        ("process_2", "process_3"),
+    ]
+
+
+def test_merge_combines_the_same_process_from_two_partials():
+    first = {
+        "nodes": [
+            node("claim_intake", "Customer submits the claim form"),
+            node("review", "Adjuster reviews the claim"),
+        ],
+        "edges": [edge("claim_intake", "review")],
+    }
+    second = {
+        "nodes": [
+            node("claims_intake", "Customer submits the claim form online"),
+            node("payment", "Billing pays the approved claim", "support"),
+        ],
+        "edges": [edge("claims_intake", "payment")],
+    }
+    result = merge_workflows([first, second])
+    assert [n["id"] for n in result["nodes"]] == ["claim_intake", "review", "payment"]
+    # the longer description wins
+    assert result["nodes"][0]["text"] == "Customer submits the claim form online"
+    assert [(e["from"], e["to"]) for e in result["edges"]] == [
+        ("claim_intake", "review"),
+        ("claim_intake", "payment"),
+    ]
+
+
+def test_merge_keeps_same_id_with_different_text_apart():
+    first = {"nodes": [node("node1", "Customer submits the claim form")], "edges": []}
+    second = {
+        "nodes": [node("node1", "Warehouse ships the replacement part"), node("node2", "Archive the record")],
+        "edges": [edge("node1", "node2")],
+    }
+    result = merge_workflows([first, second])
+    assert [n["id"] for n in result["nodes"]] == ["node1", "node1_2", "node2"]
+    assert [(e["from"], e["to"]) for e in result["edges"]] == [("node1_2", "node2")]
+
+
+def test_merge_skips_error_nodes_and_dangling_edges():
+    partial = {
+        "nodes": [node("a", "Step A"), node("oops", "Error analyzing document", "error")],
+        "edges": [edge("a", "oops"), edge("a", "missing")],
+    }
+    result = merge_workflows([partial])
+    assert [n["id"] for n in result["nodes"]] == ["a"]
+    assert result["edges"] == []
+
+
+def test_stabilize_does_not_remap_distinct_numbered_nodes():
+    result = stabilize_ids(NUMBERED, NUMBERED)
+    assert result == NUMBERED
+
+
+def test_stabilize_prefers_the_best_match():
+    previous = {
+        "nodes": [
+            node("process_1", "Customer submits the claim form online"),
+            node("process_2", "Intake team validates the attached documents"),
+        ],
+        "edges": [edge("process_1", "process_2")],
+    }
+    # same processes, listed the other way round and renumbered
+    current = {
+        "nodes": [
+            node("process_1", "Intake team validates the attached documents"),
+            node("process_2", "Customer submits the claim form online"),
+        ],
+        "edges": [edge("process_2", "process_1")],
+    }
+    result = stabilize_ids(current, previous)
+    assert result["nodes"] == previous["nodes"]
+    assert result["edges"] == previous["edges"]
+
+
+def test_stabilize_keeps_ids_and_order_and_appends_new_nodes():
+    previous = {
+        "nodes": [node("intake", "Receive the request"), node("approve", "Manager approves the request")],
+        "edges": [edge("intake", "approve")],
+    }
+    current = {
+        "nodes": [
+            node("notify", "Email the requester"),
+            node("approval", "Manager approves the request"),
+            node("intake", "Receive the request from the portal"),
+        ],
+        "edges": [edge("approval", "notify"), edge("intake", "approval")],
+    }
+    result = stabilize_ids(current, previous)
+    assert [n["id"] for n in result["nodes"]] == ["intake", "approve", "notify"]
+    assert [(e["from"], e["to"]) for e in result["edges"]] == [
+        ("intake", "approve"),
+        ("approve", "notify"),
+    ]
+
+
+def test_stabilize_renames_new_node_that_takes_a_matched_id():
+    previous = {"nodes": [node("review", "Adjuster reviews the claim")], "edges": []}
+    current = {
+        "nodes": [
+            node("claim_review", "Adjuster reviews the claim"),
+            node("review", "Legal reviews the contract terms"),
+        ],
+        "edges": [edge("claim_review", "review")],
+    }
+    result = stabilize_ids(current, previous)
+    assert [n["id"] for n in result["nodes"]] == ["review", "review_2"]
+    assert result["edges"] == [edge("review", "review_2")]
@@ -0,0 +1,33 @@
+import asyncio
+
+from llm_client import GeminiClient
+
+
+class SlowModel:
+    def __init__(self):
+        self.calls = 0
+
+    async def generate_content_async(self, contents, generation_config=None, stream=False):
+        self.calls += 1
+        reply = f"reply {self.calls}"
+        await asyncio.sleep(0.05)
+        return type("Reply", (), {"text": reply})()
+
+
+def test_duplicates_survive_the_first_caller_being_cancelled():
+    async def scenario():
+        model = SlowModel()
+        client = GeminiClient(model)
+        first = asyncio.create_task(client.generate("same prompt", {}))
+        await asyncio.sleep(0.01)
+        duplicates = [asyncio.create_task(client.generate("same prompt", {})) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        first.cancel()
+        results = await asyncio.gather(*duplicates)
+        return model, client, results
+
+    model, client, results = asyncio.run(scenario())
+    # one of the duplicates makes the call again, the others share it
+    assert results == ["reply 2"] * 3
+    assert model.calls == 2
+    assert client._in_flight == {}
@@ -0,0 +1,22 @@
+from perform import SmartDocumentProcessor
+from workflow_schema import validate_workflow
+
+
+def test_reserved_mermaid_ids_are_prefixed():
+    reply = {
+        "nodes": [
+            {"id": "review_claim", "text": "Review the claim", "type": "core"},
+            {"id": "End", "text": "Done", "type": "support"},
+        ],
+        "edges": [{"from": "Review_Claim", "to": "End", "label": "ok"}],
+    }
+    workflow, dangling = validate_workflow(reply)
+    assert [node["id"] for node in workflow["nodes"]] == ["review_claim", "node_end"]
+    assert workflow["edges"] == [{"from": "review_claim", "to": "node_end", "label": "ok"}]
+    assert dangling == []
+
+    # generate_mermaid doesn't touch the instance
+    mermaid = SmartDocumentProcessor.generate_mermaid(None, workflow).splitlines()
+    assert '    node_end["Done"]' in mermaid
+    assert "    class node_end support" in mermaid
+    assert not any(line.split()[-1:] == ["end"] for line in mermaid)
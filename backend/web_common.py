@@ -0,0 +1,163 @@
+import os
+import json
+import uuid
+import shutil
+import traceback
+
+from perform import RENDERERS, OUTPUT_FORMATS, negotiate_output
+from llm_client import ModelUnavailableError
+from jobs import JobManager
+import metrics
+
+# What the Flask server (app.py) and the ASGI server (asgi.py) share: settings, option parsing,
+# upload bookkeeping, error responses and the job manager. Nothing here reads a framework's
+# request object, the servers pass in what they took from it
+
+TEMP_DIR = "temp"
+
+# Uploads up to this size are processed straight from memory, bigger ones are spilled to disk
+SPILL_THRESHOLD = int(os.getenv("UPLOAD_SPILL_BYTES", str(8 * 1024 * 1024)))
+
+# Most files (after unpacking archives) one batch request may contain
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "200"))
+
+# Send a Server-Timing header with the per-stage timings of each request (SERVER_TIMING=0 turns it off)
+SERVER_TIMING = os.getenv("SERVER_TIMING", "1") == "1"
+
+# Content type of each output file process() writes, by file name
+RESULT_TYPES = {filename: mimetype for mimetype, filename in OUTPUT_FORMATS.values()}
+
+
+# Record a finished request's latency and add its Server-Timing header
+def record_timings(timings, endpoint, headers):
+    if timings is None or endpoint == "prometheus_metrics":
+        return
+    metrics.REQUEST_SECONDS.observe(timings.elapsed(), endpoint=endpoint or "unknown")
+    if SERVER_TIMING:
+        headers["Server-Timing"] = timings.header()
+
+
+# Give an upload its own job directory so concurrent requests never touch each other's files.
+# Returns the job ID and the directory
+def new_job_dir():
+    job_id = uuid.uuid4().hex
+    job_dir = os.path.join(TEMP_DIR, job_id)
+    os.makedirs(job_dir, exist_ok=True)
+    return job_id, job_dir
+
+
+# Whether an upload of `size` bytes (the request's Content-Length, None when unknown) stays in memory
+def keep_in_memory(size):
+    return size is not None and size <= SPILL_THRESHOLD
+
+
+# The process() arguments for an upload read into memory
+def memory_upload(job_id, filename, data):
+    metrics.UPLOAD_BYTES.observe(len(data))
+    print(f"Received {filename} in memory ({len(data)} bytes, job {job_id})")
+    return {"data": data, "filename": filename}
+
+
+# The process() arguments for an upload saved to the job directory
+def saved_upload(job_id, file_path):
+    metrics.UPLOAD_BYTES.observe(os.path.getsize(file_path))
+    print(f"File saved at: {file_path} (job {job_id})")
+    return {"file_path": file_path, "filename": os.path.basename(file_path)}
+
+
+# Per-request options from the query string (args) or form fields, returns (options, error response).
+# The output format comes from ?format= (json, mermaid, svg, png) or, where the response is the
+# result itself, the Accept header. Batches answer with a ZIP and jobs with their status, so
+# they pass no accept: their Accept header says nothing about the format of the diagrams
+def parse_options(args, form, accept=None):
+    options = {}
+    renderer = args.get("renderer") or form.get("renderer")
+    if renderer:
+        if renderer not in RENDERERS:
+            return None, ({"error": f"Unknown renderer '{renderer}', use one of: {', '.join(RENDERERS)}"}, 400)
+        options["renderer"] = renderer
+
+    requested = args.get("format") or form.get("format")
+    output, error = negotiate_output(requested, accept)
+    if error:
+        return None, ({"error": error}, 400 if requested else 406)
+    options["output"] = output
+    return options, None
+
+
+# Drop a job's workspace once its output has been read back
+def remove_job_dir(job_dir):
+    shutil.rmtree(job_dir, ignore_errors=True)
+
+
+# Gemini is out of quota or down: tell the client to come back instead of sending an error diagram
+def model_unavailable(error):
+    print(f"Gemini unavailable: {error}")
+    return (
+        {"error": "The analysis service is busy, please retry shortly"},
+        503,
+        {"Retry-After": str(error.retry_after)},
+    )
+
+
+# The error response for the exception being handled, call it from the except block
+def error_response(error):
+    if isinstance(error, ModelUnavailableError):
+        return model_unavailable(error)
+    print(f"Error occurred: {str(error)}")
+    traceback.print_exc()
+    return {"error": str(error)}, 500
+
+
+def queue_full(error):
+    print(f"Rejecting job: {error}")
+    return {"error": "Server is busy, please retry shortly"}, 429, {"Retry-After": "5"}
+
+
+# The 202 answer to a submitted job, url_for is the framework's
+def job_accepted(job, url_for):
+    return {
+        "job_id": job.id,
+        "stage": job.stage,
+        "status_url": url_for("job_status", job_id=job.id),
+        "events_url": url_for("job_events", job_id=job.id),
+        "result_url": url_for("job_result", job_id=job.id),
+    }, 202
+
+
+# Why a job's result can't be sent (as an error response), None once it's done
+def job_not_ready(job):
+    if job is None:
+        return {"error": "Unknown job"}, 404
+    if job.stage == "failed":
+        return {"error": job.error or "Failed to generate diagram"}, 500
+    if job.stage != "done":
+        return {"error": "Job not finished", "stage": job.stage}, 409
+    return None
+
+
+# One server-sent event
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# Background jobs do the full extract -> analyze -> render pipeline on their own threads, which
+# hand each job to the processor's event loop (the server's own loop under ASGI)
+def create_job_manager(processor):
+    def run_job(job):
+        return processor.run(
+            processor.process(
+                job_dir=job.job_dir,
+                on_stage=job.set_stage,
+                on_partial=job.add_partial,
+                **job.process_args,
+            )
+        )
+
+    return JobManager(
+        run_job,
+        on_expire=lambda job: remove_job_dir(job.job_dir),
+        max_workers=int(os.getenv("JOB_WORKERS", "4")),
+        max_pending=int(os.getenv("JOB_QUEUE_LIMIT", "32")),
+        ttl=int(os.getenv("JOB_TTL_SECONDS", "3600")),
+    )
@@ -0,0 +1,149 @@
+import os
+import json
+
+from chunking import normalize_id
+from stream_parser import WorkflowStreamParser
+
+
+# Bump when the validation rules change, it's part of the cached analysis keys
+WORKFLOW_SCHEMA_VERSION = "2"
+
+NODE_TYPES = ("core", "support")
+
+# The shape every analyzer asks for. Sent as the response schema, so Gemini's decoding is
+# constrained to exactly this JSON: no prose, no code fence, no single quotes
+WORKFLOW_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "nodes": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "id": {"type": "string"},
+                    "text": {"type": "string"},
+                    "type": {"type": "string", "enum": list(NODE_TYPES)},
+                },
+                "required": ["id", "text", "type"],
+            },
+        },
+        "edges": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "from": {"type": "string"},
+                    "to": {"type": "string"},
+                    "label": {"type": "string"},
+                },
+                "required": ["from", "to", "label"],
+            },
+        },
+    },
+    "required": ["nodes", "edges"],
+}
+
+# 0 sends the prompts without a schema and relies on the parsing fallbacks alone
+STRUCTURED_OUTPUT = os.getenv("STRUCTURED_OUTPUT", "1") == "1"
+
+
+# A generation config that asks for JSON matching WORKFLOW_SCHEMA
+def structured_config(generation_config):
+    if not STRUCTURED_OUTPUT:
+        return dict(generation_config)
+    return {
+        **generation_config,
+        "response_mime_type": "application/json",
+        "response_schema": WORKFLOW_SCHEMA,
+    }
+
+
+def _load_object(text):
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+# Parse a workflow reply. With structured output it's plain JSON and the first json.loads
+# succeeds; without it the object is cut out of any prose or fence around it, single quotes
+# are tried as double quotes, and a reply that is still broken (e.g. cut off at
+# max_output_tokens) keeps every node and edge that was complete.
+# Raises ValueError when there is nothing to use
+def parse_workflow_reply(response_text):
+    data = _load_object(response_text)
+    if data is not None:
+        return data
+
+    json_start = response_text.find("{")
+    json_end = response_text.rfind("}") + 1
+    if json_start >= 0 and json_end > json_start:
+        json_str = response_text[json_start:json_end]
+        data = _load_object(json_str) or _load_object(json_str.replace("'", '"').replace("\n", " "))
+        if data is not None:
+            return data
+
+    for text in (response_text, response_text.replace("'", '"')):
+        parser = WorkflowStreamParser()
+        parser.feed(text)
+        if parser.nodes:
+            print(f"Recovered {len(parser.nodes)} nodes and {len(parser.edges)} edges from a malformed reply")
+            return parser.result()
+    raise ValueError("No valid JSON found in response")
+
+
+# Check a parsed reply against the schema and make it safe to render. Node IDs are normalized
+# (lowercase_with_underscores, nodes whose IDs normalize the same are merged) and every edge
+# endpoint goes through the same mapping, so edges keep pointing at their nodes.
+# Returns (workflow, dangling): dangling are the edges naming a node that doesn't exist, they
+# are left out of the workflow. Raises ValueError when the reply has no usable nodes
+def validate_workflow(data):
+    if not isinstance(data, dict) or not isinstance(data.get("nodes"), list):
+        raise ValueError("Reply has no node list")
+
+    nodes = {}  # normalized ID -> node, in the model's order
+    for node in data["nodes"]:
+        if not isinstance(node, dict):
+            continue
+        name = node.get("id") or node.get("text")
+        if not isinstance(name, str) or not name.strip():
+            continue
+        node_id = normalize_id(name)
+        text = node.get("text") if isinstance(node.get("text"), str) and node["text"].strip() else name
+        node_type = node.get("type") if node.get("type") in NODE_TYPES else "core"
+
+        existing = nodes.get(node_id)
+        if existing is None:
+            nodes[node_id] = {"id": node_id, "text": text, "type": node_type}
+        else:
+            # the same process listed twice, keep the most detailed description
+            if len(text) > len(existing["text"]):
+                existing["text"] = text
+            if node_type == "core":
+                existing["type"] = "core"
+    if not nodes:
+        raise ValueError("Reply has no usable nodes")
+
+    edges = []
+    dangling = []
+    seen = set()
+    for edge in data.get("edges") or []:
+        if not isinstance(edge, dict):
+            continue
+        source, target = (
+            normalize_id(edge[end]) if isinstance(edge.get(end), str) and edge[end].strip() else None
+            for end in ("from", "to")
+        )
+        if source is None or target is None:
+            continue
+        label = edge.get("label") if isinstance(edge.get("label"), str) and edge["label"] else "flow"
+        if source not in nodes or target not in nodes:
+            dangling.append({"from": edge.get("from"), "to": edge.get("to"), "label": label})
+            continue
+        if source == target or (source, target) in seen:
+            continue
+        seen.add((source, target))
+        edges.append({"from": source, "to": target, "label": label})
+
+    return {"nodes": list(nodes.values()), "edges": edges}, dangling